@@ -27,6 +27,8 @@ def bipm_utcr_download():
     """
     Download UTC-rapid datafile from BIPM
     place result in the UTCr/ subdirectory
+    only files that changed on the server are downloaded.
+    Return the list of updated labs, e.g. ["ptb", "mike"]
     """
     print("bipm_utcR_download start ", datetime.datetime.utcnow())
     
@@ -46,16 +48,20 @@ def bipm_utcr_download():
                    ["pub/tai/publication/utcrlab/","utcr-usno"],
                    ["pub/tai/publication/utcrlab/","utcr-mike"] ]
     
-    for (remotedir, remotefile) in utcr_files:
-        ftp_tools.ftp_download( server, username, password, remotedir, remotefile, localdir, overwrite=True)
-
+    # all files come from one server, so they share pooled connections
+    updated = ftp_tools.ftp_refresh_many( server, username, password, utcr_files, localdir)
+    labs = updated_labs(updated)
+    print("updated labs: ", labs)
     print("bipm_utcR_download Done ", datetime.datetime.utcnow())
+    return labs
           
 def bipm_utc_download(prefixdir=""):
     """
     Download Circular-T data from BIPM website.
     
     placed in UTC/ subdirectory
+    only files that changed on the server are downloaded.
+    Return the list of updated labs, e.g. ["ptb", "mike"]
     """
     print("bipm_utc_download start ", datetime.datetime.utcnow())
     current_dir = os.getcwd()
@@ -75,11 +81,18 @@ def bipm_utc_download(prefixdir=""):
                  ["pub/tai/publication/utclab/","utc-op"],
                  ["pub/tai/publication/utclab/","utc-npl"] ]
 
-    for (remotedir, remotefile) in utc_files:
-        ftp_tools.ftp_download( server, username, password, remotedir, remotefile, localdir, overwrite=True)
-
-    
+    # all files come from one server, so they share pooled connections
+    updated = ftp_tools.ftp_refresh_many( server, username, password, utc_files, localdir)
+    labs = updated_labs(updated)
+    print("updated labs: ", labs)
     print("bipm_utc_download Done ", datetime.datetime.utcnow())
+    return labs
+
+def updated_labs(updated_files):
+    """
+    lab names from updated filenames, e.g. /x/UTC/utc-mike -> mike
+    """
+    return [os.path.basename(f).split("-", 1)[1] for f in updated_files]
 
 def read_UTC(prefixdir, station, rapid=False):
     """
@@ -0,0 +1,334 @@
+"""
+    This file is part of ppp-tools, https://github.com/aewallin/ppp-tools
+    GPLv2 license.
+
+    Native decoder for Hatanaka compressed (Compact RINEX, CRX) files.
+
+    Converts Compact RINEX 1.0 (RINEX 2) and 3.0 (RINEX 3) observation
+    files to standard RINEX, with the same output as CRX2RNX from
+    the RNXCMP package. The input is read line by line, so decode()
+    can read directly from decompress.open_decompressed().
+
+    Compact RINEX stores
+    - epoch lines as text differences to the previous epoch line,
+      with the list of satellites appended
+    - the receiver clock offset, and each observable, as integers
+      (units of 1e-9 s, 1e-12 s and 1e-3) differenced up to an order
+      given when the arc is (re)started: "3&123456"
+    - LLI and signal strength flags as text differences per satellite
+
+    Hatanaka, Y. (2008), A Compression Format and Tools for GNSS
+    Observation Data, Bulletin of the Geographical Survey Institute, 55, 21-30.
+
+    tests/test_crx2rnx.py compares the output byte for byte with the output
+    of CRX2RNX for Compact RINEX 1.0 and 3.0 files in tests/data/
+
+    command line example, decodes a file and compares speed and output with CRX2RNX:
+    python crx2rnx.py MI040040.21D
+"""
+import os
+import sys
+import time
+import subprocess
+
+import rnx3to2
+
+crx2rnx_binary = "CRX2RNX"  # external RNXCMP tool, used when native = False
+native = True  # use the decoder in this file instead of crx2rnx_binary
+
+
+class Arc():
+    """
+    one differenced data arc, e.g. the L1 phase of one satellite.
+    u[k] is the k-th difference of the latest values, u[0] the value itself.
+    """
+    __slots__ = ("order", "max_order", "u")
+
+    def __init__(self, max_order, value):
+        self.max_order = max_order
+        self.order = 0
+        self.u = [value] + [0]*max_order
+
+    def add(self, difference):
+        if self.order < self.max_order:
+            self.order += 1
+        u = self.u
+        u[self.order] = difference
+        for k in range(self.order, 0, -1):
+            u[k-1] += u[k]
+        return u[0]
+
+
+def repair(old, diff):
+    """
+    apply a text difference: " " keeps the old character,
+    "&" is a space, any other character replaces the old one.
+    """
+    if len(diff) <= len(old) and (not diff or diff.isspace()):
+        return old
+    chars = list(old)
+    for (i, c) in enumerate(diff):
+        if i < len(chars):
+            if c == " ":
+                continue
+            chars[i] = " " if c == "&" else c
+        else:
+            chars.append(" " if c == "&" else c)
+    return "".join(chars)
+
+
+def field_value(field, arc):
+    """
+    decode one field "n&value" (new arc of order n) or "difference".
+    Returns (value, arc).
+    """
+    amp = field.find("&")
+    if amp >= 0:
+        arc = Arc(int(field[:amp]), int(field[amp+1:]))
+        return (arc.u[0], arc)
+    if arc is None:
+        raise ValueError("Compact RINEX difference without initialization: %s" % field)
+    return (arc.add(int(field)), arc)
+
+
+def fixed(value, decimals, width):
+    """
+    format an integer in units of 10**-decimals like CRX2RNX,
+    i.e. as Fortran F-format without a leading zero: -0.5 -> "-.500"
+    """
+    scale = 10**decimals
+    if value >= scale or value <= -scale:
+        s = str(value)
+        return (s[:-decimals] + "." + s[-decimals:]).rjust(width)
+    (ipart, frac) = divmod(abs(value), scale)
+    s = "%s%s.%0*d" % ("-" if value < 0 else "", ipart if ipart else "", decimals, frac)
+    return s.rjust(width)
+
+
+class Decoder():
+    """
+    state of a Compact RINEX to RINEX conversion
+    """
+
+    def __init__(self):
+        self.crx_version = None
+        self.rinex_version = 2
+        self.ntype = {}  # satellite system -> number of observation types, " " for RINEX 2
+        self.epoch = ""  # the previous epoch line
+        self.clock = None  # Arc of the receiver clock offset
+        self.sats = {}  # satellite -> (list of Arcs, flag string) of the previous epoch
+
+    def header_line(self, line):
+        """
+        note the number of observation types from a header line
+        """
+        label = line[60:].rstrip()
+        if label == "RINEX VERSION / TYPE":
+            self.rinex_version = int(float(line[:9]))
+        elif label == "# / TYPES OF OBSERV" and line[:6].strip():
+            self.ntype[" "] = int(line[:6])
+        elif label == "SYS / # / OBS TYPES" and line[0] != " ":
+            self.ntype[line[0]] = int(line[3:6])
+
+    def types(self, sat):
+        if self.rinex_version == 2:
+            return self.ntype[" "]
+        return self.ntype[sat[0]]
+
+    def epoch_line(self, line):
+        """
+        return the repaired epoch line. "&" (CRX 1.0) or ">" (CRX 3.0)
+        in the first column starts a new epoch line, and all arcs.
+        """
+        if line[:1] == "&" or (self.crx_version == 3 and line[:1] == ">"):
+            self.epoch = repair("", line)
+            self.clock = None
+            self.sats = {}
+        else:
+            self.epoch = repair(self.epoch, line)
+        return self.epoch
+
+    def rinex_lines(self, lines):
+        """
+        decode Compact RINEX from an iterator over lines (without newline),
+        yielding the RINEX output lines.
+        """
+        first = next(lines)
+        if first[60:].rstrip() != "CRINEX VERS   / TYPE":
+            raise ValueError("not a Compact RINEX file")
+        self.crx_version = int(float(first[:9]))
+        next(lines)  # CRINEX PROG / DATE
+        for line in lines:
+            yield line
+            self.header_line(line)
+            if line[60:].rstrip() == "END OF HEADER":
+                break
+
+        if self.crx_version == 3:
+            (flag_col, nsat_cols, sat_col, clock_decimals) = (31, (32, 35), 41, 12)
+        else:
+            (flag_col, nsat_cols, sat_col, clock_decimals) = (28, (29, 32), 32, 9)
+        for line in lines:
+            epoch = self.epoch_line(line)
+            nsat = int(epoch[nsat_cols[0]:nsat_cols[1]])
+            if epoch[flag_col] in "2345":  # event, followed by nsat header lines
+                yield epoch[:nsat_cols[1]].rstrip()
+                for n in range(nsat):
+                    record = next(lines)
+                    self.header_line(record)
+                    yield record
+                continue
+
+            clock_line = next(lines)
+            clock = None
+            if clock_line:
+                (clock, self.clock) = field_value(clock_line, self.clock)
+            else:
+                self.clock = None
+
+            sat_list = [epoch[sat_col+3*i:sat_col+3*i+3] for i in range(nsat)]
+            if self.crx_version == 3:
+                head = epoch[:nsat_cols[1]]
+                if clock is not None:
+                    head += " "*6 + fixed(clock, clock_decimals, 15)
+                yield head.rstrip()
+            else:
+                for i in range(0, max(nsat, 1), 12):
+                    if i == 0:
+                        head = epoch[:sat_col] + "".join(sat_list[0:12])
+                        if clock is not None:
+                            head = head.ljust(68) + fixed(clock, clock_decimals, 12)
+                        yield head.rstrip()
+                    else:
+                        yield " "*32 + "".join(sat_list[i:i+12])
+
+            sats = {}
+            for sat in sat_list:
+                ntype = self.types(sat)
+                (arcs, flags) = self.sats.get(sat, ([None]*ntype, ""))
+                arcs = list(arcs)
+                # ntype fields separated by " ", then the flags.
+                # missing fields at the end of the line are missing data
+                fields = next(lines).split(" ", ntype)
+                values = [None]*ntype
+                for i in range(ntype):
+                    if i < len(fields) and fields[i]:
+                        (values[i], arcs[i]) = field_value(fields[i], arcs[i])
+                    else:
+                        arcs[i] = None
+                flag_diff = fields[ntype] if len(fields) > ntype else ""
+                flags = repair(flags, flag_diff).ljust(2*ntype)
+                obs = []
+                for i in range(ntype):
+                    if values[i] is None:  # flags of missing data are cleared
+                        flags = flags[:2*i] + "  " + flags[2*i+2:]
+                        obs.append(" "*16)
+                    else:
+                        obs.append(fixed(values[i], 3, 14) + flags[2*i:2*i+2])
+                sats[sat] = (arcs, flags)
+                if self.crx_version == 3:
+                    yield (sat + "".join(obs)).rstrip()
+                else:
+                    for i in range(0, ntype, 5):
+                        yield "".join(obs[i:i+5]).rstrip()
+            self.sats = sats
+
+
+def decode(fin, fout, rinex2=False):
+    """
+    decode Compact RINEX from binary file object fin to fout.
+    with rinex2, RINEX 3 is converted to RINEX 2 on the fly, see rnx3to2.py
+    """
+    lines = (line.decode("latin-1").rstrip("\r\n") for line in fin)
+    rnx = Decoder().rinex_lines(lines)
+    if rinex2:
+        rnx = rnx3to2.rinex2_lines(rnx)
+    rnx3to2.write_lines(rnx, fout)
+
+
+def rinex_name(crx_name):
+    """
+    RINEX name of a Compact RINEX file: .21d -> .21o, .21D -> .21O, .crx -> .rnx
+    """
+    if crx_name.endswith(".crx"):
+        return crx_name[:-4] + ".rnx"
+    if crx_name.endswith(".CRX"):
+        return crx_name[:-4] + ".RNX"
+    return crx_name[:-1] + {"d": "o", "D": "O"}[crx_name[-1]]
+
+
+def is_crx_name(fn):
+    """
+    True for Compact RINEX filenames, e.g. MI040040.21D or ..._MO.crx
+    """
+    return (fn.lower().endswith(".crx") or
+            (len(fn) > 4 and fn[-4] == "." and fn[-3:-1].isdigit() and fn[-1] in "dD"))
+
+
+def convert(crx_file, fin=None, rinex2=False):
+    """
+    convert crx_file to RINEX, next to it. With fin, read the Compact RINEX
+    from the (binary) file object fin, e.g. a decompressing reader.
+    With rinex2, RINEX 3 is also converted to RINEX 2.
+    Uses the native decoder, or crx2rnx_binary if native is False.
+    Returns the RINEX filename.
+    """
+    rnx_file = rinex_name(crx_file)
+    if not native:
+        if fin is not None:
+            with open(crx_file, "wb") as f:
+                for block in iter(lambda: fin.read(1 << 20), b""):
+                    f.write(block)
+        cmd = [crx2rnx_binary, "-f", crx_file]
+        print("Hatanaka uncompress: ", " ".join(cmd))
+        subprocess.check_call(cmd)
+        if rinex2:
+            rnx3to2.convert_file(rnx_file, rnx_file)
+        return rnx_file
+    print("Hatanaka uncompress: ", crx_file, " -> ", rnx_file)
+    part = rnx_file + ".part"
+    try:
+        with open(part, "wb") as fout:
+            if fin is None:
+                with open(crx_file, "rb") as fin:
+                    decode(fin, fout, rinex2)
+            else:
+                decode(fin, fout, rinex2)
+    except Exception:
+        os.unlink(part)
+        raise
+    os.replace(part, rnx_file)
+    return rnx_file
+
+
+def benchmark(crx_file):
+    """
+    decode crx_file natively and with crx2rnx_binary,
+    compare the outputs and print the throughput of both
+    """
+    size = os.path.getsize(crx_file)
+    t0 = time.time()
+    with open(crx_file, "rb") as fin:
+        with open(crx_file + ".native", "wb") as fout:
+            decode(fin, fout)
+    t_native = time.time() - t0
+    t0 = time.time()
+    with open(crx_file, "rb") as fin:
+        with open(crx_file + ".binary", "wb") as fout:
+            subprocess.check_call([crx2rnx_binary, "-"], stdin=fin, stdout=fout)
+    t_binary = time.time() - t0
+    with open(crx_file + ".native", "rb") as f1:
+        with open(crx_file + ".binary", "rb") as f2:
+            identical = f1.read() == f2.read()
+    print("%s: %d bytes" % (crx_file, size))
+    print("  native  %.3f s, %.1f MB/s" % (t_native, size/t_native/1e6))
+    print("  %-7s %.3f s, %.1f MB/s" % (crx2rnx_binary, t_binary, size/t_binary/1e6))
+    print("  output identical: %s" % identical)
+    os.unlink(crx_file + ".native")
+    os.unlink(crx_file + ".binary")
+    return identical
+
+
+if __name__ == "__main__":
+    for f in sys.argv[1:]:
+        benchmark(f)
@@ -0,0 +1,359 @@
+"""
+    This file is part of ppp-tools, https://github.com/aewallin/ppp-tools
+    GPLv2 license.
+
+    In-process decompression of gzip (.gz) and Unix compress (.Z) files.
+
+    Replaces copying each compressed file into the run directory and
+    then running /bin/gunzip on it. The compressed file is read once
+    from the stations/ or products/ cache, and the decompressed file is
+    written directly into the run directory.
+
+    The file format is detected from the magic number, so e.g. a
+    gzip file named .Z is handled like gunzip would.
+    Hatanaka compressed RINEX files (.21d, .21D, .crx) are also
+    decoded, and staged under their RINEX name.
+    stage_files() decompresses several files in parallel on a thread
+    pool. zlib releases the GIL, so gzip files decompress concurrently.
+    Unix compress files are decoded by an lzw_command subprocess
+    (gzip -dc), so they also decompress concurrently. Without gzip,
+    they are decoded by unlzw_blocks(), in Python, which is about 25
+    times slower than gzip and holds the GIL, so .Z files are then
+    decoded one at a time.
+    With an input_cache.InputCache, each file is decompressed only once,
+    and later runs hardlink it from the cache.
+"""
+import io
+import os
+import gzip
+import shutil
+import subprocess
+import concurrent.futures
+
+import crx2rnx
+import rnx3to2
+import rinex_prune
+import input_cache
+
+GZIP_MAGIC = b"\x1f\x8b"
+LZW_MAGIC = b"\x1f\x9d"
+block_size = 1 << 20  # bytes per read/write
+lzw_command = ["gzip", "-dc"]  # decodes .Z from stdin. None, or not installed: unlzw_blocks()
+
+
+def decompressed_name(fn):
+    """
+    filename without the compression suffix,
+    e.g. MI050040.21o.gz -> MI050040.21o, COD18461.EPH.Z -> COD18461.EPH
+    """
+    for suffix in (".gz", ".Z", ".z"):
+        if fn.endswith(suffix):
+            return fn[:-len(suffix)]
+    return fn
+
+
+def compression(path):
+    """
+    "gzip", "lzw" or None, from the first bytes of the file
+    """
+    with open(path, "rb") as f:
+        magic = f.read(2)
+    if magic == GZIP_MAGIC:
+        return "gzip"
+    if magic == LZW_MAGIC:
+        return "lzw"
+    return None
+
+
+def unlzw_blocks(fin):
+    """
+    decompress a Unix compress (.Z) stream from file object fin,
+    yielding blocks of decompressed bytes.
+    Used when lzw_command is not installed.
+
+    Codes are read in groups of 8, which for n-bit codes is n bytes.
+    When the code width changes, or after a CLEAR code, compress(1)
+    skips the rest of the current group.
+    """
+    header = fin.read(3)
+    if len(header) < 3 or header[:2] != LZW_MAGIC:
+        raise IOError("not a Unix compress file")
+    maxbits = header[2] & 0x1f
+    block_mode = bool(header[2] & 0x80)
+    if maxbits < 9 or maxbits > 16:
+        raise IOError("unsupported compress maxbits %d" % maxbits)
+    maxmaxcode = 1 << maxbits
+
+    table = [bytes([c]) for c in range(256)] + [b""]*(maxmaxcode - 256)
+    n_bits = 9
+    maxcode = (1 << n_bits) - 1
+    free_ent = 257 if block_mode else 256
+    oldcode = None
+    out = []
+    out_size = 0
+    while True:
+        group = fin.read(n_bits)
+        if not group:
+            break
+        bits = int.from_bytes(group, "little")
+        mask = (1 << n_bits) - 1
+        for i in range(len(group)*8 // n_bits):
+            code = (bits >> (i*n_bits)) & mask
+            if oldcode is None:  # first code
+                if code >= 256:
+                    raise IOError("corrupt compress file")
+                entry = table[code]
+            elif code == 256 and block_mode:  # CLEAR, start a new table
+                free_ent = 256
+                n_bits = 9
+                maxcode = (1 << n_bits) - 1
+                break
+            else:
+                if code < free_ent:
+                    entry = table[code]
+                elif code == free_ent:
+                    entry = table[oldcode] + table[oldcode][:1]
+                else:
+                    raise IOError("corrupt compress file")
+                if free_ent < maxmaxcode:
+                    table[free_ent] = table[oldcode] + entry[:1]
+                    free_ent += 1
+            oldcode = code
+            out.append(entry)
+            out_size += len(entry)
+            if out_size >= block_size:
+                yield b"".join(out)
+                out = []
+                out_size = 0
+            if free_ent > maxcode and n_bits < maxbits:  # wider codes from the next group
+                n_bits += 1
+                maxcode = maxmaxcode if n_bits == maxbits else (1 << n_bits) - 1
+                break
+    if out:
+        yield b"".join(out)
+
+
+class LZWReader(io.RawIOBase):
+    """
+    read-only binary file object for a Unix compress (.Z) file
+    """
+
+    def __init__(self, path):
+        self.f = open(path, "rb")
+        self.blocks = unlzw_blocks(self.f)
+        self.buffer = b""
+
+    def readable(self):
+        return True
+
+    def readinto(self, b):
+        while not self.buffer:
+            self.buffer = next(self.blocks, None)
+            if self.buffer is None:
+                self.buffer = b""
+                return 0
+        n = min(len(b), len(self.buffer))
+        b[:n] = self.buffer[:n]
+        self.buffer = self.buffer[n:]
+        return n
+
+    def close(self):
+        self.f.close()
+        super().close()
+
+
+class CommandReader(io.RawIOBase):
+    """
+    read-only binary file object for the output of command cmd,
+    reading path on its stdin, e.g. gzip -dc < file.Z
+    If cmd fails, an IOError is raised at the end of the output.
+    """
+
+    def __init__(self, cmd, path):
+        self.cmd = cmd
+        with open(path, "rb") as fin:
+            self.proc = subprocess.Popen(cmd, stdin=fin, stdout=subprocess.PIPE,
+                                         stderr=subprocess.PIPE)
+        self.finished = False
+
+    def readable(self):
+        return True
+
+    def readinto(self, b):
+        n = self.proc.stdout.readinto(b)
+        if n == 0 and not self.finished:
+            self.finished = True
+            error = self.proc.stderr.read()
+            if self.proc.wait() != 0:
+                raise IOError("%s failed: %s" % (" ".join(self.cmd), error.decode(errors="replace").strip()))
+        return n
+
+    def close(self):
+        if not self.closed:
+            if self.proc.poll() is None:  # closed before the end of the output
+                self.proc.kill()
+            self.proc.stdout.close()
+            self.proc.stderr.close()
+            self.proc.wait()
+        super().close()
+
+
+def open_decompressed(path):
+    """
+    open path for reading as a binary file object, decompressing
+    gzip and Unix compress files on the fly.
+    Unix compress files are decoded by lzw_command if it is installed,
+    otherwise by unlzw_blocks().
+    """
+    kind = compression(path)
+    if kind == "gzip":
+        return gzip.open(path, "rb")
+    if kind == "lzw":
+        if lzw_command and shutil.which(lzw_command[0]):
+            return io.BufferedReader(CommandReader(lzw_command, path), block_size)
+        return io.BufferedReader(LZWReader(path), block_size)
+    return open(path, "rb")
+
+
+def decompress(src, dst):
+    """
+    write the decompressed contents of src to dst, in one pass.
+    files that are not compressed are copied.
+    dst is written as dst.part and renamed into place when complete.
+    """
+    part = dst + ".part"
+    try:
+        with open(part, "wb") as fout:
+            with open_decompressed(src) as fin:
+                shutil.copyfileobj(fin, fout, block_size)
+    except Exception:
+        os.unlink(part)
+        raise
+    os.replace(part, dst)
+    return dst
+
+
+def staged_name(src):
+    """
+    filename of src after staging, e.g. MI040040.21d.gz -> MI040040.21o
+    """
+    name = decompressed_name(os.path.basename(src))
+    if crx2rnx.is_crx_name(name):
+        return crx2rnx.rinex_name(name)
+    return name
+
+
+def recipe(rinex2, prune=None):
+    """
+    input_cache recipe of stage()
+    """
+    r = "stage"
+    if prune:
+        r += ":" + rinex_prune.recipe(prune)
+    if rinex2:
+        r += ":" + rnx3to2.recipe()
+    return r
+
+
+def rinex_lines(src, rinex2=False, cache=None, prune=None):
+    """
+    generator of the RINEX lines (without newline) of the compressed,
+    and possibly Hatanaka compressed, RINEX file src.
+    with a prune profile, observations are decimated and pruned, see rinex_prune.py
+    with rinex2, RINEX 3 observations are converted to RINEX 2.
+    Nothing is written to disk. When an input_cache.InputCache cache
+    has src staged already, the lines are read from the cache.
+    """
+    if cache is not None:
+        cached = cache.lookup(src, staged_name(src), recipe(rinex2, prune))
+        if cached is not None:
+            (src, rinex2, prune) = (cached, False, None)  # cached files are converted already
+    with open_decompressed(src) as fin:
+        lines = (line.decode("latin-1").rstrip("\r\n") for line in fin)
+        if crx2rnx.is_crx_name(decompressed_name(os.path.basename(src))):
+            lines = crx2rnx.Decoder().rinex_lines(lines)
+        if prune:
+            lines = rinex_prune.pruned_lines(lines, prune, src)
+        if rinex2:
+            lines = rnx3to2.rinex2_lines(lines)
+        yield from lines
+
+
+def write_rinex(src, dst, rinex2=False, prune=None):
+    """
+    write the lines of rinex_lines(src, rinex2, prune=prune) to dst
+    """
+    part = dst + ".part"
+    try:
+        with open(part, "wb") as fout:
+            rnx3to2.write_lines(rinex_lines(src, rinex2, prune=prune), fout)
+    except Exception:
+        os.unlink(part)
+        raise
+    os.replace(part, dst)
+    return dst
+
+
+def prestage(src, cache, rinex2=False, prune=None):
+    """
+    make sure the input_cache.InputCache cache has src, staged with
+    rinex2 and prune as stage() would, e.g. ahead of the run that needs it.
+    Returns the cached file.
+    """
+    obs = rnx3to2.is_obs_name(staged_name(src))
+    (rinex2, prune) = (rinex2 and obs, prune if obs else None)
+    return cache.fetch(src, staged_name(src), recipe(rinex2, prune),
+                       lambda tmpdir: stage(src, tmpdir, rinex2=rinex2, prune=prune))
+
+
+def stage(src, destdir, cache=None, rinex2=False, prune=None):
+    """
+    decompress (or copy) src into directory destdir.
+    Hatanaka compressed RINEX is also converted to RINEX,
+    in the same pass, see crx2rnx.py
+    With a prune profile, RINEX observation files are decimated and pruned
+    (rinex_prune.py), and with rinex2, RINEX 3 observation files are
+    converted to RINEX 2, also in the same pass. Other files are not affected.
+    With an input_cache.InputCache the staged file is taken from,
+    or added to, the cache and linked into destdir.
+    Returns the full name of the staged file.
+    """
+    obs = rnx3to2.is_obs_name(staged_name(src))
+    (rinex2, prune) = (rinex2 and obs, prune if obs else None)
+    dst = os.path.join(destdir, staged_name(src))
+    if cache is not None:
+        cached = prestage(src, cache, rinex2, prune)
+        how = input_cache.link(cached, dst)
+        print("staging from cache (%s): " % how, src, " -> ", dst)
+        return dst
+    crx = crx2rnx.is_crx_name(decompressed_name(os.path.basename(src)))
+    if crx and not crx2rnx.native:  # external CRX2RNX
+        with open_decompressed(src) as fin:
+            dst = crx2rnx.convert(os.path.join(destdir, decompressed_name(os.path.basename(src))),
+                                  fin, rinex2)
+        if prune:
+            rinex_prune.prune_file(dst, dst, prune)
+        return dst
+    if crx or rinex2 or prune:
+        steps = [name for (name, step) in [("Hatanaka decode", crx), ("pruned", prune),
+                                            ("RINEX 2", rinex2)] if step]
+        print("staging (%s): " % ", ".join(steps), src, " -> ", dst)
+        return write_rinex(src, dst, rinex2, prune)
+    print("staging: ", src, " -> ", dst)
+    return decompress(src, dst)
+
+
+def stage_files(files, destdir, workers=4, cache=None, rinex2=False, prune=None):
+    """
+    stage a list of files into destdir, in parallel.
+    A file listed more than once is staged once.
+    cache is an optional input_cache.InputCache.
+    with rinex2, RINEX 3 observation files are converted to RINEX 2.
+    with a prune profile, RINEX observation files are decimated and pruned.
+    Returns the staged filenames, in the same order as files.
+    """
+    unique = list(dict.fromkeys(files))
+    with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+        staged = dict(zip(unique, executor.map(lambda f: stage(f, destdir, cache, rinex2, prune),
+                                               unique)))
+    return [staged[f] for f in files]
@@ -2,12 +2,24 @@ import ftplib
 import datetime
 import os
 import sys
+import threading
+import atexit
+import concurrent.futures
+import gzip
+import zlib
+import urllib.error
+import urllib.parse
+import http.client
+import contextlib
+import json
+
+import decompress
 
 def check_dir(target_dir):
-    # check that local target directory exists, create it if not
+    # check that local target directory exists, create it (and its parents) if not
     if not os.path.isdir(target_dir):
         print("creating target directory ", target_dir)
-        os.mkdir(target_dir)
+        os.makedirs(target_dir, exist_ok=True)
 
 def delete_files(folder):
     # delete all files in given local folder
@@ -20,12 +32,507 @@ def delete_files(folder):
         except Exception as e:
             print(e)
             
+def check_file(path, name=None):
+    """
+    check the integrity of a downloaded file.
+    name is the final filename, used to find the file type,
+    if path is a temporary (.part) file.
+    gzip files are read through to verify the CRC.
+    Unix-compress (.Z) files must start with the compress magic bytes,
+    and are decoded to the end. The format has no checksum, so this
+    finds invalid codes, but not a file cut at a code boundary.
+    Return True if the file looks good.
+    """
+    if name is None:
+        name = path
+    if os.path.getsize(path) == 0:
+        return False
+    try:
+        if name.endswith(".gz"):
+            with gzip.open(path, 'rb') as f:
+                while f.read(1 << 20):
+                    pass
+        elif name.endswith(".Z"):
+            if decompress.compression(path) != "lzw":
+                return False
+            with decompress.open_decompressed(path) as f:
+                while f.read(1 << 20):
+                    pass
+    except (OSError, EOFError, zlib.error) as e:
+        print("integrity check failed for ", name, e)
+        return False
+    return True
+
+class PartFile():
+    """
+    the .part file of a download, opened when the first data arrives,
+    so a transfer that fails before sending data (e.g. a missing remote
+    file) leaves no empty .part file to be resumed later.
+    offset is the size of an existing .part file, appended to.
+    """
+
+    def __init__(self, part, offset=0):
+        self.part = part
+        self.offset = offset
+        self.f = None
+
+    def write(self, block):
+        if self.f is None:
+            self.f = open(self.part, 'ab' if self.offset else 'wb')
+        self.f.write(block)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if self.f is not None:
+            self.f.close()
+        elif exc_type is None and not self.offset:
+            open(self.part, 'wb').close()  # an empty remote file, rejected by finish_part()
+
+
+def finish_part(part, local_fullname, expected_size=None):
+    """
+    move a completely downloaded .part file into place.
+    The size (if known) and integrity of the file are checked first.
+    A short file is kept so the download can be resumed,
+    a corrupt file is deleted.
+    """
+    size = os.path.getsize(part)
+    if expected_size is not None and size != expected_size:
+        if size > expected_size:
+            os.unlink(part)
+        raise IOError("incomplete download %s: %d of %d bytes" % (local_fullname, size, expected_size))
+    if not check_file(part, local_fullname):
+        os.unlink(part)
+        raise IOError("corrupt download %s" % local_fullname)
+    os.replace(part, local_fullname)  # atomic rename
+    return local_fullname
+
+def http_download(url, local_fullname, timeout=60, progress=None):
+    """
+    download url to local_fullname.
+    Data is written to local_fullname + ".part", an interrupted
+    download is resumed with an HTTP Range request.
+    The file is renamed into place only after size and
+    integrity checks.
+    timeout applies to each network operation, so a stalled transfer fails.
+    progress, if given, is called as progress(bytes_done, bytes_total)
+    with bytes_total None if unknown.
+    The connection comes from http_pool, and is kept open for the
+    next request to the same server.
+    Return the full local filename.
+    """
+    part = local_fullname + ".part"
+    offset = 0
+    if os.path.exists(part):
+        offset = os.path.getsize(part)
+    headers = {}
+    if offset:
+        print("resuming ", url, " from byte ", offset)
+        headers["Range"] = "bytes=%d-" % offset
+    try:
+        with http_pool.request(url, headers, timeout) as response:
+            if offset and response.status != 206:  # server ignored Range, start over
+                offset = 0
+            expected_size = None
+            if response.headers.get("Content-Length") is not None:
+                expected_size = offset + int(response.headers["Content-Length"])
+            done = offset
+            with PartFile(part, offset) as fhandle:
+                while True:
+                    block = response.read(1 << 16)
+                    if not block:
+                        break
+                    fhandle.write(block)
+                    done += len(block)
+                    if progress:
+                        progress(done, expected_size)
+    except urllib.error.HTTPError as e:
+        if e.code == 416 and offset:  # range not satisfiable, .part may be complete
+            return finish_part(part, local_fullname)
+        if e.code in (404, 410) and offset:  # the remote file is gone, do not resume from it
+            os.unlink(part)
+        raise
+    return finish_part(part, local_fullname, expected_size)
+
+class FTPPool():
+    """
+    A pool of logged-in ftplib.FTP sessions, keyed by (server, username).
+
+    Sessions are kept open between transfers, so that many files from
+    the same server need only one connection and login.
+    At most max_connections sessions are opened to each server.
+    The current remote directory of each session is remembered, and a
+    'cwd' is only sent when the directory changes.
+    A transfer that fails on a broken session is retried on a new one.
+    """
+
+    def __init__(self, max_connections=2, timeout=60, retries=2):
+        self.max_connections = max_connections
+        self.timeout = timeout
+        self.retries = retries
+        self.cond = threading.Condition()
+        self.idle = {}  # (server, username) -> list of idle sessions
+        self.count = {}  # (server, username) -> number of open sessions
+        self.home = {}  # session -> login directory
+        self.cwd = {}  # session -> current directory
+
+    def acquire(self, server, username, password):
+        """
+        return an idle session to server, or open a new one.
+        blocks if max_connections sessions are already in use.
+        """
+        key = (server, username)
+        with self.cond:
+            while True:
+                if self.idle.get(key):
+                    return self.idle[key].pop()
+                if self.count.get(key, 0) < self.max_connections:
+                    self.count[key] = self.count.get(key, 0) + 1
+                    break
+                self.cond.wait()
+        try:
+            print("FTP connect ", server)
+            ftp = ftplib.FTP(server, timeout=self.timeout)  # Establish the connection
+            ftp.login(username, password)
+            self.home[ftp] = ftp.pwd()
+            self.cwd[ftp] = ""
+        except Exception:
+            with self.cond:
+                self.count[key] -= 1
+                self.cond.notify()
+            raise
+        return ftp
+
+    def release(self, server, username, ftp, broken=False):
+        """
+        return a session to the pool.
+        a broken session is closed instead of being reused.
+        """
+        key = (server, username)
+        with self.cond:
+            if broken:
+                self.count[key] -= 1
+                self.home.pop(ftp, None)
+                self.cwd.pop(ftp, None)
+                try:
+                    ftp.close()
+                except Exception:
+                    pass
+            else:
+                self.idle.setdefault(key, []).append(ftp)
+            self.cond.notify()
+
+    def chdir(self, ftp, remotedir):
+        """
+        change remote directory, if the session is not already there.
+        relative directories are relative to the login directory.
+        """
+        if self.cwd.get(ftp) == remotedir:
+            return
+        # forget the current directory first, so a failed cwd (e.g. a missing
+        # directory) does not leave the session where it was remembered
+        self.cwd.pop(ftp, None)
+        if not remotedir.startswith("/"):
+            ftp.cwd(self.home[ftp])
+        ftp.cwd(remotedir)  # Change to the proper directory
+        self.cwd[ftp] = remotedir
+
+    def retrieve(self, server, username, password, remotedir, remotefile, local_fullname, progress=None):
+        """
+        download remotedir/remotefile to local_fullname, retrying
+        on a new session if the transfer fails.
+        Data is written to a .part file, created when the first data
+        arrives, and a retry resumes from the end of it with REST.
+        progress, if given, is called as progress(bytes_done, bytes_total)
+        """
+        part = local_fullname + ".part"
+        for attempt in range(self.retries + 1):
+            offset = 0
+            if os.path.exists(part):
+                offset = os.path.getsize(part)
+            ftp = self.acquire(server, username, password)
+            try:
+                self.chdir(ftp, remotedir)
+                ftp.voidcmd('TYPE I')
+                try:
+                    remote_size = ftp.size(remotefile)
+                except ftplib.error_perm:  # SIZE not supported
+                    remote_size = None
+                if remote_size is not None and offset > remote_size:
+                    offset = 0
+                if offset:
+                    print("resuming ", remotefile, " from byte ", offset)
+                done = [offset]
+                with PartFile(part, offset) as fhandle:
+                    def write(block):
+                        fhandle.write(block)
+                        done[0] += len(block)
+                        if progress:
+                            progress(done[0], remote_size)
+                    ftp.retrbinary('RETR ' + remotefile, write,
+                                   rest=offset or None)
+            except ftplib.error_perm:
+                # permanent error, e.g. file not found. session is still fine.
+                self.release(server, username, ftp)
+                if offset and attempt < self.retries:
+                    os.unlink(part)  # maybe REST is not supported, start over
+                    continue
+                raise
+            except ftplib.all_errors as e:
+                self.release(server, username, ftp, broken=True)
+                print("FTP transfer failed (%s), attempt %d" % (e, attempt + 1))
+                if attempt == self.retries:
+                    raise
+                continue
+            self.release(server, username, ftp)
+            return finish_part(part, local_fullname, remote_size)
+
+    def stat(self, server, username, password, remotedir, remotefile):
+        """
+        return (mdtm, size) of a remote file, from the MDTM and SIZE
+        commands. Each is None if the server does not support it.
+        """
+        for attempt in range(self.retries + 1):
+            ftp = self.acquire(server, username, password)
+            try:
+                self.chdir(ftp, remotedir)
+                ftp.voidcmd('TYPE I')
+                try:
+                    size = ftp.size(remotefile)
+                except ftplib.error_perm:
+                    size = None
+                try:
+                    mdtm = ftp.voidcmd('MDTM ' + remotefile).split()[-1]
+                except ftplib.error_perm:
+                    mdtm = None
+            except ftplib.all_errors as e:
+                self.release(server, username, ftp, broken=True)
+                print("FTP stat failed (%s), attempt %d" % (e, attempt + 1))
+                if attempt == self.retries:
+                    raise
+                continue
+            self.release(server, username, ftp)
+            return (mdtm, size)
+
+    def listing(self, server, username, password, remotedir):
+        """
+        return a dict {filename: size} for the files in remotedir.
+        size is None if the server does not support MLSD.
+        """
+        for attempt in range(self.retries + 1):
+            ftp = self.acquire(server, username, password)
+            try:
+                self.chdir(ftp, remotedir)
+                try:
+                    files = {}
+                    for (name, facts) in ftp.mlsd(facts=["type", "size"]):
+                        if facts.get("type") == "file":
+                            files[name] = int(facts["size"]) if "size" in facts else None
+                except ftplib.error_perm:  # MLSD not supported
+                    files = dict.fromkeys([os.path.basename(n) for n in ftp.nlst()])
+            except ftplib.error_perm:
+                self.release(server, username, ftp)
+                raise
+            except ftplib.all_errors as e:
+                self.release(server, username, ftp, broken=True)
+                print("FTP listing failed (%s), attempt %d" % (e, attempt + 1))
+                if attempt == self.retries:
+                    raise
+                continue
+            self.release(server, username, ftp)
+            return files
+
+    def details(self, server, username, password, remotedir):
+        """
+        return a dict {filename: {"size": .., "mtime": ..}} for the files
+        in remotedir, from MLSD. mtime is the MLSD "modify" fact, YYYYMMDDHHMMSS.
+        Without MLSD support sizes and mtimes are None.
+        """
+        for attempt in range(self.retries + 1):
+            ftp = self.acquire(server, username, password)
+            try:
+                self.chdir(ftp, remotedir)
+                try:
+                    files = {}
+                    for (name, facts) in ftp.mlsd(facts=["type", "size", "modify"]):
+                        if facts.get("type") == "file":
+                            files[name] = {"size": int(facts["size"]) if "size" in facts else None,
+                                           "mtime": facts.get("modify")}
+                except ftplib.error_perm:  # MLSD not supported
+                    files = {os.path.basename(n): {"size": None, "mtime": None}
+                             for n in ftp.nlst()}
+            except ftplib.error_perm:
+                self.release(server, username, ftp)
+                raise
+            except ftplib.all_errors as e:
+                self.release(server, username, ftp, broken=True)
+                print("FTP listing failed (%s), attempt %d" % (e, attempt + 1))
+                if attempt == self.retries:
+                    raise
+                continue
+            self.release(server, username, ftp)
+            return files
+
+    def close(self):
+        """
+        close all idle sessions
+        """
+        with self.cond:
+            for key, sessions in self.idle.items():
+                for ftp in sessions:
+                    self.count[key] -= 1
+                    self.home.pop(ftp, None)
+                    self.cwd.pop(ftp, None)
+                    try:
+                        ftp.quit()
+                    except Exception:
+                        ftp.close()
+            self.idle = {}
+
+
+class HTTPPool():
+    """
+    A pool of keep-alive http.client connections, keyed by (scheme, host, port).
+
+    Connections are kept open between requests, so that many files from
+    the same server, e.g. RINEX files from https://monitor.mikes.fi,
+    need only one TCP connection and TLS handshake.
+    At most max_connections connections are opened to each server,
+    so concurrent requests from worker threads share a few connections.
+    A request that fails on a reused connection, which the server may
+    have closed while it was idle, is retried once on a new connection.
+    Redirects are followed, HTTP errors raise urllib.error.HTTPError
+    like urllib.request.urlopen().
+    """
+
+    def __init__(self, max_connections=4, timeout=60, max_redirects=5):
+        self.max_connections = max_connections
+        self.timeout = timeout
+        self.max_redirects = max_redirects
+        self.cond = threading.Condition()
+        self.idle = {}  # (scheme, host, port) -> list of idle connections
+        self.count = {}  # (scheme, host, port) -> number of open connections
+
+    def acquire(self, key, timeout):
+        """
+        return (connection, reused). blocks if max_connections
+        connections to the server are already in use.
+        """
+        with self.cond:
+            while True:
+                if self.idle.get(key):
+                    conn = self.idle[key].pop()
+                    conn.timeout = timeout
+                    if conn.sock is not None:
+                        conn.sock.settimeout(timeout)
+                    return (conn, True)
+                if self.count.get(key, 0) < self.max_connections:
+                    self.count[key] = self.count.get(key, 0) + 1
+                    break
+                self.cond.wait()
+        (scheme, host, port) = key
+        print("HTTP connect ", host)
+        if scheme == "https":
+            return (http.client.HTTPSConnection(host, port, timeout=timeout), False)
+        return (http.client.HTTPConnection(host, port, timeout=timeout), False)
+
+    def release(self, key, conn, broken=False):
+        """
+        return a connection to the pool.
+        a broken connection is closed instead of being reused.
+        """
+        with self.cond:
+            if broken:
+                self.count[key] -= 1
+                conn.close()
+            else:
+                self.idle.setdefault(key, []).append(conn)
+            self.cond.notify()
+
+    def send(self, key, method, path, headers, timeout):
+        """
+        send a request and return (connection, response)
+        """
+        while True:
+            (conn, reused) = self.acquire(key, timeout)
+            try:
+                conn.request(method, path, headers=headers)
+                return (conn, conn.getresponse())
+            except (http.client.HTTPException, ConnectionError) as e:
+                self.release(key, conn, broken=True)
+                if not reused:
+                    raise
+                print("HTTP connection closed by server (%s), reconnecting" % e)
+            except Exception:
+                self.release(key, conn, broken=True)
+                raise
+
+    @contextlib.contextmanager
+    def request(self, url, headers=None, timeout=None, method="GET"):
+        """
+        GET (or HEAD) url, yielding the http.client.HTTPResponse.
+        The connection is returned to the pool when the response
+        has been read completely.
+        """
+        if timeout is None:
+            timeout = self.timeout
+        headers = dict(headers or {})
+        headers.setdefault("User-Agent", "ppp-tools")
+        for redirect in range(self.max_redirects + 1):
+            parts = urllib.parse.urlsplit(url)
+            if parts.scheme not in ("http", "https"):
+                raise ValueError("unsupported url %s" % url)
+            key = (parts.scheme, parts.hostname, parts.port)
+            path = (parts.path or "/") + ("?" + parts.query if parts.query else "")
+            (conn, response) = self.send(key, method, path, headers, timeout)
+            if response.status in (301, 302, 303, 307, 308) and response.headers.get("Location"):
+                response.read()
+                self.release(key, conn, broken=response.will_close)
+                url = urllib.parse.urljoin(url, response.headers["Location"])
+                continue
+            if response.status >= 400:
+                response.read()
+                self.release(key, conn, broken=response.will_close)
+                raise urllib.error.HTTPError(url, response.status, response.reason,
+                                             response.headers, None)
+            try:
+                yield response
+            except Exception:
+                self.release(key, conn, broken=True)
+                raise
+            # a partly read response leaves the connection unusable
+            self.release(key, conn, broken=response.will_close or not response.isclosed())
+            return
+        raise IOError("too many redirects: %s" % url)
+
+    def close(self):
+        """
+        close all idle connections
+        """
+        with self.cond:
+            for key, connections in self.idle.items():
+                for conn in connections:
+                    self.count[key] -= 1
+                    conn.close()
+            self.idle = {}
+
+
+# module-wide pools, used by ftp_download() and http_download()
+ftp_pool = FTPPool()
+atexit.register(ftp_pool.close)
+http_pool = HTTPPool()
+atexit.register(http_pool.close)
+
+
 def ftp_download( server, username, password, remotedir, remotefile, localdir, overwrite=False):
     """
     Generic function to download a file using ftp.
     Place it in the local_directory.
     If it already exists, don't download.
     Return the full local filename.
+    Connections are reused through ftp_pool.
     """
     check_dir( localdir )  # check that target dir exists, if not create it
     local_fullname = localdir + remotefile 
@@ -35,18 +542,64 @@ def ftp_download( server, username, password, remotedir, remotefile, localdir, o
         print('Remote: ftp://%s/%s%s' % (server,remotedir, remotefile) )
         print('Local : ', local_fullname)
         sys.stdout.flush()
-        ftp = ftplib.FTP(server)  # Establish the connection
-        ftp.login(username, password)
-        ftp.cwd(remotedir) # Change to the proper directory
-        fhandle = open(local_fullname, 'wb')
-        ftp.retrbinary('RETR ' + remotefile, fhandle.write)
-        fhandle.close()
-        ftp.close()
+        ftp_pool.retrieve(server, username, password, remotedir, remotefile, local_fullname)
     else:
         print(remotefile," already exists locally, not downloading.")
     print("ftp_download Done ", datetime.datetime.utcnow())
     sys.stdout.flush()
     return local_fullname
 
+def read_meta(local_fullname):
+    """
+    read the metadata sidecar <file>.meta, written by ftp_refresh()
+    """
+    try:
+        with open(local_fullname + ".meta") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+def write_meta(local_fullname, meta):
+    with open(local_fullname + ".meta.tmp", "w") as f:
+        json.dump(meta, f)
+    os.replace(local_fullname + ".meta.tmp", local_fullname + ".meta")
+
+def ftp_refresh( server, username, password, remotedir, remotefile, localdir):
+    """
+    Download a file only if it changed on the server.
+    The remote MDTM and SIZE are compared to the values stored in
+    a <file>.meta sidecar at the previous download.
+    Return True if the file was downloaded.
+    """
+    check_dir( localdir )
+    local_fullname = localdir + remotefile
+    (mdtm, size) = ftp_pool.stat(server, username, password, remotedir, remotefile)
+    remote = {"mdtm": mdtm, "size": size}
+    known = mdtm is not None or size is not None
+    if known and os.path.exists(local_fullname) and read_meta(local_fullname) == remote:
+        print(remotefile, " unchanged on server, not downloading.")
+        return False
+    print('Remote: ftp://%s/%s%s changed, downloading' % (server, remotedir, remotefile))
+    if os.path.exists(local_fullname + ".part"):
+        os.unlink(local_fullname + ".part")  # may be from an older version of the file
+    ftp_pool.retrieve(server, username, password, remotedir, remotefile, local_fullname)
+    write_meta(local_fullname, remote)
+    return True
+
+def ftp_refresh_many( server, username, password, files, localdir, workers=2):
+    """
+    Refresh several files from one ftp server, checking and
+    downloading in parallel over pooled connections.
+    files is a list of [remotedir, remotefile] pairs.
+    Return the list of full local filenames that were updated.
+    """
+    with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as pool:
+        futures = [pool.submit(ftp_refresh, server, username, password,
+                               remotedir, remotefile, localdir)
+                   for (remotedir, remotefile) in files]
+        updated = [f.result() for f in futures]
+    return [localdir + remotefile for ((remotedir, remotefile), u)
+            in zip(files, updated) if u]
+
 if __name__ == "__main__":
     pass
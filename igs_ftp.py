@@ -11,10 +11,22 @@ import ftplib
 import datetime
 import sys
 import os
-import wget
+import re
+import json
+import time
+import threading
 
 import ftp_tools
 import gpstime
+import mirrors
+import negative_cache
+import product_cache
+import transfer
+
+# cached remote directory listings are refreshed after this many seconds
+listing_ttl = 6*3600
+_listings = {}  # url -> (time of listing, {filename: size})
+_listings_lock = threading.Lock()
 
 # ftp://cddis.gsfc.nasa.gov/gnss/data/daily/
 # YYYY/DDD/YYn/brdcDDD0.YYn.Z   (merged GPS broadcast ephemeris file)
@@ -33,29 +45,30 @@ def cddis_brdc_file(dt, prefixdir=""):
     localdir = prefixdir + "/stations/brdc/"
     ftp_tools.check_dir(localdir)
 
-    ftp_tools.ftp_download(server, username="anonymous", password="",
-                           remotedir=remotedir, remotefile=f, localdir=localdir)
+    if not os.path.isfile(localdir+f):
+        url = transfer.ftp_url(server, "anonymous", "", remotedir + "/", f)
+        transfer.download([(url, localdir+f)], negative=negative_cache.for_prefix(prefixdir))
     return localdir+f
 
 def get_IGS_rapid(dt, prefixdir=""):
     (server, username, password, directory, files,
      localdir) = IGS_rapid_files(dt, prefixdir)
     (clk1, eph1, erp1) = download(
-        server, username, password, directory, files, localdir)
+        server, username, password, directory, files, localdir, dt)
     return (clk1, eph1, erp1)
 
 def get_IGS_final(dt, prefixdir=""):
     (server, username, password, directory, files,
      localdir) = IGS_final_files(dt, prefixdir)
     (clk1, eph1, erp1) = download(
-        server, username, password, directory, files, localdir)
+        server, username, password, directory, files, localdir, dt)
     return (clk1, eph1, erp1)
 
 def get_CODE_final(dt, prefixdir=""):
     (server, username, password, directory, files,
      localdir) = CODE_final_files(dt, prefixdir)
     (clk1, eph1, erp1) = download(
-        server, username, password, directory, files, localdir)
+        server, username, password, directory, files, localdir, dt)
     return (clk1, eph1, erp1)
 
 
@@ -63,10 +76,265 @@ def get_CODE_rapid(dt, prefixdir=""):
     (server, username, password, directory, files,
      localdir) = CODE_rapid_files(dt, prefixdir)
     (clk1, eph1, erp1) = download(
-        server, username, password, directory, files, localdir)
+        server, username, password, directory, files, localdir, dt)
     return (clk1, eph1, erp1)
 
 
+def product_files(dt, rapid=True, products="CODE", prefixdir=""):
+    """
+        return the (server, username, password, remotedir, files, localdir)
+        tuple for the requested product type.
+        products is "CODE" or "IGS", rapid selects rapid or final products.
+    """
+    if products == "CODE":
+        if rapid:
+            return CODE_rapid_files(dt, prefixdir)
+        return CODE_final_files(dt, prefixdir)
+    elif products == "IGS":
+        if rapid:
+            return IGS_rapid_files(dt, prefixdir)
+        return IGS_final_files(dt, prefixdir)
+    raise ValueError("unknown products %s" % products)
+
+
+def get_products(dtlist, rapid=True, products="CODE", prefixdir="", workers=4):
+    """
+        Prefetch CLK/EPH/ERP products for all days in dtlist.
+
+        The complete set of files is resolved first, and then downloaded
+        with a pool of at most 'workers' concurrent transfers.
+        A status line is printed for each file.
+
+        Returns (clk_files, eph_files, erp_files), lists of local filenames
+        in the same order as dtlist.
+        Raises IOError, listing the files, if any file could not be
+        downloaded, as download() does.
+    """
+    clk_files = []
+    eph_files = []
+    erp_files = []
+    transfers = []  # (url, local_file, dt), each file only once
+    for dt in dtlist:
+        (server, username, password, remotedir, files,
+         localdir) = product_files(dt, rapid, products, prefixdir)
+        ftp_tools.check_dir(localdir)
+        for f in files:
+            if localdir+f not in [t[1] for t in transfers]:
+                transfers.append((remote_url(server, remotedir, f), localdir+f, dt))
+        clk_files.append(localdir+files[0])
+        eph_files.append(localdir+files[1])
+        erp_files.append(localdir+files[2])
+
+    print("prefetch start ", datetime.datetime.now(),
+          " %d files, %d workers" % (len(transfers), workers))
+    sys.stdout.flush()
+    if not transfers:
+        return (clk_files, eph_files, erp_files)
+    cache = product_cache.for_localdir(localdir)  # all product directories share one cache
+    status = fetch_files(transfers, cache, workers, mirrors.ranking(prefixdir),
+                         negative_cache.for_prefix(prefixdir))
+    for (url, local_file, dt) in transfers:
+        print("  %-10s %s" % (status[local_file], local_file))
+    print("prefetch Done ", datetime.datetime.now())
+    sys.stdout.flush()
+    failed = ["%s (%s)" % (local_file, status[local_file]) for (url, local_file, dt) in transfers
+              if status[local_file] not in ("cached", "downloaded")]
+    if failed:
+        raise IOError("products not available: %s" % ", ".join(failed))
+    return (clk_files, eph_files, erp_files)
+
+
+def remote_url(server, remotedir, f="", username="", password=""):
+    """
+        url of a remote product file, or of the directory if f is empty.
+        servers given without http:// or https:// are ftp servers.
+    """
+    if server.startswith("http"):
+        return server + remotedir + f
+    return transfer.ftp_url(server, username, password, remotedir, f)
+
+
+def mirror_urls(url, local_file, dt, ranking):
+    """
+        urls of local_file on all mirrors of its product family,
+        fastest healthy mirror first, by the MirrorRanking ranking.
+        the family is the name of the local product directory, e.g. CODE_final
+        url, the url the file was resolved to, is returned if the
+        directory is not a product family.
+    """
+    family = os.path.basename(os.path.dirname(local_file))
+    if dt is None or family not in mirrors.registry:
+        return [url]
+    f = os.path.basename(local_file)
+    urls = [remote_url(server, remotedir, f) for (server, remotedir) in ranking.ranked(family, dt)]
+    if url not in urls:
+        urls.append(url)
+    return urls
+
+
+def remote_listing(server, remotedir, prefixdir="", ttl=None):
+    """
+        return {filename: size} for a remote product directory,
+        e.g. CODE/2024/ or pub/igs/products/2310/
+
+        Listings are cached in memory and as json files in
+        <prefixdir>/products/listings/, and fetched again when
+        they are older than ttl seconds (default listing_ttl).
+    """
+    if ttl is None:
+        ttl = listing_ttl
+    url = remote_url(server, remotedir)
+    listing_dir = prefixdir + "/products/listings/"
+    cache_file = listing_dir + re.sub(r"[^A-Za-z0-9._-]", "_", url) + ".json"
+    with _listings_lock:
+        entry = _listings.get(url)
+    if entry is None and os.path.isfile(cache_file):
+        with open(cache_file) as f:
+            cached = json.load(f)
+        entry = (cached["time"], cached["files"])
+    if entry is None or time.time() - entry[0] > ttl:
+        print("listing ", url)
+        entry = (time.time(), transfer.listing(url))
+        ftp_tools.check_dir(listing_dir)
+        with open(cache_file + ".tmp", "w") as f:
+            json.dump({"url": url, "time": entry[0], "files": entry[1]}, f)
+        os.replace(cache_file + ".tmp", cache_file)
+    with _listings_lock:
+        _listings[url] = entry
+    return entry[1]
+
+
+def product_available(server, remotedir, f, prefixdir=""):
+    """
+        True if file f is in the (cached) listing of the remote directory
+    """
+    return f in remote_listing(server, remotedir, prefixdir)
+
+
+def check_products(dtlist, rapid=True, products="CODE", prefixdir=""):
+    """
+        check that products for all days in dtlist exist,
+        either locally or in the remote directory listing.
+        Returns the list of urls of missing products.
+        If a listing can not be fetched, the products are assumed
+        to exist, and the download will tell.
+    """
+    missing = []
+    for dt in dtlist:
+        (server, username, password, remotedir, files,
+         localdir) = product_files(dt, rapid, products, prefixdir)
+        for f in files:
+            if os.path.isfile(localdir+f):
+                continue
+            try:
+                if not product_available(server, remotedir, f, prefixdir):
+                    missing.append(remote_url(server, remotedir, f))
+            except Exception as e:
+                print("could not list ", remote_url(server, remotedir), e)
+    return missing
+
+
+def require_products(dtlist, rapid=True, products="CODE", prefixdir=""):
+    """
+        raise IOError if any product for the days in dtlist is missing.
+        called before RINEX staging or engine runs, so a run fails early.
+    """
+    missing = check_products(dtlist, rapid, products, prefixdir)
+    if missing:
+        for url in missing:
+            print("missing product: ", url)
+        raise IOError("%d products not available: %s" % (len(missing), ", ".join(missing)))
+
+
+class ProductPolicy():
+    """
+        Ordered list of product choices to try, e.g.
+        CODE final, then IGS final, then CODE rapid, then IGS rapid.
+
+        Each choice is a (products, rapid) tuple, with products "CODE" or "IGS".
+        resolve() returns the first choice for which products for all
+        requested days are available, according to the cached listings.
+    """
+
+    def __init__(self, choices=None):
+        if choices is None:
+            choices = [("CODE", False), ("IGS", False), ("CODE", True), ("IGS", True)]
+        self.choices = choices
+
+    def resolve(self, dtlist, prefixdir=""):
+        """
+            return (products, rapid) of the first available choice.
+            all days use the same choice, so a multi-day run does not
+            mix products.
+        """
+        for (products, rapid) in self.choices:
+            missing = check_products(dtlist, rapid, products, prefixdir)
+            if not missing:
+                print("product policy: using %s" % describe(products, rapid))
+                return (products, rapid)
+            print("product policy: %s not available (%d files missing)" % (
+                describe(products, rapid), len(missing)))
+        raise IOError("no products available for %s" % [day_string(dt) for dt in dtlist])
+
+
+def describe(products, rapid):
+    """
+        e.g. "CODE final", used in logs and result-file preambles
+    """
+    if rapid:
+        return "%s rapid" % products
+    return "%s final" % products
+
+
+def fetch_files(transfers, cache, workers=4, ranking=None, negative=None):
+    """
+        Download a list of (url, local_file, dt) transfers concurrently,
+        with at most 'workers' transfers per server.
+        With a MirrorRanking ranking, files that are not cached are
+        fetched from all mirrors of their product family, fastest healthy
+        mirror first, and download times are recorded in the ranking.
+        Files that are valid in the ProductCache are not downloaded,
+        new files are registered in the cache.
+        Files that failed recently according to the NegativeCache
+        negative, if given, are skipped.
+        Returns a dict mapping local_file to a status string:
+        "cached", "downloaded", "failed" or "missing".
+    """
+    status = {}
+    pending = []
+    days = {}
+    for (url, local_file, dt) in transfers:
+        days[local_file] = day_string(dt)
+        if cache.lookup(local_file, day=days[local_file]):
+            status[local_file] = "cached"
+            continue
+        ftp_tools.check_dir(os.path.dirname(local_file))
+        if ranking is not None:  # fail over to other mirrors
+            pending.append((mirror_urls(url, local_file, dt, ranking), local_file))
+        else:
+            pending.append((url, local_file))
+
+    on_done = None
+    if ranking is not None:
+        on_done = ranking.record
+    status.update(transfer.download(pending, limit=workers, on_done=on_done, negative=negative))
+    if ranking is not None:
+        ranking.save()  # once per batch, see mirrors.py
+    for (url, local_file) in pending:
+        if status[local_file] == "downloaded":
+            cache.register(local_file, day=days[local_file])
+    return status
+
+
+def day_string(dt):
+    """
+        day of a product, as used in the ProductCache index
+    """
+    if dt is None:
+        return None
+    return "%d-%02d-%02d" % (dt.year, dt.month, dt.day)
+
+
 def CODE_rapid_files(dt, prefixdir=""):
     """
         retrieve rapid CODE products for the datetime dt
@@ -81,8 +349,8 @@ def CODE_rapid_files(dt, prefixdir=""):
         updated working link (as of 2021 July)
         ftp://ftp.aiub.unibe.ch/CODE/
     """
-    server = "ftp.aiub.unibe.ch"
-    remotedir = "CODE/"
+    # first mirror of mirrors.registry. fetching picks the fastest healthy mirror
+    (server, remotedir) = mirrors.canonical("CODE_rapid", dt)
     week = gpstime.gpsWeek(dt.year, dt.month, dt.day)
     dow = gpstime.dayOfWeek(dt.year, dt.month, dt.day)
     clk = "COD%s%s.CLK_R" % (week,  dow)
@@ -93,7 +361,6 @@ def CODE_rapid_files(dt, prefixdir=""):
     print("SP3 = ", sp3)
     print("ERP = ", erp)
 
-    ftp_tools.check_dir(prefixdir + "/products/")
     localdir = prefixdir + "/products/CODE_rapid/"
     print("local dir = ", localdir)
 
@@ -120,7 +387,6 @@ def CODE_final_files_old(dt, prefixdir=""):
     print("SP3 = ", sp3)
     print("ERP = ", erp)
 
-    ftp_tools.check_dir(prefixdir + "/products/")
     localdir = prefixdir + "/products/CODE_final/"
     print("local dir = ", localdir)
     return (server, "", "", remotedir, [clk, sp3, erp], localdir)
@@ -138,8 +404,8 @@ def CODE_final_files(dt, prefixdir=""):
         COD0OPSFIN_20241510000_01D_01D_ERP.ERP.gz
         COD0OPSFIN_20241510000_01D_05M_ORB.SP3.gz 
     """
-    server = "http://ftp.aiub.unibe.ch/"
-    remotedir = "CODE/%s/" % (dt.year)
+    # first mirror of mirrors.registry. fetching picks the fastest healthy mirror
+    (server, remotedir) = mirrors.canonical("CODE_final", dt)
     week = gpstime.gpsWeek(dt.year, dt.month, dt.day)
     dow = gpstime.dayOfWeek(dt.year, dt.month, dt.day)
     doy = dt.timetuple().tm_yday
@@ -151,7 +417,6 @@ def CODE_final_files(dt, prefixdir=""):
     print("SP3 = ", sp3)
     print("ERP = ", erp)
 
-    ftp_tools.check_dir(prefixdir + "/products/")
     localdir = prefixdir + "/products/CODE_final/"
     print("local dir = ", localdir)
     return (server, "", "", remotedir, [clk, sp3, erp], localdir)
@@ -170,21 +435,12 @@ def IGS_rapid_files(dt, prefixdir=""):
     week = gpstime.gpsWeek(dt.year, dt.month, dt.day)
     dow = gpstime.dayOfWeek(dt.year, dt.month, dt.day)
     
-    #server = "gssc.esa.int"
-    #remotedir = "gnss/products/%d/" % (week)
-
-    server = "igs.ensg.ign.fr"
-    remotedir = "pub/igs/products/%d/" % (week)
-
+    # igs.ensg.ign.fr, the first mirror of mirrors.registry.
+    # fetching picks the fastest healthy mirror, igs.ensg.ign.fr or gssc.esa.int
+    (server, remotedir) = mirrors.canonical("IGS_rapid", dt)
     
     #clk = "igs%s%s.clk_30s.Z" % (week, dow)  # clock, 30s interval
     #clk = "igs%s%s.clk.Z" % (week, dow)  # clock, (5 minute interval?)
-    
-    #server = "gssc.esa.int"
-    #week = gpstime.gpsWeek(dt.year, dt.month, dt.day)
-    #dow = gpstime.dayOfWeek(dt.year, dt.month, dt.day)
-    
-    #remotedir = "gnss/products/%d/" % (week)
 
     clk = "igr%s%s.clk.Z" % (week, dow)  # clock
     sp3 = "igr%s%s.sp3.Z" % (week, dow)  # orbit
@@ -194,7 +450,6 @@ def IGS_rapid_files(dt, prefixdir=""):
     print("SP3 = ", sp3)
     print("ERP = ", erp)
 
-    ftp_tools.check_dir(prefixdir + "/products/")
     localdir = prefixdir + "/products/IGS_rapid/"
     print("local dir = ", localdir)
     return (server, "", "", remotedir, [clk, sp3, erp], localdir)
@@ -215,11 +470,9 @@ def IGS_final_files(dt, prefixdir=""):
     week = gpstime.gpsWeek(dt.year, dt.month, dt.day)
     dow = gpstime.dayOfWeek(dt.year, dt.month, dt.day)
     
-    #server = "gssc.esa.int"
-    #remotedir = "gnss/products/%d/" % (week)
-
-    server = "igs.ensg.ign.fr"
-    remotedir = "pub/igs/products/%d/" % (week)
+    # igs.ensg.ign.fr, the first mirror of mirrors.registry.
+    # fetching picks the fastest healthy mirror, igs.ensg.ign.fr or gssc.esa.int
+    (server, remotedir) = mirrors.canonical("IGS_final", dt)
 
     
     clk = "igs%s%s.clk_30s.Z" % (week, dow)  # clock, 30s interval
@@ -231,26 +484,41 @@ def IGS_final_files(dt, prefixdir=""):
     print("SP3 = ", sp3)
     print("ERP = ", erp)
 
-    ftp_tools.check_dir(prefixdir + "/products/")
     localdir = prefixdir + "/products/IGS_final/"
     print("local dir = ", localdir)
     return (server, "", "", remotedir, [clk, sp3, erp], localdir)
 
 
-def download(server, username, password, remotedir, files, localdir):
+def download(server, username, password, remotedir, files, localdir, dt=None):
     """
         Download a list of files from given ftp server
+        Files already in the ProductCache are not downloaded.
+        dt is the day of the products, recorded in the cache index.
         Return list of local downloaded files
     """
     print("download start ", datetime.datetime.now())
     ftp_tools.check_dir(localdir)
+    cache = product_cache.for_localdir(localdir)
+    ranking = mirrors.MirrorRanking(cache.products_dir)
 
+    pending = []
     for f in files:
         local_file = localdir+f
         #ftp_tools.ftp_download(
         #    server, username, password, remotedir, f, localdir)
-        if not os.path.isfile(local_file):
-            wget.download(server+remotedir+f, out = local_file)
+        if not cache.lookup(local_file, day=day_string(dt)):
+            url = remote_url(server, remotedir, f, username, password)
+            # fail over to other mirrors
+            pending.append((mirror_urls(url, local_file, dt, ranking), local_file))
+    negative = negative_cache.for_prefix(os.path.dirname(cache.products_dir.rstrip("/")))
+    status = transfer.download(pending, on_done=ranking.record, negative=negative)
+    ranking.save()
+    for (urls, local_file) in pending:
+        if status[local_file] == "missing":
+            raise IOError("product known to be missing, not retried: %s" % urls[0])
+        if status[local_file] != "downloaded":
+            raise IOError("download failed: %s" % urls[0])
+        cache.register(local_file, day=day_string(dt))
     print("download Done ", datetime.datetime.now())
     sys.stdout.flush()
     output = []
@@ -0,0 +1,187 @@
+"""
+    This file is part of ppp-tools, https://github.com/aewallin/ppp-tools
+    GPLv2 license.
+
+    Cache of decompressed (staged) input files.
+
+    Every run decompresses its RINEX and product files into the run
+    directory again, and multi-day runs with overlapping windows stage
+    the same days over and over. The staged files are cached in
+    <prefixdir>/staged/, keyed by the sha256 of the compressed source
+    file and the staging recipe, so a re-published file with new
+    contents gets a new entry.
+
+    Run directories are populated from the cache with a hardlink, or a
+    reflink (copy-on-write clone) where hardlinks are not possible,
+    and only as a last resort with a copy.
+    Cached files are made read-only, so a program that tries to write
+    to its (hardlinked) input fails instead of changing the cache.
+
+    command line example, prints the size of the cache:
+    python input_cache.py
+"""
+import os
+import sys
+import stat
+import fcntl
+import shutil
+import hashlib
+import tempfile
+import threading
+
+import ftp_tools
+
+# size quota for the staged-file cache, in bytes. None means no limit.
+cache_max_bytes = None
+
+FICLONE = 0x40049409  # Linux ioctl, clone the extents of a file (btrfs, xfs)
+
+_lock = threading.Lock()
+_hashes = {}  # (path, size, mtime_ns) -> sha256, hashes computed by this process
+
+
+def source_hash(path):
+    """
+    sha256 of the contents of path.
+    remembered for as long as the size and mtime of path do not change.
+    """
+    st = os.stat(path)
+    memo_key = (os.path.abspath(path), st.st_size, st.st_mtime_ns)
+    with _lock:
+        h = _hashes.get(memo_key)
+    if h is None:
+        sha = hashlib.sha256()
+        with open(path, "rb") as f:
+            for block in iter(lambda: f.read(1 << 20), b""):
+                sha.update(block)
+        h = sha.hexdigest()
+        with _lock:
+            _hashes[memo_key] = h
+    return h
+
+
+def reflink(src, dst):
+    """
+    make dst a copy-on-write clone of src. Raises OSError where the
+    filesystem does not support it.
+    """
+    with open(src, "rb") as fin:
+        with open(dst, "wb") as fout:
+            try:
+                fcntl.ioctl(fout.fileno(), FICLONE, fin.fileno())
+            except OSError:
+                fout.close()
+                os.unlink(dst)
+                raise
+
+
+def link(cached, dst):
+    """
+    place the cached file cached at dst: hardlink, reflink or copy.
+    an existing dst is replaced.
+    """
+    if os.path.lexists(dst):
+        os.unlink(dst)
+    try:
+        os.link(cached, dst)
+        return "hardlink"
+    except OSError:
+        pass
+    try:
+        reflink(cached, dst)
+        return "reflink"
+    except OSError:
+        pass
+    shutil.copyfile(cached, dst)
+    return "copy"
+
+
+class InputCache():
+    """
+    staged files, stored as <cache_dir>/<key[:2]>/<key>-<filename>
+    """
+
+    def __init__(self, cache_dir):
+        self.cache_dir = cache_dir.rstrip("/") + "/"
+        ftp_tools.check_dir(self.cache_dir)
+
+    def key(self, src, recipe):
+        return hashlib.sha256((source_hash(src) + ":" + recipe).encode()).hexdigest()
+
+    def entry(self, key, name):
+        return self.cache_dir + key[:2] + "/" + key + "-" + name
+
+    def lookup(self, src, name, recipe):
+        """
+        the cached file for source file src and recipe, or None
+        """
+        entry = self.entry(self.key(src, recipe), name)
+        if os.path.isfile(entry):
+            os.utime(entry)  # last use, for prune()
+            return entry
+        return None
+
+    def fetch(self, src, name, recipe, produce):
+        """
+        return the cached file for source file src and recipe, named name.
+        On a miss, produce(tmpdir) is called to write the file into the
+        empty directory tmpdir; it returns the filename it wrote.
+        """
+        entry = self.lookup(src, name, recipe)
+        if entry is not None:
+            return entry
+        entry = self.entry(self.key(src, recipe), name)
+        os.makedirs(os.path.dirname(entry), exist_ok=True)  # threads may race here
+        tmpdir = tempfile.mkdtemp(prefix="tmp.", dir=self.cache_dir)
+        try:
+            made = produce(tmpdir)
+            os.chmod(made, stat.S_IRUSR | stat.S_IRGRP | stat.S_IROTH)
+            os.replace(made, entry)
+        finally:
+            shutil.rmtree(tmpdir, ignore_errors=True)
+        if cache_max_bytes is not None:
+            self.prune(cache_max_bytes)
+        return entry
+
+    def files(self):
+        """
+        list of (mtime, size, path) of all cached files
+        """
+        files = []
+        for sub in os.scandir(self.cache_dir):
+            if not sub.is_dir() or sub.name.startswith("tmp."):
+                continue
+            for entry in os.scandir(sub.path):
+                st = entry.stat()
+                files.append((st.st_mtime, st.st_size, entry.path))
+        return files
+
+    def prune(self, max_bytes):
+        """
+        delete least recently used files until the total size is at most max_bytes.
+        hardlinks to a deleted file, in run directories, stay valid.
+        """
+        files = sorted(self.files())
+        total = sum(f[1] for f in files)
+        for (mtime, size, path) in files:
+            if total <= max_bytes:
+                break
+            print("input cache, removing ", path)
+            os.unlink(path)
+            total -= size
+
+    def total_size(self):
+        return sum(f[1] for f in self.files())
+
+
+def for_prefix(prefixdir=""):
+    return InputCache(prefixdir + "/staged/")
+
+
+if __name__ == "__main__":
+    cache = for_prefix(os.getcwd())
+    files = cache.files()
+    print("input cache: %d files, %d bytes" % (len(files), sum(f[1] for f in files)))
+    if len(sys.argv) > 1:  # python input_cache.py <max_bytes>
+        cache.prune(int(float(sys.argv[1])))
+        print("after pruning: %d bytes" % cache.total_size())
@@ -0,0 +1,231 @@
+"""
+    This file is part of ppp-tools, https://github.com/aewallin/ppp-tools
+    GPLv2 license.
+
+    Registry of mirror servers for each product family, and a ranking
+    of mirrors by measured latency and throughput.
+
+    Families have the same names as the local product directories,
+    e.g. products/IGS_rapid/ is family "IGS_rapid".
+    Each mirror is a (server, remotedir) pair, where remotedir is a
+    format string using year, doy and week of the product day.
+    Servers given without http:// or https:// are ftp servers.
+
+    The ranking is stored in <prefixdir>/products/mirrors.json so it
+    persists between runs. Mirrors without measurements are probed by
+    timing a listing of the product directory. Every download attempt
+    updates the statistics of its mirror in memory, and save() writes
+    them once per batch of downloads. save() holds an flock() on
+    <prefixdir>/products/mirrors.lock and merges with the statistics
+    other processes saved meanwhile, so several processes can share
+    the ranking.
+"""
+import os
+import json
+import time
+import fcntl
+import threading
+import contextlib
+import urllib.parse
+
+import ftp_tools
+import gpstime
+import transfer
+
+registry = {
+    "CODE_rapid": [("ftp.aiub.unibe.ch", "CODE/"),
+                   ("http://ftp.aiub.unibe.ch/", "CODE/")],
+    "CODE_final": [("http://ftp.aiub.unibe.ch/", "CODE/%(year)d/"),
+                   ("ftp.aiub.unibe.ch", "CODE/%(year)d/")],
+    "IGS_rapid": [("igs.ensg.ign.fr", "pub/igs/products/%(week)d/"),
+                  ("gssc.esa.int", "gnss/products/%(week)d/")],
+    "IGS_final": [("igs.ensg.ign.fr", "pub/igs/products/%(week)d/"),
+                  ("gssc.esa.int", "gnss/products/%(week)d/")],
+}
+
+probe_interval = 7*86400  # seconds before a mirror is probed again
+typical_size = 5.0e6  # bytes, a typical product file, used for ranking
+default_throughput = 1.0e6  # bytes/s, assumed for mirrors without downloads
+default_latency = 1.0  # seconds, assumed for mirrors without a successful probe
+failure_penalty = 30.0  # seconds added to the score for each recent failure
+max_failures = 3  # consecutive failures before a mirror is considered unhealthy
+failure_holdoff = 3600  # seconds an unhealthy mirror is ranked last
+alpha = 0.3  # weight of new measurements in the moving averages
+
+_lock = threading.Lock()
+
+
+def mirror_key(server):
+    """
+    "scheme://host" for a registry server or a url,
+    e.g. "igs.ensg.ign.fr" -> "ftp://igs.ensg.ign.fr"
+    """
+    if "://" not in server:
+        server = "ftp://" + server
+    parts = urllib.parse.urlsplit(server)
+    netloc = parts.hostname
+    if parts.port:
+        netloc += ":%d" % parts.port
+    return "%s://%s" % (parts.scheme, netloc)
+
+
+def remotedir_for(pattern, dt):
+    week = gpstime.gpsWeek(dt.year, dt.month, dt.day)
+    return pattern % {"year": dt.year, "doy": dt.timetuple().tm_yday, "week": week}
+
+
+def canonical(family, dt):
+    """
+    the (server, remotedir) of the first mirror of family for the
+    product day dt. Nothing is probed, the ranking is used only when
+    files are fetched, see igs_ftp.mirror_urls()
+    """
+    (server, pattern) = registry[family][0]
+    return (server, remotedir_for(pattern, dt))
+
+
+class MirrorRanking():
+    """
+    Latency/throughput statistics for mirrors, stored in
+    <products_dir>/mirrors.json
+    """
+
+    def __init__(self, products_dir):
+        self.products_dir = products_dir.rstrip("/") + "/"
+        self.ranking_file = self.products_dir + "mirrors.json"
+        self.lock_file = self.products_dir + "mirrors.lock"
+        self.stats = self.load()
+        self.changed = set()  # mirrors recorded since the last save()
+
+    def load(self):
+        try:
+            with open(self.ranking_file) as f:
+                return json.load(f)
+        except (IOError, ValueError):
+            return {}
+
+    @contextlib.contextmanager
+    def lock(self):
+        """
+        exclusive lock on mirrors.json, across processes
+        """
+        with open(self.lock_file, "a") as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+    def save(self):
+        """
+        write the statistics recorded since the last save() to mirrors.json.
+        The file is read again under the lock, and a mirror keeps the
+        statistics of whichever process updated it last.
+        """
+        with _lock:
+            if not self.changed:
+                return
+            ftp_tools.check_dir(self.products_dir)
+            with self.lock():
+                stats = self.load()
+                for key in self.changed:
+                    if self.stats[key]["updated"] >= stats.get(key, {}).get("updated", 0.0):
+                        stats[key] = self.stats[key]
+                with open(self.ranking_file + ".tmp", "w") as f:
+                    json.dump(stats, f, indent=1)
+                os.replace(self.ranking_file + ".tmp", self.ranking_file)
+            self.stats = stats
+            self.changed = set()
+
+    def record(self, url, ok, seconds, nbytes=0, probe=False):
+        """
+        update statistics of the mirror serving url, in memory.
+        a probe measures latency, a download measures throughput.
+        used as the on_done callback of transfer.download()
+        """
+        key = mirror_key(url)
+        with _lock:
+            s = self.stats.setdefault(key, {"latency": None, "throughput": None,
+                                            "failures": 0, "last_failure": 0.0,
+                                            "last_probe": 0.0})
+            s["updated"] = time.time()
+            self.changed.add(key)
+            if ok:
+                s["failures"] = 0
+                if probe:
+                    s["last_probe"] = time.time()
+                    s["latency"] = average(s["latency"], seconds)
+                elif nbytes > 0 and seconds > 0:
+                    s["throughput"] = average(s["throughput"], nbytes/seconds)
+            else:
+                s["failures"] += 1
+                s["last_failure"] = time.time()
+                if probe:
+                    s["last_probe"] = time.time()
+
+    def healthy(self, key):
+        s = self.stats.get(key)
+        if s is None or s["failures"] < max_failures:
+            return True
+        return time.time() - s["last_failure"] > failure_holdoff
+
+    def score(self, key):
+        """
+        expected time in seconds to fetch a typical product file,
+        plus a penalty for consecutive failures
+        """
+        s = self.stats.get(key, {})
+        latency = s.get("latency") or default_latency
+        throughput = s.get("throughput") or default_throughput
+        return latency + typical_size/throughput + failure_penalty*s.get("failures", 0)
+
+    def probe(self, server, remotedir):
+        """
+        time a listing of remotedir on server
+        """
+        if server.startswith("http"):
+            url = server + remotedir
+        else:
+            url = transfer.ftp_url(server, "", "", remotedir, "")
+        print("probing mirror ", url)
+        t0 = time.time()
+        try:
+            transfer.listing(url)
+        except Exception as e:
+            print("mirror probe failed: ", url, e)
+            self.record(url, False, time.time() - t0, probe=True)
+            return
+        self.record(url, True, time.time() - t0, probe=True)
+
+    def ranked(self, family, dt):
+        """
+        return the mirrors of family as a list of (server, remotedir)
+        for the product day dt, fastest healthy mirror first.
+        mirrors not probed within probe_interval are probed first.
+        """
+        mirrors = [(server, remotedir_for(pattern, dt)) for (server, pattern) in registry[family]]
+        for (server, remotedir) in mirrors:
+            s = self.stats.get(mirror_key(server))
+            if s is None or time.time() - s["last_probe"] > probe_interval:
+                self.probe(server, remotedir)
+        return sorted(mirrors, key=lambda m: (not self.healthy(mirror_key(m[0])),
+                                              self.score(mirror_key(m[0]))))
+
+
+def average(old, new):
+    if old is None:
+        return new
+    return (1.0 - alpha)*old + alpha*new
+
+
+def ranking(prefixdir=""):
+    return MirrorRanking(prefixdir + "/products/")
+
+
+if __name__ == "__main__":
+    import datetime
+    r = ranking(os.getcwd())
+    dt = datetime.datetime.utcnow() - datetime.timedelta(days=20)
+    for family in registry:
+        print(family, r.ranked(family, dt))
+    r.save()
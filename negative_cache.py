@@ -0,0 +1,149 @@
+"""
+    This file is part of ppp-tools, https://github.com/aewallin/ppp-tools
+    GPLv2 license.
+
+    Negative cache: remembers inputs that could not be downloaded.
+
+    When a station has no RINEX file for a day, or final products are
+    not published yet, a rerun of a batch would try the same failing
+    download again and wait on its timeouts and retries.
+    Failed downloads are recorded in <prefixdir>/missing.json, by local
+    filename, and are not tried again until the entry expires.
+    The expiry depends on the kind of input: rapid products appear
+    within hours, a missing RINEX file is retried after a day.
+    save() holds an flock() on <prefixdir>/missing.json.lock while it
+    merges with the entries other processes saved meanwhile.
+"""
+import os
+import json
+import time
+import fcntl
+import threading
+import contextlib
+
+# seconds before a failed download is tried again, by kind of input
+expiry = {
+    "rapid": 4*3600,  # products/*_rapid/
+    "final": 12*3600,  # products/*_final/
+    "rinex": 24*3600,  # stations/
+    "other": 3600,
+}
+
+_lock = threading.Lock()
+
+
+def kind(local_file):
+    """
+    kind of input, from the directory of local_file:
+    "rapid", "final", "rinex" or "other"
+    """
+    directory = os.path.dirname(local_file)
+    if directory.endswith("_rapid"):
+        return "rapid"
+    if directory.endswith("_final"):
+        return "final"
+    if "/stations/" in local_file:
+        return "rinex"
+    return "other"
+
+
+class NegativeCache():
+    """
+    failed downloads, stored in a json file as
+    {local_file: {"kind": .., "time": .., "url": .., "failures": ..}}
+    """
+
+    def __init__(self, cache_file):
+        self.cache_file = cache_file
+        self.lock_file = cache_file + ".lock"
+        self.entries = self.load()
+        self.changed = set()  # recorded entries, not yet saved
+        self.removed = set()  # cleared entries, not yet saved
+
+    def load(self):
+        if not os.path.isfile(self.cache_file):
+            return {}
+        try:
+            with open(self.cache_file) as f:
+                return json.load(f)
+        except ValueError:
+            print("ignoring corrupt negative cache ", self.cache_file)
+            return {}
+
+    @contextlib.contextmanager
+    def lock(self):
+        """
+        exclusive lock on missing.json, across processes
+        """
+        with open(self.lock_file, "a") as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+    def save(self):
+        """
+        write the entries recorded or removed here, merged with the
+        entries written meanwhile by other processes.
+        The file is read again under the lock.
+        """
+        with self.lock():
+            entries = self.load()
+            for local_file in self.changed:
+                entries[local_file] = self.entries[local_file]
+            for local_file in self.removed:
+                entries.pop(local_file, None)
+            self.entries = entries
+            self.changed = set()
+            self.removed = set()
+            with open(self.cache_file + ".%d.tmp" % os.getpid(), "w") as f:
+                json.dump(entries, f, indent=1)
+            os.replace(self.cache_file + ".%d.tmp" % os.getpid(), self.cache_file)
+
+    def known_missing(self, local_file):
+        """
+        True if a download of local_file failed recently,
+        i.e. within expiry[kind(local_file)] seconds
+        """
+        with _lock:
+            entry = self.entries.get(local_file)
+        if entry is None:
+            return False
+        return time.time() - entry["time"] < expiry.get(entry["kind"], expiry["other"])
+
+    def record(self, local_file, url=""):
+        """
+        record a failed download of local_file
+        """
+        with _lock:
+            entry = self.entries.get(local_file, {"failures": 0})
+            self.entries[local_file] = {"kind": kind(local_file), "time": time.time(),
+                                        "url": url, "failures": entry["failures"] + 1}
+            self.changed.add(local_file)
+            self.removed.discard(local_file)
+            self.save()
+
+    def clear(self, local_file):
+        """
+        forget local_file, after a successful download
+        """
+        with _lock:
+            if local_file in self.entries:
+                del self.entries[local_file]
+                self.changed.discard(local_file)
+                self.removed.add(local_file)
+                self.save()
+
+
+def for_prefix(prefixdir=""):
+    return NegativeCache(prefixdir + "/missing.json")
+
+
+if __name__ == "__main__":
+    cache = for_prefix(os.getcwd())
+    for (local_file, entry) in sorted(cache.entries.items()):
+        state = "missing" if cache.known_missing(local_file) else "expired"
+        print("%-8s %-6s %s %s" % (state, entry["kind"],
+                                   time.strftime("%Y-%m-%d %H:%M", time.localtime(entry["time"])),
+                                   local_file))
@@ -0,0 +1,338 @@
+"""
+    This file is part of ppp-tools, https://github.com/aewallin/ppp-tools
+    GPLv2 license.
+
+    Batch scheduler for PPP runs over a grid of stations x days x engines.
+
+    A backfill with nested for-loops over ppp_gpsppp.run() uses one core
+    for days, and within each run the network is idle while the engine
+    runs, and the CPU is idle while files download.
+    run_batch() runs the grid as a pipeline of three stages:
+    - prepare: download the inputs of a job and stage them into the
+      input cache (decompress, Hatanaka decode, prune, RINEX 3 to 2),
+      see prepare_job(). Runs on download_workers processes.
+    - engine: run the PPP program of the job, in its own run directory,
+      see ppp_common.run_workdir(). Staging there is only a hardlink from
+      the input cache. Runs on workers processes.
+    - collect: the status row of each finished job is printed and
+      added to the status table, in the main process.
+    When all jobs are done, the product cache is maintained, see product_cache.py
+    Runs whose inputs have not changed since their last run are skipped,
+    with status "up-to-date", see run_manifest.py. force=True runs them again.
+    The stages are connected by bounded queues: at most queue_size
+    prepared jobs wait for an engine, so preparing stays a few jobs
+    ahead of the engines, without filling the disk with the inputs
+    of the whole batch. Of the waiting jobs, the first one prepared
+    is started next, so one slow download does not hold up the engines.
+    With prefetch=True all inputs of the batch are instead downloaded
+    first, in one transfer phase, see ppp_plan.py
+
+    command line example:
+    python ppp_batch.py --stations MI04 MI05 --start 2024-06-01 --end 2024-06-10 --engines gpspace glab --workers 4
+"""
+import os
+import sys
+import time
+import argparse
+import datetime
+import queue
+import threading
+import functools
+import traceback
+import concurrent.futures
+
+import ftp_tools
+import igs_ftp
+import decompress
+import input_cache
+import product_cache
+import rinex_prune
+import run_manifest
+import ppp_plan
+import ppp_gpsppp
+import ppp_glab
+import ppp_rtklib
+
+poll_interval = 0.5  # seconds, engine_stage() waiting for prepared jobs
+
+
+def fetch_inputs(station, dt, engine, rapid, products, policy, prefixdir, num_days):
+    """
+    download the RINEX and product files of one job, if they are not cached.
+    Returns (rinex_files, product_files)
+    """
+    if engine == "gpspace" and num_days > 1:
+        days = [dt - datetime.timedelta(days=n) for n in reversed(range(num_days))]
+        product_days = days + [dt + datetime.timedelta(days=1)]
+        if policy is not None:
+            (products, rapid) = policy.resolve(product_days, prefixdir)
+    else:
+        days = [dt]
+        (product_days, products, rapid) = ppp_plan.run_products(engine, dt, rapid, products,
+                                                                policy, prefixdir)
+    rinex_files = [station.get_rinex(day, prefixdir) for day in days]
+    (clk_files, eph_files, erp_files) = igs_ftp.get_products(product_days, rapid=rapid, products=products,
+                                                             prefixdir=prefixdir)
+    return (rinex_files, clk_files + eph_files + erp_files)
+
+
+def prepare_job(job):
+    """
+    prepare stage of one job, in a prepare process: download the inputs
+    and stage them into the input cache, as the engine run will stage them.
+    """
+    (station, dt, engine, rapid, products, policy, prefixdir, num_days) = job
+    (rinex_files, product_files) = fetch_inputs(station, dt, engine, rapid, products, policy,
+                                                prefixdir, num_days)
+    cache = input_cache.for_prefix(prefixdir)
+    rinex2 = station.rinex3 and engine == "gpspace"  # GPSPACE reads RINEX 2 only
+    for f in rinex_files:
+        decompress.prestage(f, cache, rinex2=rinex2, prune=rinex_prune.profile(engine))
+    for f in product_files:
+        decompress.prestage(f, cache)
+    sys.stdout.flush()
+
+
+def error_string(e):
+    return "%s: %s" % (type(e).__name__, e)
+
+
+def status_row(job, status="ok", result="", error="", seconds=0.0):
+    (station, dt, engine) = job[:3]
+    return {"station": station.name, "day": dt, "engine": engine, "status": status,
+            "result": result, "error": error, "seconds": seconds}
+
+
+def init_engine(force):
+    run_manifest.skip_up_to_date = not force
+
+
+def run_job(job):
+    """
+    engine stage of one (station, day, engine) job, in an engine process.
+    Returns the status table row of the job.
+    """
+    (station, dt, engine, rapid, products, policy, prefixdir, num_days) = job
+    row = status_row(job)
+    t0 = time.time()
+    n_skipped = len(run_manifest.skipped)
+    try:
+        if engine == "gpspace" and num_days > 1:
+            row["result"] = ppp_gpsppp.run_multiday(station, dt, num_days, rapid=rapid, prefixdir=prefixdir,
+                                                    products=products, policy=policy)
+        elif engine == "gpspace":
+            row["result"] = ppp_gpsppp.run(station, dt, rapid=rapid, prefixdir=prefixdir,
+                                           products=products, policy=policy)
+        elif engine == "glab":
+            row["result"] = ppp_glab.run(station, dt, rapid=rapid, prefixdir=prefixdir)
+        elif engine == "rtklib":
+            row["result"] = ppp_rtklib.run(station, dt, rapid=rapid, prefixdir=prefixdir)
+        else:
+            raise ValueError("unknown engine %s" % engine)
+        if row["result"] in run_manifest.skipped[n_skipped:]:  # the runner returned an earlier result
+            row["status"] = "up-to-date"
+    except Exception as e:
+        traceback.print_exc()
+        row["status"] = "failed"
+        row["error"] = error_string(e)
+    row["seconds"] = time.time() - t0
+    sys.stdout.flush()
+    return row
+
+
+def prepare_stage(jobs, preparer, ready):
+    """
+    submit the jobs to the prepare pool, in order. ready.put() blocks while
+    the ready queue is full, and the engine stage takes at most queue_size
+    jobs from it, so preparing stays about queue_size jobs ahead.
+    """
+    for (n, job) in enumerate(jobs):
+        ready.put((n, job, preparer.submit(prepare_job, job), time.time()))
+    ready.put(None)
+
+
+def engine_stage(engine_pool, engine_slots, ready, done, queue_size):
+    """
+    start the engine run of each prepared job, as soon as an engine is free.
+    Up to queue_size jobs are taken from the ready queue, and the first of
+    them that has been prepared is started, so a slow download does not
+    hold up jobs that were prepared after it.
+    status rows of finished jobs are put in the done queue.
+    If the engine pool breaks, e.g. when an engine process is killed,
+    the remaining jobs fail.
+    """
+    def finished(n, future):
+        try:
+            row = future.result()
+        except Exception as e:  # e.g. an engine process died
+            row = status_row(jobs[n], status="failed", error=error_string(e))
+        engine_slots.release()
+        done.put((n, row))
+
+    jobs = {}
+    waiting = {}  # prepare future -> (n, job, submit time), of jobs not started yet
+    more = True  # more jobs may come from the ready queue
+    while True:
+        engine_slots.acquire()  # wait for a free engine before taking the next job
+        completed = set()
+        while not completed:
+            while more and len(waiting) < queue_size:
+                try:
+                    item = ready.get(block=not waiting)
+                except queue.Empty:
+                    break
+                if item is None:
+                    more = False
+                else:
+                    (n, job, prepared, t0) = item
+                    jobs[n] = job
+                    waiting[prepared] = (n, job, t0)
+            if not waiting:
+                break
+            # poll, so jobs that arrive in the ready queue meanwhile are also considered
+            (completed, pending) = concurrent.futures.wait(waiting, timeout=poll_interval,
+                                                           return_when=concurrent.futures.FIRST_COMPLETED)
+        if not waiting:
+            break
+        prepared = min(completed, key=lambda f: waiting[f][0])  # in job order, among the prepared jobs
+        (n, job, t0) = waiting.pop(prepared)
+        error = prepared.exception()
+        if error is not None:
+            print("batch: preparing %s %s %s failed: %s" % (
+                job[0].name, igs_ftp.day_string(job[1]), job[2], error_string(error)))
+            engine_slots.release()
+            done.put((n, status_row(job, status="failed", error=error_string(error),
+                                    seconds=time.time() - t0)))
+            continue
+        try:
+            future = engine_pool.submit(run_job, job)
+        except Exception as e:  # e.g. BrokenProcessPool
+            print("batch: cannot start engine runs: %s" % error_string(e))
+            engine_slots.release()
+            failed = [(n, job, t0)] + list(waiting.values())
+            while more:
+                item = ready.get()
+                if item is None:
+                    more = False
+                else:
+                    failed.append((item[0], item[1], item[3]))
+            for (m, failed_job, t) in failed:
+                done.put((m, status_row(failed_job, status="failed", error=error_string(e),
+                                        seconds=time.time() - t)))
+            break
+        future.add_done_callback(functools.partial(finished, n))
+
+
+def run_batch(stations, dates, engines, workers=4, download_workers=4, rapid=True,
+              products="CODE", policy=None, prefixdir="", num_days=1, queue_size=None,
+              prefetch=False, force=False):
+    """
+    run every engine for every station and day in dates, as a pipeline:
+    inputs are downloaded and staged on download_workers processes,
+    while at most workers engine runs are active.
+    queue_size (default workers) is the number of prepared jobs that may
+    wait for an engine.
+    With prefetch, all inputs are downloaded first, in one transfer phase.
+    With num_days > 1, gpspace runs are multi-day runs ending on each day.
+    Returns the status table, a list of dicts with keys
+    station, day, engine, status ("ok", "up-to-date", "failed"), result (result file),
+    error and seconds. Rows are in the order of the jobs.
+    """
+    if not prefixdir:
+        prefixdir = os.getcwd()
+    ftp_tools.check_dir(prefixdir + "/products/")
+    if prefetch:
+        first = min(dates) - datetime.timedelta(days=num_days - 1)
+        for engine in engines:
+            plan_dates = ppp_plan.date_range(first, max(dates)) if engine == "gpspace" else dates
+            entries = ppp_plan.plan(stations, plan_dates, engine=engine, rapid=rapid,
+                                    products=products, policy=policy, prefixdir=prefixdir,
+                                    check_remote=policy is not None)  # to resolve the policy
+            ppp_plan.prefetch(entries, prefixdir, download_workers)
+
+    jobs = [(s, dt, engine, rapid, products, policy, prefixdir, num_days)
+            for dt in dates for s in stations for engine in engines]
+    print("batch: %d jobs on %d engine workers, %d prepare workers" % (len(jobs), workers, download_workers))
+    sys.stdout.flush()
+    queue_size = queue_size or workers
+    # (n, job, prepare future, submit time). the engine stage holds queue_size of them
+    ready = queue.Queue(maxsize=1)
+    done = queue.Queue()  # (n, status row)
+    engine_slots = threading.Semaphore(workers)
+    table = [None]*len(jobs)
+    with concurrent.futures.ProcessPoolExecutor(max_workers=download_workers) as preparer:
+        with concurrent.futures.ProcessPoolExecutor(max_workers=workers, initializer=init_engine,
+                                                    initargs=(force,)) as engine_pool:
+            stages = [threading.Thread(target=prepare_stage, args=(jobs, preparer, ready), daemon=True),
+                      threading.Thread(target=engine_stage, daemon=True,
+                                       args=(engine_pool, engine_slots, ready, done, queue_size))]
+            for stage in stages:
+                stage.start()
+            # collect stage
+            for count in range(len(jobs)):
+                (n, row) = done.get()
+                table[n] = row
+                print("batch: %d/%d done, %s %s %s %s" % (count + 1, len(jobs), row["station"],
+                      igs_ftp.day_string(row["day"]), row["engine"], row["status"]))
+                sys.stdout.flush()
+            for stage in stages:
+                stage.join()
+    # no run of this batch is active any more. runs of other processes
+    # are protected by product_cache.in_use_seconds
+    product_cache.ProductCache(prefixdir + "/products/").maintain()
+    print_status(table)
+    return table
+
+
+def print_status(table):
+    print("%-10s %-10s %-8s %-7s %9s  %s" % ("station", "day", "engine", "status", "seconds", "result"))
+    for row in table:
+        print("%-10s %-10s %-8s %-7s %9.1f  %s" % (
+            row["station"], igs_ftp.day_string(row["day"]), row["engine"], row["status"],
+            row["seconds"], os.path.basename(row["result"] or "") or row["error"]))
+    failed = [row for row in table if row["status"] == "failed"]
+    skipped = [row for row in table if row["status"] == "up-to-date"]
+    print("%d jobs, %d ok, %d up to date, %d failed" % (
+        len(table), len(table) - len(failed) - len(skipped), len(skipped), len(failed)))
+    sys.stdout.flush()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="run PPP for a grid of stations, days and engines")
+    parser.add_argument("--stations", nargs="+", required=True, help="station names, e.g. MI04 MI05")
+    parser.add_argument("--start", required=True, help="first day, YYYY-MM-DD")
+    parser.add_argument("--end", help="last day, YYYY-MM-DD (default: start)")
+    parser.add_argument("--engines", nargs="+", choices=ppp_plan.engines, default=["gpspace"])
+    parser.add_argument("--products", choices=["CODE", "IGS"], default="CODE")
+    parser.add_argument("--final", action="store_true", help="final products (default: rapid)")
+    parser.add_argument("--policy", action="store_true",
+                        help="use the default product fallback policy (CODE/IGS, final/rapid)")
+    parser.add_argument("--num-days", type=int, default=1, help="multi-day gpspace runs ending on each day")
+    parser.add_argument("--workers", type=int, default=os.cpu_count(), help="concurrent engine runs")
+    parser.add_argument("--download-workers", type=int, default=4,
+                        help="concurrent downloads and staging of inputs")
+    parser.add_argument("--queue-size", type=int, help="prepared jobs waiting for an engine (default: workers)")
+    parser.add_argument("--prefetch", action="store_true", help="download all inputs first")
+    parser.add_argument("--force", action="store_true", help="also run jobs that are up to date")
+    args = parser.parse_args(argv)
+
+    known = ppp_plan.all_stations()
+    stations = []
+    for name in args.stations:
+        if name not in known:
+            parser.error("unknown station %s, known stations: %s" % (name, " ".join(sorted(known))))
+        stations.append(known[name])
+    start = datetime.datetime.strptime(args.start, "%Y-%m-%d")
+    end = datetime.datetime.strptime(args.end, "%Y-%m-%d") if args.end else start
+    policy = igs_ftp.ProductPolicy() if args.policy else None
+
+    table = run_batch(stations, ppp_plan.date_range(start, end), args.engines, workers=args.workers,
+                      download_workers=args.download_workers, rapid=not args.final,
+                      products=args.products, policy=policy, prefixdir=os.getcwd(),
+                      num_days=args.num_days, queue_size=args.queue_size, prefetch=args.prefetch,
+                      force=args.force)
+    return 0 if all(row["status"] != "failed" for row in table) else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
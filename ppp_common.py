@@ -9,6 +9,8 @@
 import math
 import os
 import datetime
+import shutil
+import tempfile
 import station
 
 import ftp_tools
@@ -91,6 +93,59 @@ def diff(result1, result2):
     assert(len(td) == len(d))
     return (td, d)
 
+# working directories of successful runs are removed, unless keep_workdirs is True.
+# the directory of a run that fails is always kept, for inspection.
+keep_workdirs = False
+
+
+def run_workdir(prefixdir, my_station, dt, tag):
+    """
+    create a new, empty working directory for one (station, day, program) run,
+    <prefixdir>/temp/<station>.<YYYY-MM-DD>.<tag>.<random>/
+    Each run writes only into its own directory, so runs may execute in parallel.
+    Returns the directory name, with a trailing slash.
+    """
+    os.makedirs(prefixdir + "/temp", exist_ok=True)
+    prefix = "%s.%s.%s." % (my_station.name, dt.strftime("%Y-%m-%d"), tag)
+    workdir = tempfile.mkdtemp(prefix=prefix, dir=prefixdir + "/temp") + "/"
+    print("working directory ", workdir)
+    return workdir
+
+
+def finish_workdir(workdir):
+    """
+    remove the working directory of a finished run, unless keep_workdirs
+    """
+    if not keep_workdirs:
+        print("removing working directory ", workdir)
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+def result_name(my_station, mjd, rapid=True, tag="ppp", num_days=1):
+    """
+    filename for result file
+    single day: MI04.59385.rapid.gpspace.txt
+    multi-day: MI04.59385.MD_2.rapid.gpspace.txt
+    """
+    rapid_final = "final"
+    if rapid:
+        rapid_final = "rapid"
+    if num_days==1:
+        return my_station.receiver + "." + \
+            str(mjd) + "." + rapid_final + "." + tag + ".txt"
+    return my_station.receiver + "." + \
+        str(mjd) + ".MD_"+str(num_days) + "." + rapid_final + "." + tag + ".txt"
+
+
+def result_path(my_station, dt, rapid=True, tag="ppp", prefixdir="", num_days=1):
+    """
+    the result file of a run for day dt (the last day of a multi-day run),
+    as it is named when the last observation is on day dt.
+    used to find the manifest of the run before running, see run_manifest.py
+    """
+    mjd = int(jdutil.datetime_to_mjd(datetime.datetime(dt.year, dt.month, dt.day)))
+    return prefixdir + "/results/" + my_station.name + "/" + result_name(my_station, mjd, rapid, tag, num_days)
+
 
 def write_result_file(ppp_result,  preamble="", rapid=True, tag="ppp", prefixdir="", num_days=1):
     """ 
@@ -102,19 +157,7 @@ def write_result_file(ppp_result,  preamble="", rapid=True, tag="ppp", prefixdir
     last_obs = ppp_result.observations[-1]
     last_obs_mjd = int(jdutil.datetime_to_mjd(last_obs.epoch))
 
-    rapid_final = "final"
-    if rapid:
-        rapid_final = "rapid"
-    # filename for result file
-    # single day: MI04.59385.rapid.gpspace.txt
-    # multi-day: 
-    if num_days==1:
-        result_file = ppp_result.station.receiver + "." + \
-            str(last_obs_mjd) + "." + rapid_final + "." + tag + ".txt"
-    else:
-        result_file = ppp_result.station.receiver + "." + \
-            str(last_obs_mjd) + ".MD_"+str(num_days) + "." + rapid_final + "." + tag + ".txt"
-            
+    result_file = result_name(ppp_result.station, last_obs_mjd, rapid, tag, num_days)
     outfile = prefixdir + "/results/" + ppp_result.station.name + "/" + result_file
     with open(outfile, 'w') as f:
         #            "# run start:
@@ -7,10 +7,13 @@
 """
 import os
 import datetime
-import shutil
 import subprocess
 
 import station
+import decompress
+import input_cache
+import rinex_prune
+import run_manifest
 import ftp_tools
 import bipm_ftp
 import igs_ftp
@@ -83,10 +86,10 @@ def run(station, dt, rapid=True, prefixdir=""):
     
     """
     print("ESA gLAB PPP-run")
-    original_dir = prefixdir
     dt_start = datetime.datetime.utcnow()
 
     doy = dt.timetuple().tm_yday
+    igs_ftp.require_products([dt], rapid=rapid, products="CODE", prefixdir=prefixdir)
     rinex = station.get_rinex( dt ) # download rinex file
 
     print("getting IGS products:")
@@ -113,69 +116,37 @@ def run(station, dt, rapid=True, prefixdir=""):
     run_log += "       ERP: %s\n" % erp[len(prefixdir):]
     print(run_log)
     print("-------------------")
-    
-    # we do processing in a temp directory
-    tempdir = prefixdir + "/temp/"
-    ftp_tools.check_dir( tempdir )
-    ftp_tools.delete_files(tempdir) # empty the temp directory
 
-    # copy files to tempdir
+    # skip the run if its inputs have not changed since the last run, see run_manifest.py
+    antfile = prefixdir + "/common/igs14.atx"
+    settings = {"rapid": rapid, "products": "CODE",
+                "staging": decompress.recipe(False, rinex_prune.profile("glab"))}
+    manifest = run_manifest.build(station, glab_tag, run_manifest.binary_version(glab_binary),
+                                  [rinex, clk, eph, erp], [antfile], settings, prefixdir)
+    run_file = ppp_common.result_path(station, dt, rapid, glab_tag, prefixdir)
+    done = run_manifest.up_to_date(run_file, manifest)
+    if done is not None:
+        return done
+
+    # we do processing in a new directory of this run, under temp/
+    tempdir = ppp_common.run_workdir(prefixdir, station, dt, glab_tag)
+
+    # decompress files into tempdir
     files_to_copy = [ rinex, clk, eph,  erp ]
-    copied_files = []
-    for f in files_to_copy:
-        shutil.copy2( f, tempdir )
-        (tmp,fn ) = os.path.split(f)
-        copied_files.append( tempdir + fn )
+    # the RINEX file is decimated to 30 s and pruned to GPS while staging, see rinex_prune.py
+    copied_files = decompress.stage_files(files_to_copy, tempdir, cache=input_cache.for_prefix(prefixdir),
+                                          prune=rinex_prune.profile("glab"))
     print("copied files: ", copied_files)
 
-    # unzip zipped files, if needed
-    for f in copied_files:
-        if f[-1] == "Z" or f[-1] == "z": # compressed .z or .Z file
-            cmd ='/bin/gunzip'
-            cmd = cmd + " -f " + f # -f overwrites existing file
-            print("unzipping: ", cmd)
-            p = subprocess.Popen(cmd, shell=True)
-            p.communicate()
-
-    # Hatanaka uncompress - if needed
-    #rinexfile = copied_files[0] # the first file is the unzipped RINEX, in the temp dir
-    if rinex[-3] == "d" or rinex[-3] == "D" or rinex[-4] == "D":  # can end .z, .Z, or .gz - so the "d" is in position -3 or -4
-        hata_file = copied_files[0]
-        hata_file = hata_file[:-2] # strip off ".Z"
-        if rinex[-4] == "D":
-            hata_file = hata_file[:-1] # stip off more
-        #print "hata ", hata_file
-        cmd = "CRX2RNX " + hata_file
-        print("Hatanaka uncompress: ", cmd)
-        p = subprocess.Popen(cmd, shell=True)
-        p.communicate()
+    # the rinex file name. staging also decoded Hatanaka-compressed RINEX
+    inputfile = os.path.basename(copied_files[0])
     
-
-    # figure out the rinex file name
-    (tmp,rinexfile ) = os.path.split(rinex)
-    inputfile = rinexfile[:-2] # strip off ".Z"
-    
-    if inputfile[-1] == ".": # ends in a dot
-        inputfile = inputfile[:-1] # strip off
-        
-    if inputfile[-1] == "d" or inputfile[-1] == "D":
-        # if hatanaka compressed, we already uncompressed, so change to "O"
-        inputfile = inputfile[:-1]+"O"
     
-    
-    # now ppp itself:
-    os.chdir( tempdir )
-
-    antfile = prefixdir + "/common/igs14.atx"
+    # now ppp itself, in the run directory:
     outfile = tempdir + "out.txt"
     eph = copied_files[2]
     clk = copied_files[1]
     inputfile = tempdir + inputfile
-    
-    if eph[-1] == "Z":
-        eph = eph[:-2]
-    if clk[-1] == "Z":
-        clk = clk[:-2]
             
     print("inputfile for gLAB is: ",inputfile)
     
@@ -233,8 +204,10 @@ def run(station, dt, rapid=True, prefixdir=""):
     run_log2 += "  last obs: %s\n" % ppp_result.observations[-1].epoch
     run_log2 += "   num obs: %d\n" % len(ppp_result.observations)
     
-    ppp_common.write_result_file( ppp_result=ppp_result, preamble=run_log+run_log2, rapid=rapid, tag=glab_tag, prefixdir=prefixdir )
-    os.chdir(original_dir)
+    result_file = ppp_common.write_result_file( ppp_result=ppp_result, preamble=run_log+run_log2, rapid=rapid, tag=glab_tag, prefixdir=prefixdir )
+    run_manifest.write(run_file, manifest, result_file)
+    ppp_common.finish_workdir(tempdir)
+    return result_file
 
 if __name__ == "__main__":
 
@@ -4,11 +4,14 @@
 
 import os
 import datetime
-import shutil
 import subprocess
 import struct
 
 import station
+import decompress
+import input_cache
+import rinex_prune
+import run_manifest
 import ftp_tools
 import bipm_ftp
 import igs_ftp
@@ -78,9 +81,31 @@ def nrcan_inp_file(inpfile, rinex, cmdfile, eph_files, clk_files, rapid):
     return inpfile
 
 
-def nrcan_def_file(prefixdir, def_file):
+def nrcan_config_files(prefixdir):
     """
-    create a gpsppp.def file
+    the helper files listed in the gpsppp.def file, by DEF-file keyword
+    """
+    return {"TRF": prefixdir + "/gpsppp/gpsppp.trf",
+            "SVB": prefixdir + "/gpsppp/gpsppp.svb_gnss_yrly",
+            "PCV": prefixdir + "/common/igs20.atx",
+            "FLT": prefixdir + "/gpsppp/gpsppp.flt",
+            "OLC": prefixdir + "/gpsppp/gpsppp.olc",
+            "MET": prefixdir + "/gpsppp/gpsppp.met"}
+
+
+def nrcan_manifest(station, rapid, products, inputs, config, prefixdir, num_days=1):
+    """
+    the run_manifest.py manifest of a GPSPACE run
+    """
+    settings = {"rapid": rapid, "products": products, "num_days": num_days,
+                "staging": decompress.recipe(station.rinex3, rinex_prune.profile("gpspace"))}
+    config = config + sorted(nrcan_config_files(prefixdir).values())
+    return run_manifest.build(station, gpsppp_tag, gpsppp_version, inputs, config, settings, prefixdir)
+
+
+def nrcan_def_file(prefixdir, workdir, def_file):
+    """
+    create a gpsppp.def file in the run directory workdir
     the file defines locations of helper files
 
     GSD/DLG-lines are headers in English/French, included in the header of the output .pos file
@@ -106,16 +131,17 @@ def nrcan_def_file(prefixdir, def_file):
     ---------
     """
     # these are fixed files for now. in principle they could vary from run to run.
-    trf = "'%s/gpsppp/gpsppp.trf'" % prefixdir
-    svb = "'%s/gpsppp/gpsppp.svb_gnss_yrly'" % prefixdir
-    atx = "'%s/common/igs20.atx'" % prefixdir
-    flt = "'%s/gpsppp/gpsppp.flt'" % prefixdir
-    olc = "'%s/gpsppp/gpsppp.olc'" % prefixdir
-    met = "'%s/gpsppp/gpsppp.met'" % prefixdir
-    # NOTE: this file is in the temp directory!
-    erp = "'%s/temp/gpsppp.ERP'" % prefixdir
-
-    with open(prefixdir + "/temp/" + def_file, 'w') as f:
+    files = nrcan_config_files(prefixdir)
+    trf = "'%s'" % files["TRF"]
+    svb = "'%s'" % files["SVB"]
+    atx = "'%s'" % files["PCV"]
+    flt = "'%s'" % files["FLT"]
+    olc = "'%s'" % files["OLC"]
+    met = "'%s'" % files["MET"]
+    # NOTE: this file is in the run directory!
+    erp = "'%sgpsppp.ERP'" % workdir
+
+    with open(workdir + def_file, 'w') as f:
         f.write("'LNG' 'ENGLISH'\n")
         f.write("'SVB' %s\n" % svb)
         f.write("'TRF' %s\n" % trf)  # coordinate transformations (?)
@@ -128,9 +154,9 @@ def nrcan_def_file(prefixdir, def_file):
         # this might include a version-string for ppp-tools also?
         f.write("'GSD' 'ppp-tools, from https://github.com/aewallin/ppp-tools'\n")
 
-def nrcan_cmd_file(prefixdir, cmd_file, num_days=1):
+def nrcan_cmd_file(workdir, cmd_file, num_days=1):
     """
-    create a  cmd file for gpspace
+    create a  cmd file for gpspace, in the run directory workdir
 
     example 1day.cmd file:
     ---------
@@ -157,7 +183,7 @@ def nrcan_cmd_file(prefixdir, cmd_file, num_days=1):
     ' GDOP CUTOFF                                 '             20.0000
     ---------
     """
-    with open(prefixdir + "/temp/" + cmd_file, 'w') as f:
+    with open(workdir + cmd_file, 'w') as f:
         f.write("' UT DAYS OBSERVED                      (1-45)'%20d\n"%(num_days+1))
         # f.write("' UT DAYS OBSERVED                      (1-45)'                   2\n")
         f.write("' USER DYNAMICS         (1=STATIC,2=KINEMATIC)'                   1\n")
@@ -243,54 +269,57 @@ def nrcan_parse_result(filename, my_station, inputfile, bwd=False):
         nrcan_result.reverse()
     return nrcan_result
 
-def run_multiday(station, dtend, num_days, rapid=True, prefixdir="", products="CODE"):
+def run_multiday(station, dtend, num_days, rapid=True, prefixdir="", products="CODE", policy=None,
+                 sliding=False):
     """
         multi-day run, ending at given datetime dtend
         num_days specifies number of days.
+        if an igs_ftp.ProductPolicy is given, it chooses products and rapid.
+        sliding=True keeps a per-station archive of spliced days, for daily
+        runs over "the last num_days days", see splice_archive.py
     """
-    original_dir = prefixdir
     dt_start = datetime.datetime.utcnow()  # for timing how long processing takes
 
-    # we do processing in a temp directory
-    tempdir = prefixdir + "/temp/"
-    ftp_tools.check_dir(tempdir)
-    ftp_tools.delete_files(tempdir)  # empty the temp directory
+    # check that all products exist before any other work.
+    # products for day N and N+1 are needed.
+    product_days = [dtend - datetime.timedelta(days=n) for n in reversed(range(num_days))]
+    product_days.append(dtend + datetime.timedelta(days=1))
+    if policy is not None:
+        (products, rapid) = policy.resolve(product_days, prefixdir)
+    igs_ftp.require_products(product_days, rapid=rapid, products=products, prefixdir=prefixdir)
 
-    # get spliced multi-day rinex file
-    dtlist, rinex, rlist = station.get_multiday_rinex(dtend, num_days=num_days)  # this downloads RINEX over ftp, if needed
-    # results in uncompressed "splice.rnx" file in the temp-directory.
-    # dtlist has the datetimes for the days we will process
-    print(dtlist)
-    print(rinex)
-    
-
-    
     # get GPS Products
     # nrcan ppp wants IGS products for two days.
     # if we process day N, we need products for N and N+1
-    clk_files = []
-    eph_files = []
-    erp_file = ""  # we do not use the ERP files, for now.
-    dtlist.append( dtlist[-1]+datetime.timedelta(days=1) ) # add one day
-    for dt in dtlist:
-        if not rapid:  # Final products
-            if products=="CODE":
-                (clk1, eph1, erp1) = igs_ftp.get_CODE_final(dt, prefixdir)
-            elif products=="IGS":
-                (clk1, eph1, erp1) = igs_ftp.get_IGS_final(dt, prefixdir)
-
-        elif rapid:  # Rapid products
-            if products=="CODE":
-                (clk1, eph1, erp1) = igs_ftp.get_CODE_rapid(dt, prefixdir)
-            elif products=="IGS":
-                (clk1, eph1, erp1) = igs_ftp.get_IGS_rapid(dt, prefixdir)
-                
-        clk_files.append(clk1)
-        eph_files.append(eph1)
-        erp_file = erp1
+    # all products for the run are downloaded concurrently, up front
+    (clk_files, eph_files, erp_files) = igs_ftp.get_products(
+        product_days, rapid=rapid, products=products, prefixdir=prefixdir)
+    erp_file = erp_files[-1]  # we do not use the ERP files, for now.
     print("clk_files: ",str(clk_files))
     print("eph_files: ",str(eph_files))
-    
+
+    # skip the run if its inputs have not changed since the last run, see run_manifest.py
+    rinex_files = [station.get_rinex(day) for day in product_days[:-1]]  # this downloads RINEX over ftp, if needed
+    manifest = nrcan_manifest(station, rapid, products, rinex_files + clk_files + eph_files + [erp_file],
+                              [], prefixdir, num_days)
+    run_file = ppp_common.result_path(station, dtend, rapid, gpsppp_tag, prefixdir, num_days)
+    done = run_manifest.up_to_date(run_file, manifest)
+    if done is not None:
+        return done
+
+    # we do processing in a new directory of this run, under temp/
+    tempdir = ppp_common.run_workdir(prefixdir, station, dtend, gpsppp_tag + ".MD_%d" % num_days)
+
+    # get spliced multi-day rinex file
+    # RINEX version 3 files are converted to version 2 when they are staged, see rnx3to2.py
+    dtlist, rinex = station.get_multiday_rinex(
+        dtend, num_days=num_days, rinex2=station.rinex3, sliding=sliding,
+        prune=rinex_prune.profile("gpspace"), workdir=tempdir)
+    # results in uncompressed "splice.rnx" file in the run directory.
+    # dtlist has the datetimes for the days we will process
+    print(dtlist)
+    print(rinex)
+
     run_log = ""
     run_log += " run start: %d-%02d-%02d %02d:%02d:%02d\n" % (
         dt_start.year, dt_start.month, dt_start.day, dt_start.hour, dt_start.minute, dt_start.second)
@@ -300,9 +329,10 @@ def run_multiday(station, dtend, num_days, rapid=True, prefixdir="", products="C
     run_log += "   DOY_end: %03d\n" % dtend.timetuple().tm_yday
     run_log += "      date: %d-%02d-%02d\n" % (dtend.year, dtend.month, dtend.day)
     run_log += "  num_days: %d\n" % num_days
+    run_log += "  Products: %s\n" % igs_ftp.describe(products, rapid)
     run_log += "     RINEX: %s\n" % rinex[len(tempdir):]
-    for r in rlist:
-        run_log += " src RINEX: %s\n" % r[len(tempdir):]
+    for r in rinex_files:
+        run_log += " src RINEX: %s\n" % os.path.basename(r)
     for c in clk_files:
         run_log += "       CLK: %s\n" % c[len(prefixdir):]
     for e in eph_files:
@@ -311,7 +341,7 @@ def run_multiday(station, dtend, num_days, rapid=True, prefixdir="", products="C
     print(run_log)
     
     
-    cmd_file = nrcan_cmd_file(prefixdir, "md.cmd", num_days)
+    cmd_file = nrcan_cmd_file(tempdir, "md.cmd", num_days)
     
     # use an existing cmd-file (doesn't change from run to run)
     #cmdfile = prefixdir + "/gpsppp/2day.cmd"
@@ -322,60 +352,20 @@ def run_multiday(station, dtend, num_days, rapid=True, prefixdir="", products="C
         tempdir + "run.inp", rinex+".Z", cmdfile, eph_files, clk_files, rapid)
     
     # write a DEF file
-    nrcan_def_file(prefixdir, "gpsppp.def")
+    nrcan_def_file(prefixdir, tempdir, "gpsppp.def")
     nrcan_pos_file = tempdir + "splice.pos"
     
-    # move  CLK, EPH, ERP files to temp_dir
+    # decompress CLK, EPH, ERP files into temp_dir
     files_to_move = clk_files + eph_files + [erp_file]
-    moved_files = []
-    for f in files_to_move:
-        shutil.copy2(f, tempdir)
-        (tmp, fn) = os.path.split(f)
-        moved_files.append(tempdir + fn)
+    moved_files = decompress.stage_files(files_to_move, tempdir, cache=input_cache.for_prefix(prefixdir))
     print("moved files: ",str(moved_files))
 
-    # unzip zipped files. this may include the RINEX, CLK, EPH files.
-    for f in moved_files:
-        if f[-1] == "Z" or f[-1] == "z":  # compressed .z or .Z file
-            cmd = '/bin/gunzip'
-            cmd = cmd + " -f " + f  # -f overwrites existing file
-            print("unzipping: ", cmd)
-            p = subprocess.Popen(cmd, shell=True)
-            p.communicate()
-
     # rename the ERP file - becase the name is fixed to gpsppp.ERP in the DEF file.
-    cmd = '/bin/mv'
-    gpsppp_erp = prefixdir + "/temp/gpsppp.ERP"
-    (tmp, fn) = os.path.split(erp_file)  # [:-2]
-    print('erp file ', fn)
-    if fn[-1]=='Z': # final products are zipped
-        fn = fn[:-2] # strip off '.Z'S
-    elif fn[-3:]=='.gz':
-        fn = fn[:-3]
-    cmd = cmd + " " + tempdir + fn + " " + gpsppp_erp
-    print("rename command: ", cmd)
-    p = subprocess.Popen(cmd, shell=True)
-    p.communicate()
-    
-    # if RINEX version 3, use gfzrnx to convert 3->2
-    if station.rinex3:
-        print('Converting RINEX v3 to v2')
-        v3file = rinex + "_rx3" # rename the v3 file
-        cmd = "mv " + rinex + " " + v3file
-        print("rename v3 file: ", cmd)
-        p = subprocess.Popen(cmd, shell=True)
-        p.communicate()
+    gpsppp_erp = tempdir + "gpsppp.ERP"
+    print("rename ERP file: ", moved_files[-1], gpsppp_erp)
+    os.replace(moved_files[-1], gpsppp_erp)
     
-        #v2file = inputfile[:-1]+"2"  # name ending in "O" or "o" is replaced with "2" for v2 rinex
-        cmd = "gfzrnx -finp " + v3file + " -fout " + rinex + " --version_out 2"
-        print("3to2 command: ",cmd)
-        p = subprocess.Popen(cmd, shell=True)
-        p.communicate()
-        # use the v2 file for the rest of the run
-        #inputfile = v2file
-
-    # now gpsppp itself:
-    os.chdir(tempdir)
+    # now gpsppp itself, in the run directory:
     cmd = gpsppp_binary + " < " + inp_file
     p = subprocess.Popen(cmd, shell=True, cwd=tempdir)
     p.communicate()  # wait for processing to finish
@@ -400,25 +390,32 @@ def run_multiday(station, dtend, num_days, rapid=True, prefixdir="", products="C
     
     result_file = ppp_common.write_result_file(
         ppp_result=ppp_result, preamble=run_log+run_log2, rapid=rapid, tag=gpsppp_tag, prefixdir=prefixdir, num_days=num_days)
-    os.chdir(original_dir)  # change back to original directory
+    run_manifest.write(run_file, manifest, result_file)
+    ppp_common.finish_workdir(tempdir)
     return result_file
 
-def run(station, dt, rapid=True, prefixdir="", products="CODE"):
+def run(station, dt, rapid=True, prefixdir="", products="CODE", policy=None):
     """
     Single day/RINEX-file PPP-processing with NRCan ppp.
 
     requires "gpsppp" or "gpspace" binary
 
+    if an igs_ftp.ProductPolicy is given, it chooses products and rapid.
     """
     print("------------------------------------")
 
     print("ppp-tools: PPP-processing with NRCan ppp.")
 
-    original_dir = prefixdir
     dt_start = datetime.datetime.utcnow()  # for timing how long processing takes
 
     year = dt.timetuple().tm_year
     doy = dt.timetuple().tm_yday
+    # check that products for day N and N+1 exist, before any other work
+    product_days = [dt, dt+datetime.timedelta(days=1)]
+    if policy is not None:
+        (products, rapid) = policy.resolve(product_days, prefixdir)
+    igs_ftp.require_products(product_days, rapid=rapid,
+                             products=products, prefixdir=prefixdir)
     rinex = station.get_rinex(dt)  # this downloads RINEX over ftp, if needed
 
     # get GPS Products
@@ -453,20 +450,26 @@ def run(station, dt, rapid=True, prefixdir="", products="CODE"):
         eph_files = [eph1, eph2]
         erp_file = erp1
 
-    # we do processing in a temp directory
-    tempdir = prefixdir + "/temp/"
-    ftp_tools.check_dir(tempdir)
-    ftp_tools.delete_files(tempdir)  # empty the temp directory
-
     # use an existing cmd-file (doesn't change from run to run)
     cmdfile = prefixdir + "/gpsppp/1day.cmd"
 
+    # skip the run if its inputs have not changed since the last run, see run_manifest.py
+    manifest = nrcan_manifest(station, rapid, products, [rinex] + clk_files + eph_files + [erp_file],
+                              [cmdfile], prefixdir)
+    run_file = ppp_common.result_path(station, dt, rapid, gpsppp_tag, prefixdir)
+    done = run_manifest.up_to_date(run_file, manifest)
+    if done is not None:
+        return done
+
+    # we do processing in a new directory of this run, under temp/
+    tempdir = ppp_common.run_workdir(prefixdir, station, dt, gpsppp_tag)
+
     # write an INP file, corresponding to the keyboard-input required
     inp_file = nrcan_inp_file(
         tempdir + "run.inp", rinex, cmdfile, eph_files, clk_files, rapid)
 
     # write a DEF file
-    nrcan_def_file(prefixdir, "gpsppp.def")
+    nrcan_def_file(prefixdir, tempdir, "gpsppp.def")
 
     # result will be stored in a POS file:
     (rinexdir, fn) = os.path.split(rinex)
@@ -483,80 +486,31 @@ def run(station, dt, rapid=True, prefixdir="", products="CODE"):
     run_log += "      Year: %d\n" % year
     run_log += "       DOY: %03d\n" % doy
     run_log += "      date: %d-%02d-%02d\n" % (dt.year, dt.month, dt.day)
+    run_log += "  Products: %s\n" % igs_ftp.describe(products, rapid)
     run_log += "     RINEX: %s\n" % rinex[len(prefixdir):]
     run_log += "       CLK: %s\n" % [c[len(prefixdir):] for c in clk_files]
     run_log += "       EPH: %s\n" % [e[len(prefixdir):] for e in eph_files]
     run_log += "       ERP: %s\n" % erp_file[len(prefixdir):]
     print(run_log)
 
-    # move RINEX, CLK, EPH, ERP files to temp_dir
+    # decompress RINEX, CLK, EPH, ERP files into temp_dir
+    # RINEX version 3 is converted to version 2 while staging, see rnx3to2.py
+    # GPSPACE has no pruning profile, observations are staged in full, see rinex_prune.py
     files_to_move = [rinex, clk1, clk2, eph1, eph2, erp_file]
-    moved_files = []
-    for f in files_to_move:
-        shutil.copy2(f, tempdir)
-        (tmp, fn) = os.path.split(f)
-        moved_files.append(tempdir + fn)
+    moved_files = decompress.stage_files(files_to_move, tempdir, cache=input_cache.for_prefix(prefixdir),
+                                         rinex2=station.rinex3, prune=rinex_prune.profile("gpspace"))
     print(moved_files)
 
-    # unzip zipped files. this may include the RINEX, CLK, EPH files.
-    for f in moved_files:
-        if f[-1] == "Z" or f[-1] == "z":  # compressed .z or .Z file
-            cmd = '/bin/gunzip'
-            cmd = cmd + " -f " + f  # -f overwrites existing file
-            print("unzipping: ", cmd)
-            p = subprocess.Popen(cmd, shell=True)
-            p.communicate()
-
     # rename the ERP file - becase the name is fixed to gpsppp.ERP in the DEF file.
-    cmd = '/bin/mv'
-    gpsppp_erp = prefixdir + "/temp/gpsppp.ERP"
-    (tmp, fn) = os.path.split(erp_file)  # [:-2]
-    if fn[-3:]=='.gz':
-        fn = fn[:-3]
-
-    cmd = cmd + " " + tempdir + fn + " " + gpsppp_erp
-    print("rename command: ", cmd)
-    p = subprocess.Popen(cmd, shell=True)
-    p.communicate()
-
-    # figure out the rinex file name
+    gpsppp_erp = tempdir + "gpsppp.ERP"
+    print("rename ERP file: ", moved_files[-1], gpsppp_erp)
+    os.replace(moved_files[-1], gpsppp_erp)
+
+    # the rinex file name. staging also decoded Hatanaka-compressed RINEX
     print("rinex= ", rinex)
-    (tmp, rinexfile) = os.path.split(rinex)
-    inputfile = rinexfile[:-2]  # strip off ".Z"
-    if inputfile[-1] == ".":  # ends in a dot
-        inputfile = inputfile[:-1]  # strip off
-
-    # if the RINEX file is hatanaka-compressed, uncompress it
-    if inputfile[-1] == "d" or inputfile[-1] == "D":
-        hata_file = moved_files[0]
-        hata_file = hata_file[:-2]  # strip off ".Z"
-        if hata_file[-1] == ".":
-            hata_file = hata_file[:-1]  # stip off more
-
-        cmd = "CRX2RNX " + hata_file
-        print("Hatanaka uncompress: ", cmd)
-        p = subprocess.Popen(cmd, shell=True)
-        p.communicate()
-
-    # if RINEX version 3, use gfzrnx to convert 3->2
-    if station.rinex3:
-        print('Converting RINEX v3 to v2')
-        v3file = tempdir+inputfile + "_rx3" # rename the v3 file
-        cmd = "mv " + tempdir + inputfile + " " + v3file
-        print("rename v3 file: ", cmd)
-        p = subprocess.Popen(cmd, shell=True)
-        p.communicate()
-    
-        #v2file = inputfile[:-1]+"2"  # name ending in "O" or "o" is replaced with "2" for v2 rinex
-        cmd = "gfzrnx -finp " + v3file + " -fout " + tempdir+inputfile + " --version_out 2"
-        print("3to2 command: ",cmd)
-        p = subprocess.Popen(cmd, shell=True)
-        p.communicate()
-        # use the v2 file for the rest of the run
-        #inputfile = v2file
-
-    # now gpsppp itself:
-    os.chdir(tempdir)
+    inputfile = os.path.basename(moved_files[0])
+
+    # now gpsppp itself, in the run directory:
     cmd = gpsppp_binary + " < " + inp_file
     p = subprocess.Popen(cmd, shell=True, cwd=tempdir)
     p.communicate()  # wait for processing to finish
@@ -580,7 +534,8 @@ def run(station, dt, rapid=True, prefixdir="", products="CODE"):
     result_file = ppp_common.write_result_file(
         ppp_result=ppp_result, preamble=run_log+run_log2, 
         rapid=rapid, tag=gpsppp_tag, prefixdir=prefixdir)
-    os.chdir(original_dir)  # change back to original directory
+    run_manifest.write(run_file, manifest, result_file)
+    ppp_common.finish_workdir(tempdir)
     return result_file
 
 
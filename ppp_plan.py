@@ -0,0 +1,249 @@
+"""
+    This file is part of ppp-tools, https://github.com/aewallin/ppp-tools
+    GPLv2 license.
+
+    Work plan ("dry run") for a batch of PPP runs.
+
+    For a list of stations, a date range, an engine and a product choice,
+    plan() lists every RINEX and product file the batch needs, with its
+    cache status and an estimate of its size. prefetch() then downloads
+    everything that is not cached in one transfer phase, before any
+    processing starts.
+
+    command line example:
+    python ppp_plan.py --stations MI04 MI05 --start 2024-06-01 --end 2024-06-10 --engine gpspace --final --prefetch
+"""
+import os
+import sys
+import argparse
+import datetime
+
+import station
+import ftp_tools
+import igs_ftp
+import product_cache
+import mirrors
+import negative_cache
+import rinex_index
+import transfer
+
+# size estimates in bytes, used when the size of a remote file is unknown
+typical_bytes = {"rinex": 8.0e6, "clk": 3.0e6, "eph": 1.0e6, "erp": 2.0e3}
+
+engines = ["gpspace", "glab", "rtklib"]
+
+
+def all_stations():
+    """
+    Station objects defined in station.py, by name
+    """
+    return {s.name: s for s in vars(station).values() if isinstance(s, station.Station)}
+
+
+def date_range(start, end):
+    n = (end - start).days
+    return [start + datetime.timedelta(days=d) for d in range(n + 1)]
+
+
+def run_products(engine, dt, rapid=True, products="CODE", policy=None, prefixdir=""):
+    """
+    the product days and (products, rapid) choice used by a run of engine for day dt.
+    gpspace needs products for day N and N+1, gLAB and RTKLib for day N.
+    gLAB uses CODE products, RTKLib uses CODE rapid products.
+    """
+    if engine == "gpspace":
+        days = [dt, dt + datetime.timedelta(days=1)]
+        if policy is not None:
+            (products, rapid) = policy.resolve(days, prefixdir)
+        return (days, products, rapid)
+    elif engine == "glab":
+        return ([dt], "CODE", rapid)
+    elif engine == "rtklib":
+        return ([dt], "CODE", True)
+    raise ValueError("unknown engine %s" % engine)
+
+
+def remote_size(server, remotedir, f, prefixdir, check_remote):
+    """
+    return (status, size) of a remote file from the cached listing.
+    status is "remote", "missing" or "unknown"
+    """
+    if not check_remote:
+        return ("unknown", None)
+    try:
+        files = igs_ftp.remote_listing(server, remotedir, prefixdir)
+    except Exception as e:
+        print("could not list ", server + remotedir, e)
+        return ("unknown", None)
+    if f in files:
+        return ("remote", files[f])
+    return ("missing", None)
+
+
+def plan(stations, dates, engine="gpspace", rapid=True, products="CODE",
+         policy=None, prefixdir="", check_remote=False):
+    """
+    list all input files for runs of engine for every station and day.
+
+    Returns a list of dicts with keys
+    kind ("rinex", "clk", "eph", "erp"), station, day, url, local_file,
+    status ("cached", "remote", "missing", "known-missing", "unknown", "unresolved")
+    and bytes (an estimate).
+    Each file appears once, even if several runs need it.
+    With check_remote, remote directory listings are used to
+    find missing files and remote sizes. For RINEX files the listing
+    is kept in a per-station RinexIndex, see rinex_index.py Files that failed to download
+    recently are "known-missing", see negative_cache.py
+    A product policy is resolved from the remote listings, so without
+    check_remote the products of runs that use it are listed as the first
+    choice of the policy, with status "unresolved".
+    Nothing is downloaded and no directories are created.
+    """
+    negative = negative_cache.for_prefix(prefixdir)
+    indexes = {}
+    if check_remote:
+        for s in stations:
+            if s.ftp_server:
+                indexes[s.name] = rinex_index.RinexIndex(s, prefixdir)
+                try:
+                    indexes[s.name].scan(min(dates), max(dates))
+                except Exception as e:
+                    print("could not list ", s.rinex_dir_url(), e)
+                    del indexes[s.name]
+    entries = []
+    seen = set()
+    for dt in dates:
+        for s in stations:
+            (url, local_file) = s.rinex_transfer(dt, prefixdir)
+            if local_file not in seen:
+                seen.add(local_file)
+                if os.path.isfile(local_file):
+                    (status, size) = ("cached", os.path.getsize(local_file))
+                elif negative.known_missing(local_file):
+                    (status, size) = ("known-missing", None)
+                elif not s.ftp_server:  # local station, files are not on a server
+                    (status, size) = ("missing", None)
+                elif s.name in indexes:
+                    if indexes[s.name].available(dt):
+                        (status, size) = ("remote", indexes[s.name].size(dt))
+                    else:
+                        (status, size) = ("missing", None)
+                else:
+                    (status, size) = ("unknown", None)
+                entries.append({"kind": "rinex", "station": s.name, "day": dt, "url": url,
+                                "local_file": local_file, "status": status,
+                                "bytes": size or typical_bytes["rinex"]})
+
+        unresolved = policy is not None and engine == "gpspace" and not check_remote
+        if unresolved:
+            (days, day_products, day_rapid) = run_products(engine, dt, rapid, products, None, prefixdir)
+            (day_products, day_rapid) = policy.choices[0]
+        else:
+            (days, day_products, day_rapid) = run_products(engine, dt, rapid, products, policy, prefixdir)
+        for day in days:
+            (server, username, password, remotedir, files,
+             localdir) = igs_ftp.product_files(day, day_rapid, day_products, prefixdir)
+            for (kind, f) in zip(["clk", "eph", "erp"], files):
+                local_file = localdir + f
+                if local_file in seen:
+                    continue
+                seen.add(local_file)
+                if unresolved:
+                    (status, size) = ("unresolved", None)
+                elif os.path.isfile(local_file):
+                    (status, size) = ("cached", os.path.getsize(local_file))
+                elif negative.known_missing(local_file):
+                    (status, size) = ("known-missing", None)
+                else:
+                    (status, size) = remote_size(server, remotedir, f, prefixdir, check_remote)
+                entries.append({"kind": kind, "station": "", "day": day,
+                                "url": igs_ftp.remote_url(server, remotedir, f),
+                                "local_file": local_file, "status": status,
+                                "bytes": size or typical_bytes[kind]})
+    return entries
+
+
+def print_plan(entries):
+    print("%-6s %-10s %-10s %-13s %12s  %s" % ("kind", "station", "day", "status", "bytes", "file"))
+    for e in entries:
+        print("%-6s %-10s %-10s %-13s %12d  %s" % (
+            e["kind"], e["station"], igs_ftp.day_string(e["day"]), e["status"],
+            e["bytes"], os.path.basename(e["local_file"])))
+    todo = [e for e in entries if e["status"] not in ("cached", "missing", "known-missing", "unresolved")]
+    print("%d files, %d to download, estimated %.1f MB" % (
+        len(entries), len(todo), sum(e["bytes"] for e in todo)/1.0e6))
+    missing = [e for e in entries if e["status"] == "missing"]
+    if missing:
+        print("%d files are missing on the server" % len(missing))
+    known = [e for e in entries if e["status"] == "known-missing"]
+    if known:
+        print("%d files failed recently and are skipped" % len(known))
+    unresolved = [e for e in entries if e["status"] == "unresolved"]
+    if unresolved:
+        print("%d product files depend on the product policy, use --check-remote to resolve it" % len(unresolved))
+
+
+def prefetch(entries, prefixdir="", workers=4):
+    """
+    download all files of the plan that are not cached and not
+    known to be missing, in one transfer phase. Products of an
+    unresolved policy are not downloaded.
+    Returns a dict mapping local_file to the download status.
+    """
+    todo = [e for e in entries if e["status"] not in ("cached", "missing", "known-missing", "unresolved")]
+    products = [e for e in todo if e["kind"] != "rinex"]
+    rinex = [(e["url"], e["local_file"]) for e in todo if e["kind"] == "rinex"]
+    status = {}
+    if products:
+        transfers = [(e["url"], e["local_file"], e["day"]) for e in products]
+        cache = product_cache.ProductCache(prefixdir + "/products/")
+        status.update(igs_ftp.fetch_files(transfers, cache, workers, mirrors.ranking(prefixdir),
+                                          negative_cache.for_prefix(prefixdir)))
+    if rinex:
+        for (url, local_file) in rinex:
+            ftp_tools.check_dir(os.path.dirname(local_file))
+        status.update(transfer.download(rinex, limit=workers,
+                                        negative=negative_cache.for_prefix(prefixdir)))
+    for (local_file, s) in status.items():
+        print("  %-10s %s" % (s, local_file))
+    return status
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="list (and optionally prefetch) the inputs of a batch of PPP runs")
+    parser.add_argument("--stations", nargs="+", required=True, help="station names, e.g. MI04 MI05")
+    parser.add_argument("--start", required=True, help="first day, YYYY-MM-DD")
+    parser.add_argument("--end", help="last day, YYYY-MM-DD (default: start)")
+    parser.add_argument("--engine", choices=engines, default="gpspace")
+    parser.add_argument("--products", choices=["CODE", "IGS"], default="CODE")
+    parser.add_argument("--final", action="store_true", help="final products (default: rapid)")
+    parser.add_argument("--policy", action="store_true",
+                        help="use the default product fallback policy (CODE/IGS, final/rapid), "
+                             "resolved from the remote listings")
+    parser.add_argument("--check-remote", action="store_true", help="check remote directory listings")
+    parser.add_argument("--prefetch", action="store_true", help="download all missing inputs")
+    parser.add_argument("--workers", type=int, default=4, help="concurrent transfers per server")
+    args = parser.parse_args(argv)
+
+    prefixdir = os.getcwd()
+    known = all_stations()
+    stations = []
+    for name in args.stations:
+        if name not in known:
+            parser.error("unknown station %s, known stations: %s" % (name, " ".join(sorted(known))))
+        stations.append(known[name])
+    start = datetime.datetime.strptime(args.start, "%Y-%m-%d")
+    end = datetime.datetime.strptime(args.end, "%Y-%m-%d") if args.end else start
+    policy = igs_ftp.ProductPolicy() if args.policy else None
+
+    entries = plan(stations, date_range(start, end), engine=args.engine, rapid=not args.final,
+                   products=args.products, policy=policy, prefixdir=prefixdir,
+                   check_remote=args.check_remote or args.policy)
+    print_plan(entries)
+    if args.prefetch:
+        prefetch(entries, prefixdir, args.workers)
+    sys.stdout.flush()
+
+
+if __name__ == "__main__":
+    main()
@@ -1,10 +1,13 @@
 import os
 import datetime
-import shutil
 import subprocess
 import numpy
 
 import station
+import decompress
+import input_cache
+import rinex_prune
+import run_manifest
 import ftp_tools
 import bipm_ftp
 import igs_ftp
@@ -121,10 +124,10 @@ def run(station, dt, rapid=True, prefixdir=""):
     print("------------------------------")
     print("PPP run using RTKLib rnx2rtkp")
 
-    original_dir = prefixdir
     dt_start = datetime.datetime.utcnow()
 
     doy = dt.timetuple().tm_yday
+    igs_ftp.require_products([dt], rapid=True, products="CODE", prefixdir=prefixdir)
     rinex = station.get_rinex( dt ) # doenload rinex file
     
     # GET NAV file
@@ -146,56 +149,31 @@ def run(station, dt, rapid=True, prefixdir=""):
     run_log += "       ERP: %s\n" % erp
     print(run_log)
 
-    # we do processing in a temp directory
-    tempdir = prefixdir + "/temp/"
-    ftp_tools.check_dir( tempdir )
-    ftp_tools.delete_files(tempdir) # empty the temp directory
+    # skip the run if its inputs have not changed since the last run, see run_manifest.py
+    conf_file = prefixdir + "/common/rtklib_opts1.conf"
+    settings = {"rapid": True, "products": "CODE",
+                "staging": decompress.recipe(False, rinex_prune.profile("rtklib"))}
+    manifest = run_manifest.build(station, rtklib_tag, run_manifest.binary_version(rtklib_binary),
+                                  [rinex, clk, eph, erp], [conf_file], settings, prefixdir)
+    run_file = ppp_common.result_path(station, dt, rapid, rtklib_tag, prefixdir)
+    done = run_manifest.up_to_date(run_file, manifest)
+    if done is not None:
+        return done
+
+    # we do processing in a new directory of this run, under temp/
+    tempdir = ppp_common.run_workdir(prefixdir, station, dt, rtklib_tag)
 
     # copy files to tempdir
     
     files_to_copy = [ rinex, clk, eph, eph, erp] # , navfile 
-    copied_files = []
-    for f in files_to_copy:
-        shutil.copy2( f, tempdir )
-        (tmp,fn ) = os.path.split(f)
-        copied_files.append( tempdir + fn )
-
-    # unzip zipped files, if needed
-    for f in copied_files:
-        if f[-1] == "Z" or f[-1] == "z": # compressed .z or .Z file
-            cmd ='/bin/gunzip'
-            cmd = cmd + " -f " + f # -f overwrites existing file
-            print("unzipping: ", cmd)
-            p = subprocess.Popen(cmd, shell=True)
-            p.communicate()
+    # decompress files into tempdir. the RINEX file is pruned to GPS L1/L2, see rinex_prune.py
+    copied_files = decompress.stage_files(files_to_copy, tempdir, cache=input_cache.for_prefix(prefixdir),
+                                          prune=rinex_prune.profile("rtklib"))
 
-    # Hatanaka uncompress - if needed
-    #rinexfile = copied_files[0] # the first file is the unzipped RINEX, in the temp dir
-    if rinex[-3] == "d" or rinex[-3] == "D" or rinex[-4] == "D":
-        hata_file = copied_files[0]
-        hata_file = hata_file[:-2] # strip off ".Z"
-        if hata_file[-1] == ".":
-            hata_file = hata_file[:-1] # stip off more
-        #print "hata ", hata_file
-        cmd = "CRX2RNX " + hata_file
-        print("Hatanaka uncompress: ", cmd)
-        p = subprocess.Popen(cmd, shell=True)
-        p.communicate()
-    
-
-    # figure out the rinex file name
-    (tmp,rinexfile ) = os.path.split(rinex)
-    inputfile = rinexfile[:-2] # strip off ".Z"
-    if inputfile[-1] == ".": # ends in a dot
-        inputfile = inputfile[:-1] # strip off
-        
-    if inputfile[-1] == "d" or inputfile[-1] == "D":
-        # if hatanaka compressed, we already uncompressed, so change to "O"
-        inputfile = inputfile[:-1]+"O"
-        
-    # now ppp itself:
-    os.chdir( tempdir )
+    # the rinex file name. staging also decoded Hatanaka-compressed RINEX
+    inputfile = os.path.basename(copied_files[0])
 
+    # now ppp itself, in the run directory:
     antfile = prefixdir + "/common/igs14.atx"
     outfile = tempdir + "out.txt"
     
@@ -230,7 +208,6 @@ def run(station, dt, rapid=True, prefixdir=""):
     print("eph ", eph)
     cmd =  rtklib_binary # must have this executable in path
     
-    conf_file = prefixdir + "/common/rtklib_opts1.conf"
     options = [ " -k %s"%conf_file,
                 #" -p 7",               # mode 7:ppp-static
                 #" -t", # lat/lon/height time output
@@ -264,7 +241,9 @@ def run(station, dt, rapid=True, prefixdir=""):
     # here we may parse the output and store it to file somewhere
     ppp_result = parse_result(outfile, station)
     result_file = ppp_common.write_result_file( ppp_result=ppp_result, preamble=run_log+run_log2, rapid=rapid, tag=rtklib_tag, prefixdir=prefixdir )
-    os.chdir(original_dir) # change back to original directory
+    run_manifest.write(run_file, manifest, result_file)
+    ppp_common.finish_workdir(tempdir)
+    return result_file
     
 if __name__ == "__main__":
 
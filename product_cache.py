@@ -0,0 +1,218 @@
+"""
+    This file is part of ppp-tools, https://github.com/aewallin/ppp-tools
+    GPLv2 license.
+
+    Index of downloaded IGS/CODE products.
+
+    Products are stored as before in <prefixdir>/products/<CENTER>_<type>/
+    An SQLite index in <prefixdir>/products/cache_index.sqlite records
+    for each file the product type (rapid/final), analysis centre, day,
+    size, sha256 checksum and time of last access.
+
+    The index is used for
+    - deciding if a product needs to be downloaded (file indexed, and size matches)
+    - dropping rapid products once final products for the same day exist
+    - LRU-eviction when the cache grows beyond a size quota
+
+    Dropping and eviction are a maintenance step, maintain(), which is
+    not run when products are fetched: ppp_batch.run_batch() runs it
+    at the end of a batch, or from the command line:
+    python product_cache.py maintain
+    Files used within in_use_seconds (looked up or downloaded) may have
+    been resolved by a run that has not staged them yet, and are not deleted.
+
+    All changes to the index are made while holding an flock() on
+    <prefixdir>/products/cache.lock, so several processes on one host
+    can share the cache.
+"""
+import os
+import time
+import sqlite3
+import hashlib
+import fcntl
+import threading
+import contextlib
+
+import ftp_tools
+
+# size quota for the product cache, in bytes. None means no limit.
+cache_max_bytes = None
+# seconds since the last use of a file during which maintain() does not delete it
+in_use_seconds = 86400
+
+_thread_lock = threading.Lock()  # flock() does not exclude threads of one process
+
+
+class ProductCache():
+    """
+    On-disk index of the product files under <prefixdir>/products/
+    """
+
+    def __init__(self, products_dir):
+        self.products_dir = products_dir.rstrip("/") + "/"
+        ftp_tools.check_dir(self.products_dir)
+        self.db_file = self.products_dir + "cache_index.sqlite"
+        self.lock_file = self.products_dir + "cache.lock"
+        with self.lock():
+            with self.connect() as db:
+                db.execute("CREATE TABLE IF NOT EXISTS files ("
+                           " path TEXT PRIMARY KEY,"
+                           " kind TEXT,"  # "rapid" or "final"
+                           " center TEXT,"  # analysis centre, "CODE" or "IGS"
+                           " day TEXT,"  # YYYY-MM-DD
+                           " size INTEGER,"
+                           " sha256 TEXT,"
+                           " last_access REAL)")
+
+    @contextlib.contextmanager
+    def lock(self):
+        """
+        exclusive lock on the cache, across threads and processes
+        """
+        with _thread_lock:
+            with open(self.lock_file, "a") as f:
+                fcntl.flock(f, fcntl.LOCK_EX)
+                try:
+                    yield
+                finally:
+                    fcntl.flock(f, fcntl.LOCK_UN)
+
+    def connect(self):
+        return contextlib.closing(sqlite3.connect(self.db_file, timeout=60))
+
+    def lookup(self, path, day=None):
+        """
+        return True if path is a valid cached file.
+        The file must exist and, if it is indexed, have the indexed size.
+        Files found on disk but not in the index are added to it.
+        """
+        if not os.path.isfile(path):
+            return False
+        with self.lock():
+            with self.connect() as db:
+                row = db.execute("SELECT size FROM files WHERE path=?",
+                                 (path,)).fetchone()
+                if row is not None:
+                    if row[0] != os.path.getsize(path):
+                        print("cached file has wrong size: ", path)
+                        return False
+                    db.execute("UPDATE files SET last_access=? WHERE path=?",
+                               (time.time(), path))
+                    db.commit()
+                    return True
+        # file was downloaded before the index existed
+        self.register(path, day=day)
+        return True
+
+    def register(self, path, kind=None, center=None, day=None):
+        """
+        add a downloaded file to the index.
+        kind and center default to values parsed from the directory name,
+        e.g. products/CODE_final/
+        """
+        (center_dir, fn) = os.path.split(path)
+        (dir_center, sep, dir_kind) = os.path.basename(center_dir).partition("_")
+        kind = kind or dir_kind
+        center = center or dir_center
+        size = os.path.getsize(path)
+        sha256 = file_sha256(path)
+        with self.lock():
+            with self.connect() as db:
+                if day is None:  # keep the day of an earlier registration
+                    row = db.execute("SELECT day FROM files WHERE path=?",
+                                     (path,)).fetchone()
+                    if row is not None:
+                        day = row[0]
+                db.execute("INSERT OR REPLACE INTO files VALUES (?,?,?,?,?,?,?)",
+                           (path, kind, center, day, size, sha256, time.time()))
+                db.commit()
+
+    def remove(self, db, path):
+        print("product cache, removing ", path)
+        if os.path.isfile(path):
+            os.unlink(path)
+        db.execute("DELETE FROM files WHERE path=?", (path,))
+
+    def drop_superseded(self, keep=[]):
+        """
+        delete rapid products for days where final products from
+        the same analysis centre exist.
+        Files listed in keep, and files used within in_use_seconds,
+        are not deleted.
+        """
+        in_use = time.time() - in_use_seconds
+        with self.lock():
+            with self.connect() as db:
+                rows = db.execute("SELECT r.path FROM files r JOIN files f"
+                                  " ON r.center=f.center AND r.day=f.day"
+                                  " WHERE r.kind='rapid' AND f.kind='final'"
+                                  " AND r.day IS NOT NULL AND r.last_access < ?",
+                                  (in_use,)).fetchall()
+                for (path,) in set(rows):
+                    if path not in keep:
+                        self.remove(db, path)
+                db.commit()
+
+    def evict(self, max_bytes, keep=[]):
+        """
+        delete least-recently used files until the total size
+        is at most max_bytes.
+        Files listed in keep, and files used within in_use_seconds,
+        are not deleted.
+        """
+        in_use = time.time() - in_use_seconds
+        with self.lock():
+            with self.connect() as db:
+                total = db.execute("SELECT TOTAL(size) FROM files").fetchone()[0]
+                rows = db.execute("SELECT path, size FROM files WHERE last_access < ?"
+                                  " ORDER BY last_access", (in_use,)).fetchall()
+                for (path, size) in rows:
+                    if total <= max_bytes:
+                        break
+                    if path in keep:
+                        continue
+                    self.remove(db, path)
+                    total -= size
+                db.commit()
+        if total > max_bytes:
+            print("product cache, %d bytes in use, over the quota of %d bytes" % (total, max_bytes))
+
+    def maintain(self, keep=[]):
+        """
+        apply the cache policies: drop superseded rapid products,
+        then enforce cache_max_bytes.
+        Not run when fetching products, as other processes may be
+        about to stage the files. Files used within in_use_seconds
+        are kept.
+        """
+        self.drop_superseded(keep)
+        if cache_max_bytes is not None:
+            self.evict(cache_max_bytes, keep)
+
+    def total_size(self):
+        with self.connect() as db:
+            return int(db.execute("SELECT TOTAL(size) FROM files").fetchone()[0])
+
+
+def file_sha256(path):
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            h.update(block)
+    return h.hexdigest()
+
+
+def for_localdir(localdir):
+    """
+    return the ProductCache for a product directory,
+    e.g. <prefixdir>/products/CODE_final/ -> cache in <prefixdir>/products/
+    """
+    return ProductCache(os.path.dirname(localdir.rstrip("/")))
+
+
+if __name__ == "__main__":
+    import sys
+    cache = ProductCache(os.getcwd() + "/products/")
+    if sys.argv[1:] == ["maintain"]:
+        cache.maintain()
+    print("product cache size: %d bytes" % cache.total_size())
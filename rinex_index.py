@@ -0,0 +1,174 @@
+"""
+    This file is part of ppp-tools, https://github.com/aewallin/ppp-tools
+    GPLv2 license.
+
+    Availability index of the RINEX files of a station.
+
+    Instead of guessing a filename for each day and trying to download it,
+    the RINEX directory of the station (ftp_dir on the server, or the local
+    stations/<name>/ directory for stations without a server) is listed once.
+    Filenames are parsed back into days with Station.parse_rinex_filename().
+
+    The index is stored in <prefixdir>/stations/<name>/availability.json as
+    {"scanned": time, "files": {filename: {"day": .., "size": .., "mtime": ..}}}
+    and is updated incrementally: a scan only replaces entries that changed.
+    A file whose size or mtime changed since the last scan was re-published,
+    and a local copy of it is out of date.
+
+    For http(s) servers sizes and mtimes come from HEAD requests, which are
+    made only for new files and for days in the requested range.
+
+    command line example:
+    python rinex_index.py MI05 2024-06-01 2024-06-30
+"""
+import os
+import sys
+import json
+import time
+import datetime
+
+import ftp_tools
+import transfer
+
+# the index is listed again when it is older than this many seconds
+scan_ttl = 6*3600
+
+
+class RinexIndex():
+    """
+    days with RINEX files for one station
+    """
+
+    def __init__(self, station, prefixdir=""):
+        self.station = station
+        self.localdir = prefixdir + "/stations/" + station.name + "/"
+        self.index_file = self.localdir + "availability.json"
+        self.scanned = 0.0
+        self.files = {}  # filename -> {"day": "YYYY-MM-DD", "size": .., "mtime": ..}
+        if os.path.isfile(self.index_file):
+            with open(self.index_file) as f:
+                index = json.load(f)
+            self.scanned = index["scanned"]
+            self.files = index["files"]
+
+    def save(self):
+        ftp_tools.check_dir(os.path.dirname(self.localdir.rstrip("/")))
+        ftp_tools.check_dir(self.localdir)
+        with open(self.index_file + ".tmp", "w") as f:
+            json.dump({"station": self.station.name, "scanned": self.scanned,
+                       "files": self.files}, f, indent=1)
+        os.replace(self.index_file + ".tmp", self.index_file)
+
+    def listing(self, start=None, end=None):
+        """
+        {filename: {"size": .., "mtime": ..}} of the RINEX directory.
+        for http(s) servers, HEAD requests are made for files that are
+        new or whose day is between start and end.
+        """
+        if not self.station.ftp_server:  # local station
+            files = {}
+            if os.path.isdir(self.localdir):
+                for entry in os.scandir(self.localdir):
+                    if entry.is_file():
+                        st = entry.stat()
+                        files[entry.name] = {"size": st.st_size, "mtime": "%.0f" % st.st_mtime}
+            return files
+
+        def wanted(fn):
+            dt = self.station.parse_rinex_filename(fn)
+            if dt is None:
+                return False
+            if fn not in self.files:
+                return True
+            return (start is None or dt >= start) and (end is None or dt <= end)
+        return transfer.listing_details(self.station.rinex_dir_url(), wanted)
+
+    def scan(self, start=None, end=None, force=False):
+        """
+        update the index from a listing of the RINEX directory, unless
+        the index is younger than scan_ttl.
+        Returns the list of re-published files, i.e. files whose size
+        or mtime changed since the previous scan.
+        """
+        if not force and time.time() - self.scanned < scan_ttl:
+            return []
+        print("scanning RINEX directory of ", self.station.name)
+        changed = []
+        files = {}
+        for (fn, details) in self.listing(start, end).items():
+            dt = self.station.parse_rinex_filename(fn)
+            if dt is None:
+                continue
+            old = self.files.get(fn)
+            if old is not None:
+                if details["size"] is None and details["mtime"] is None:
+                    details = old  # not checked in this scan, keep what we know
+                elif (old["size"], old["mtime"]) != (details["size"], details["mtime"]):
+                    changed.append(fn)
+            files[fn] = {"day": dt.strftime("%Y-%m-%d"), "size": details["size"],
+                         "mtime": details["mtime"]}
+        self.files = files
+        self.scanned = time.time()
+        self.save()
+        for fn in changed:
+            print("re-published RINEX file: ", fn)
+        return changed
+
+    def days(self, start=None, end=None):
+        """
+        sorted list of the days, as datetimes, with a RINEX file
+        """
+        days = set()
+        for entry in self.files.values():
+            dt = datetime.datetime.strptime(entry["day"], "%Y-%m-%d")
+            if (start is None or dt >= start) and (end is None or dt <= end):
+                days.add(dt)
+        return sorted(days)
+
+    def available(self, dt):
+        return self.station.rinex_filename(dt) in self.files
+
+    def size(self, dt):
+        entry = self.files.get(self.station.rinex_filename(dt))
+        return entry["size"] if entry else None
+
+    def stale_local_files(self):
+        """
+        local RINEX files whose size differs from the file on the server,
+        e.g. because the file was re-published after we downloaded it
+        """
+        if not self.station.ftp_server:
+            return []
+        stale = []
+        for (fn, entry) in sorted(self.files.items()):
+            local_file = self.localdir + fn
+            if (entry["size"] is not None and os.path.isfile(local_file) and
+                    os.path.getsize(local_file) != entry["size"]):
+                stale.append(local_file)
+        return stale
+
+
+def available_days(station, start, end, prefixdir=""):
+    """
+    days between start and end with a RINEX file for station,
+    from an up to date RinexIndex
+    """
+    index = RinexIndex(station, prefixdir)
+    index.scan(start, end)
+    return index.days(start, end)
+
+
+if __name__ == "__main__":
+    import station
+    known = {s.name: s for s in vars(station).values() if isinstance(s, station.Station)}
+    s = known[sys.argv[1]]
+    start = datetime.datetime.strptime(sys.argv[2], "%Y-%m-%d")
+    end = datetime.datetime.strptime(sys.argv[3], "%Y-%m-%d")
+    index = RinexIndex(s, os.getcwd())
+    index.scan(start, end, force=True)
+    days = index.days(start, end)
+    print("%s: %d days with RINEX between %s and %s" % (s.name, len(days), sys.argv[2], sys.argv[3]))
+    for dt in days:
+        print("  %s %s %s" % (dt.strftime("%Y-%m-%d"), s.rinex_filename(dt), index.size(dt)))
+    for f in index.stale_local_files():
+        print("out of date: ", f)
@@ -0,0 +1,221 @@
+"""
+    This file is part of ppp-tools, https://github.com/aewallin/ppp-tools
+    GPLv2 license.
+
+    Decimation and signal pruning of RINEX observation files.
+
+    The PPP engines use only part of a RINEX file. Stations with 1 s or
+    10 s multi-GNSS files make an engine parse many times the data it uses.
+
+    pruned_lines() is a pre-stage, chained into decompress.stage() and
+    rinex_splice.splice() with prune=<profile>. A profile keeps
+    - epochs at multiples of interval seconds (of the day), or all
+      epochs when interval is None
+    - satellites of the systems in systems
+    - RINEX 2 observation types in v2_types, and RINEX 3 observation
+      codes whose type (C, L, D or S) is in v3_kinds and whose
+      frequency band is in v3_bands
+    Event epochs (flags 2-5) are kept.
+
+    Each engine has its own profile, taken from its configuration, so
+    only data the engine would not use is dropped:
+    - gLAB decimates to 30 s (-pre:dec 30) and uses GPS L1/L2 (-pre:availf G12)
+    - RTKLib uses GPS (navsys=1) L1+L2 (frequency=l1+l2), at the full rate
+      of the file, see common/rtklib_opts1.conf
+    GPSPACE has no profile: its CMD file sets no interval and no systems,
+    so its files are staged in full.
+    Set enabled = False to stage the full files for all engines.
+
+    command line example, with the gLAB profile:
+    python rinex_prune.py MI050040.21o MI050040.21o_pruned glab
+"""
+import os
+import sys
+
+import rinex_splice
+import rnx3to2
+
+enabled = True  # used by the runners, prune=rinex_prune.profile(engine)
+tolerance = 0.1  # seconds, for epoch times that are not exact multiples of interval
+
+# interval in seconds (None keeps all epochs), systems (None keeps all systems),
+# RINEX 2 types kept, RINEX 3 types (C, L, D, S) and frequency bands kept
+profiles = {
+    "glab": {"interval": 30.0, "systems": "G",  # -pre:dec 30 -pre:availf G12
+             "v2_types": ["C1", "P1", "L1", "C2", "P2", "L2"], "v3_kinds": "CL", "v3_bands": "12"},
+    "rtklib": {"interval": None, "systems": "G",  # navsys=1, frequency=l1+l2
+               "v2_types": ["C1", "P1", "L1", "C2", "P2", "L2"], "v3_kinds": "CL", "v3_bands": "12"},
+}
+
+
+def profile(engine):
+    """
+    the pruning profile of engine, or None if its files are staged in full
+    """
+    if not enabled:
+        return None
+    return profiles.get(engine)
+
+
+def recipe(prof):
+    """
+    string describing the pruning profile prof, for input_cache keys
+    """
+    return "prune:%s:%s:%s:%s:%s" % (prof["interval"], prof["systems"], ",".join(prof["v2_types"]),
+                                     prof["v3_kinds"], prof["v3_bands"])
+
+
+def kept_types(types, version, prof):
+    """
+    the observation types kept, {system: [types]}
+    """
+    kept = {}
+    for (system, t) in types.items():
+        if version < 3:
+            kept[system] = [x for x in t if x in prof["v2_types"]]
+        elif prof["systems"] is None or system in prof["systems"]:
+            codes = [x for x in t if x[0] in prof["v3_kinds"] and x[1] in prof["v3_bands"]]
+            if codes:
+                kept[system] = codes
+    return kept
+
+
+def keep_epoch(time, prof):
+    interval = prof["interval"]
+    if interval is None or time is None:
+        return True
+    sod = time.hour*3600 + time.minute*60 + time.second + time.microsecond*1e-6
+    return abs(sod - round(sod/interval)*interval) < tolerance
+
+
+def keep_satellite(sat, prof):
+    if prof["systems"] is None:
+        return True
+    return (sat[0] if sat[0] != " " else "G") in prof["systems"]
+
+
+def prune_header(source, kept, prof):
+    """
+    header lines of the pruned file
+    """
+    interval = prof["interval"]
+    types_label = "# / TYPES OF OBSERV" if source.version < 3 else "SYS / # / OBS TYPES"
+    lines = []
+    types_written = False
+    for line in source.header:
+        label = rinex_splice.header_label(line)
+        if label == types_label:
+            if not types_written:
+                lines.extend(rinex_splice.types_header(kept, source.version))
+                types_written = True
+        elif label == "INTERVAL" and interval is not None:
+            if float(line[:10]) < interval:
+                line = rnx3to2.header("%10.3f" % interval, "INTERVAL")
+            lines.append(line)
+        elif label in ("SYS / PHASE SHIFT", "SYS / SCALE FACTOR", "SYS / DCBS APPLIED",
+                       "SYS / PCVS APPLIED"):
+            if line[0] == " " or line[0] in kept:
+                lines.append(line)
+        elif label == "END OF HEADER":
+            rate = "interval %s s" % interval if interval is not None else "all epochs"
+            lines.append(rnx3to2.header("pruned: %s, systems %s" % (rate, prof["systems"]), "COMMENT"))
+            lines.append(line)
+        elif label not in rinex_splice.dropped_labels:
+            lines.append(line)
+    return lines
+
+
+def pick(data, columns, n):
+    """
+    the 16-character fields at columns of the observation data string data
+    """
+    fields = []
+    for c in columns:
+        start = 16*c
+        fields.append(data[start:start+16].ljust(16) if start < n else " "*16)
+    return fields
+
+
+def pruned_lines(lines, prof, name=""):
+    """
+    generator of the lines of the RINEX file pruned with profile prof,
+    from an iterator over the lines of a RINEX observation file
+    """
+    source = rinex_splice.Source(name, lines)
+    kept = kept_types(source.types, source.version, prof)
+    columns = {system: [source.types[system].index(t) for t in kept[system]] for system in kept}
+    yield from prune_header(source, kept, prof)
+    for (time, epoch, records) in source.epochs():
+        if time is None:  # event
+            yield from epoch
+            continue
+        if not keep_epoch(time, prof):
+            continue
+        if source.version < 3:
+            sat_list = "".join(line[32:68] for line in epoch)
+            nsat = len(records)
+            sats = [sat_list[3*i:3*i+3] for i in range(nsat)]
+            cols = columns.get(" ", [])
+            out = []
+            for (sat, (system, rows)) in zip(sats, records):
+                if not keep_satellite(sat, prof):
+                    continue
+                data = "".join(row.ljust(80) for row in rows)
+                fields = pick(data, cols, len(data))
+                if all(f[:14].isspace() for f in fields):
+                    continue
+                out.append((sat, ["".join(fields[i:i+5]).rstrip()
+                                  for i in range(0, max(len(fields), 1), 5)]))
+            if not out:
+                continue
+            head = epoch[0][:29] + "%3d" % len(out)
+            names = [sat for (sat, rows) in out]
+            for i in range(0, max(len(names), 1), 12):
+                if i == 0:
+                    line = head + "".join(names[0:12])
+                    clock = epoch[0][68:80]
+                    if clock.strip():
+                        line = line.ljust(68) + clock
+                    yield line.rstrip()
+                else:
+                    yield " "*32 + "".join(names[i:i+12])
+            for (sat, rows) in out:
+                yield from rows
+        else:
+            out = []
+            for (system, rows) in records:
+                if system not in columns:
+                    continue
+                data = rows[0][3:]
+                fields = pick(data, columns[system], len(data))
+                if all(f[:14].isspace() for f in fields):
+                    continue
+                out.append((rows[0][:3] + "".join(fields)).rstrip())
+            if not out:
+                continue
+            yield (epoch[0][:32] + "%3d" % len(out) + epoch[0][35:]).rstrip()
+            yield from out
+
+
+def prune_file(rnx_file, pruned_file, prof):
+    """
+    write a copy of rnx_file, pruned with profile prof, to pruned_file
+    """
+    print("pruning: ", rnx_file, " -> ", pruned_file)
+    part = pruned_file + ".part"
+    try:
+        with open(rnx_file, "rb") as fin:
+            with open(part, "wb") as fout:
+                lines = (line.decode("latin-1").rstrip("\r\n") for line in fin)
+                rnx3to2.write_lines(pruned_lines(lines, prof, rnx_file), fout)
+    except Exception:
+        os.unlink(part)
+        raise
+    os.replace(part, pruned_file)
+    return pruned_file
+
+
+if __name__ == "__main__":
+    before = os.path.getsize(sys.argv[1])
+    prune_file(sys.argv[1], sys.argv[2], profiles[sys.argv[3] if len(sys.argv) > 3 else "glab"])
+    print("%d -> %d bytes" % (before, os.path.getsize(sys.argv[2])))
@@ -0,0 +1,288 @@
+"""
+    This file is part of ppp-tools, https://github.com/aewallin/ppp-tools
+    GPLv2 license.
+
+    Native splicer for consecutive daily RINEX observation files.
+
+    Replaces staging each day into temp/ (decompress, CRX2RNX) and then
+    running gfzrnx -finp ... -fout splice.rnx, where every byte was
+    written three or four times. Here the daily files are read as line
+    streams from decompress.rinex_lines(), which decompresses, decodes
+    Hatanaka compression and optionally converts RINEX 3 to 2, and the
+    spliced file is the only file written.
+
+    - the header is the header of the first file, with the observation
+      types of all files and TIME OF LAST OBS of the last file.
+      INTERVAL is kept if all files agree on it.
+    - files with other observation types than the spliced file are
+      rewritten to its types, with blanks for types they do not have.
+    - epochs that are not later than the last epoch written, e.g. the
+      midnight epoch repeated at the start of the next file, are dropped.
+
+    command line example:
+    python rinex_splice.py splice.rnx MI050040.21d.gz MI050050.21d.gz
+"""
+import os
+import sys
+import datetime
+
+import decompress
+import rnx3to2
+
+# header records that describe single files, and are dropped from the splice
+dropped_labels = {"PRN / # OF OBS", "# OF SATELLITES"}
+
+
+def header_label(line):
+    return line[60:].rstrip()
+
+
+def obs_types(header, version):
+    """
+    observation types of a RINEX header, as {system: [types]}.
+    RINEX 2 types are the same for all systems, and stored under " ".
+    """
+    types = {}
+    system = " "
+    for line in header:
+        label = header_label(line)
+        if version < 3 and label == "# / TYPES OF OBSERV":
+            types.setdefault(" ", []).extend(line[6:60].split())
+        elif version >= 3 and label == "SYS / # / OBS TYPES":
+            if line[0] != " ":
+                system = line[0]
+                types[system] = []
+            types[system].extend(line[7:60].split())
+    return types
+
+
+def types_header(types, version):
+    """
+    the header lines listing observation types {system: [types]}
+    """
+    lines = []
+    if version < 3:
+        t = types.get(" ", [])
+        for i in range(0, max(len(t), 1), 9):
+            text = ("%6d" % len(t)) if i == 0 else " "*6
+            lines.append(rnx3to2.header(text + "".join("%6s" % x for x in t[i:i+9]),
+                                        "# / TYPES OF OBSERV"))
+        return lines
+    for (system, t) in types.items():
+        for i in range(0, max(len(t), 1), 13):
+            text = ("%s  %3d" % (system, len(t))) if i == 0 else " "*6
+            lines.append(rnx3to2.header(text + "".join(" %3s" % x for x in t[i:i+13]),
+                                        "SYS / # / OBS TYPES"))
+    return lines
+
+
+def epoch_time(text, version):
+    """
+    datetime of the date/time field of an epoch line, or None if blank
+    """
+    if not text.strip():
+        return None
+    f = text.split()
+    year = int(f[0])
+    if version < 3:
+        year += 2000 if year < 80 else 1900
+    return (datetime.datetime(year, int(f[1]), int(f[2]), int(f[3]), int(f[4])) +
+            datetime.timedelta(seconds=float(f[5])))
+
+
+class Source():
+    """
+    one daily file: its header, and an iterator over its remaining lines
+    """
+
+    def __init__(self, name, lines):
+        self.name = name
+        self.lines = lines
+        self.header = []
+        for line in lines:
+            self.header.append(line)
+            if header_label(line) == "END OF HEADER":
+                break
+        if not self.header or header_label(self.header[0]) != "RINEX VERSION / TYPE":
+            raise ValueError("not a RINEX file: %s" % name)
+        self.version = int(float(self.header[0][:9]))
+        self.types = obs_types(self.header, self.version)
+        self.last_epoch = None  # time of the last epoch written, see body_lines()
+
+    def label(self, label):
+        """
+        the last header line with label, or None
+        """
+        found = [line for line in self.header if header_label(line) == label]
+        return found[-1] if found else None
+
+    def epochs(self):
+        """
+        generator of (time, epoch lines, records) for each epoch.
+        records is a list of (system, observation lines) per satellite.
+        time is None for event epochs, whose special records are in epoch lines.
+        """
+        lines = self.lines
+        if self.version < 3:
+            nrows = (len(self.types.get(" ", [])) + 4) // 5
+            for line in lines:
+                if not line.strip():
+                    continue
+                (flag, nsat) = (line[28:29], int(line[29:32]))
+                if flag in "2345":
+                    yield (None, [line] + [next(lines) for n in range(nsat)], [])
+                    continue
+                epoch = [line] + [next(lines) for n in range((nsat - 1) // 12)]
+                records = [(" ", [next(lines) for r in range(nrows)]) for n in range(nsat)]
+                yield (epoch_time(line[1:26], 2), epoch, records)
+        else:
+            for line in lines:
+                if not line.strip():
+                    continue
+                (flag, nsat) = (line[31:32], int(line[32:35]))
+                if flag in "2345":
+                    yield (None, [line] + [next(lines) for n in range(nsat)], [])
+                    continue
+                records = []
+                for n in range(nsat):
+                    record = next(lines)
+                    records.append((record[0], [record]))
+                yield (epoch_time(line[2:29], 3), [line], records)
+
+
+def merge_header(sources, types):
+    """
+    the header of the spliced file
+    """
+    first = sources[0]
+    intervals = set(s.label("INTERVAL") for s in sources)
+    last_obs = sources[-1].label("TIME OF LAST OBS")
+    types_label = "# / TYPES OF OBSERV" if first.version < 3 else "SYS / # / OBS TYPES"
+    lines = []
+    types_written = False
+    for line in first.header:
+        label = header_label(line)
+        if label == types_label:
+            if not types_written:
+                lines.extend(types_header(types, first.version))
+                types_written = True
+        elif label == "TIME OF LAST OBS":
+            if last_obs is not None:
+                lines.append(last_obs)
+        elif label == "INTERVAL":
+            if len(intervals) == 1:
+                lines.append(line)
+        elif label == "END OF HEADER":
+            lines.append(rnx3to2.header("spliced from %d files" % len(sources), "COMMENT"))
+            lines.append(line)
+        elif label not in dropped_labels:
+            lines.append(line)
+    return lines
+
+
+def remap(records, source_types, types, version):
+    """
+    rewrite observation records from source_types to types,
+    with blank fields for types that the source does not have
+    """
+    out = []
+    for (system, lines) in records:
+        have = source_types.get(system, [])
+        want = types.get(system, [])
+        if version < 3:
+            data = "".join(line.ljust(80) for line in lines)
+        else:
+            data = lines[0][3:]
+        fields = []
+        for t in want:
+            if t in have:
+                i = have.index(t)
+                fields.append(data[16*i:16*i+16].ljust(16))
+            else:
+                fields.append(" "*16)
+        if version < 3:
+            rows = ["".join(fields[i:i+5]).rstrip() for i in range(0, max(len(fields), 1), 5)]
+        else:
+            rows = [(lines[0][:3] + "".join(fields)).rstrip()]
+        out.append((system, rows))
+    return out
+
+
+def merged_types(sources):
+    """
+    the observation types of all sources, {system: [types]} in order of appearance
+    """
+    types = {}
+    for s in sources:
+        for (system, t) in s.types.items():
+            merged = types.setdefault(system, [])
+            merged.extend(x for x in t if x not in merged)
+    return types
+
+
+def body_lines(source, types, last=None):
+    """
+    generator of the epoch lines of source, with observations for types.
+    epochs not later than last are dropped.
+    """
+    same_types = all(source.types.get(system) == t for (system, t) in types.items()
+                     if system in source.types)
+    dropped = 0
+    for (time, epoch, records) in source.epochs():
+        if time is not None:
+            if last is not None and time <= last:
+                dropped += 1
+                continue
+            source.last_epoch = time
+        if not same_types:
+            records = remap(records, source.types, types, source.version)
+        yield from epoch
+        for (system, lines) in records:
+            yield from lines
+    if dropped:
+        print("splice: dropped %d epochs of %s already written" % (dropped, source.name))
+
+
+def splice_lines(sources):
+    """
+    generator of the lines of the spliced file, from a list of Source objects
+    """
+    version = sources[0].version
+    if any(s.version != version for s in sources):
+        raise ValueError("cannot splice RINEX files of different versions: %s" %
+                         ", ".join("%s %d" % (s.name, s.version) for s in sources))
+    types = merged_types(sources)
+    yield from merge_header(sources, types)
+    last = None
+    for s in sources:
+        yield from body_lines(s, types, last)
+        if s.last_epoch is not None:
+            last = s.last_epoch
+
+
+def splice(files, spliced_file, rinex2=False, cache=None, prune=None):
+    """
+    splice the (compressed) daily RINEX files into spliced_file.
+    With a prune profile, the files are decimated and pruned on the fly, see rinex_prune.py
+    With rinex2, RINEX 3 files are converted to RINEX 2 on the fly.
+    With an input_cache.InputCache, days that are staged already are read from the cache.
+    Returns spliced_file.
+    """
+    print("splicing ", len(files), " files into ", spliced_file)
+    sources = [Source(f, decompress.rinex_lines(f, rinex2, cache, prune)) for f in files]
+    part = spliced_file + ".part"
+    try:
+        with open(part, "wb") as fout:
+            rnx3to2.write_lines(splice_lines(sources), fout)
+    except Exception:
+        os.unlink(part)
+        raise
+    finally:
+        for s in sources:
+            s.lines.close()
+    os.replace(part, spliced_file)
+    return spliced_file
+
+
+if __name__ == "__main__":
+    splice(sys.argv[2:], sys.argv[1])
@@ -0,0 +1,301 @@
+"""
+    This file is part of ppp-tools, https://github.com/aewallin/ppp-tools
+    GPLv2 license.
+
+    Streaming RINEX 3 to RINEX 2.11 observation file converter.
+
+    GPSPACE reads RINEX 2 only. Instead of running gfzrnx --version_out 2
+    on the decompressed RINEX 3 file, the RINEX 3 lines are converted as
+    they are decompressed (and Hatanaka-decoded), in the same pass, see
+    decompress.stage().
+
+    Only the satellite systems in systems, and the RINEX 2 observation
+    types in v2_types are written. Each RINEX 2 type is taken from the
+    first RINEX 3 observation code in the priority table that the file
+    header lists for the satellite system, e.g. P2 from C2W, C2P, C2Y
+    or C2D for GPS. Satellites with none of the selected observations
+    in an epoch are left out.
+
+    RINEX 2 files are passed through unchanged.
+
+    command line example:
+    python rnx3to2.py MI050040.21o MI050040.21o_v2
+"""
+import os
+import sys
+import itertools
+
+systems = "GR"  # satellite systems to keep
+v2_types = ["C1", "P1", "L1", "C2", "P2", "L2"]  # RINEX 2 observation types to write
+
+# RINEX 2 type -> RINEX 3 codes in order of preference, by satellite system
+priority = {
+    "G": {"C1": ["C1C"], "P1": ["C1W", "C1P", "C1Y"],
+          "L1": ["L1C", "L1W", "L1P", "L1Y", "L1X", "L1L", "L1S"],
+          "D1": ["D1C", "D1W", "D1P", "D1Y", "D1X"],
+          "S1": ["S1C", "S1W", "S1P", "S1Y", "S1X"],
+          "C2": ["C2C", "C2L", "C2X", "C2S"], "P2": ["C2W", "C2P", "C2Y", "C2D"],
+          "L2": ["L2W", "L2P", "L2Y", "L2D", "L2L", "L2X", "L2S", "L2C"],
+          "D2": ["D2W", "D2P", "D2Y", "D2D", "D2L", "D2X", "D2S", "D2C"],
+          "S2": ["S2W", "S2P", "S2Y", "S2D", "S2L", "S2X", "S2S", "S2C"],
+          "C5": ["C5Q", "C5X", "C5I"], "L5": ["L5Q", "L5X", "L5I"],
+          "D5": ["D5Q", "D5X", "D5I"], "S5": ["S5Q", "S5X", "S5I"]},
+    "R": {"C1": ["C1C"], "P1": ["C1P"], "L1": ["L1C", "L1P"], "D1": ["D1C", "D1P"],
+          "S1": ["S1C", "S1P"], "C2": ["C2C"], "P2": ["C2P"], "L2": ["L2P", "L2C"],
+          "D2": ["D2P", "D2C"], "S2": ["S2P", "S2C"]},
+    "E": {"C1": ["C1C", "C1X", "C1B"], "L1": ["L1C", "L1X", "L1B"], "D1": ["D1C", "D1X", "D1B"],
+          "S1": ["S1C", "S1X", "S1B"],
+          "C5": ["C5Q", "C5X", "C5I"], "L5": ["L5Q", "L5X", "L5I"],
+          "D5": ["D5Q", "D5X", "D5I"], "S5": ["S5Q", "S5X", "S5I"],
+          "C7": ["C7Q", "C7X", "C7I"], "L7": ["L7Q", "L7X", "L7I"],
+          "D7": ["D7Q", "D7X", "D7I"], "S7": ["S7Q", "S7X", "S7I"],
+          "C8": ["C8Q", "C8X", "C8I"], "L8": ["L8Q", "L8X", "L8I"],
+          "D8": ["D8Q", "D8X", "D8I"], "S8": ["S8Q", "S8X", "S8I"],
+          "C6": ["C6C", "C6X", "C6B"], "L6": ["L6C", "L6X", "L6B"],
+          "D6": ["D6C", "D6X", "D6B"], "S6": ["S6C", "S6X", "S6B"]},
+}
+
+system_names = {"G": "G (GPS)", "R": "R (GLONASS)", "E": "E (GALILEO)", "S": "S (GEO)"}
+
+# header records that exist in RINEX 2.11. Other (RINEX 3 only) records are dropped.
+v2_labels = {"PGM / RUN BY / DATE", "COMMENT", "MARKER NAME", "MARKER NUMBER",
+             "OBSERVER / AGENCY", "REC # / TYPE / VERS", "ANT # / TYPE",
+             "APPROX POSITION XYZ", "ANTENNA: DELTA H/E/N", "INTERVAL",
+             "TIME OF FIRST OBS", "TIME OF LAST OBS", "RCV CLOCK OFFS APPL",
+             "LEAP SECONDS"}
+
+
+def recipe():
+    """
+    string describing the conversion settings, for input_cache keys
+    """
+    return "rinex2:%s:%s" % (systems, ",".join(v2_types))
+
+
+def header(text, label):
+    return "%-60s%-20s" % (text, label)
+
+
+class Converter():
+    """
+    converts RINEX 3 observation lines, given one at a time to line(),
+    calling write(line) for each RINEX 2 output line.
+    """
+
+    def __init__(self, write):
+        self.write = write
+        self.line = self.first_line
+        self.header = []  # RINEX 3 header lines, until END OF HEADER
+        self.system = None  # system of the SYS / # / OBS TYPES record being read
+        self.obs_types = {}  # system -> list of RINEX 3 observation codes
+        self.columns = {}  # system -> RINEX 3 field index, or None, for each type in self.types
+        self.types = []  # RINEX 2 observation types written
+        self.special = 0  # special records (event epochs) still to copy
+        self.epoch = None  # the current epoch: (epoch line without satellites, clock, nsat)
+        self.records = []  # (satellite, RINEX 2 observation lines) of the current epoch
+
+    def first_line(self, line):
+        if line[60:].rstrip() != "RINEX VERSION / TYPE":
+            raise ValueError("not a RINEX file")
+        if float(line[:9]) < 3 or line[20] != "O":  # RINEX 2, or not observations
+            self.line = self.write
+        else:
+            self.line = self.header_line
+            self.header.append(line)
+
+    def header_line(self, line):
+        label = line[60:].rstrip()
+        if label == "SYS / # / OBS TYPES":
+            if line[0] != " ":
+                self.system = line[0]
+                self.obs_types[self.system] = []
+            codes = line[7:60].split()
+            self.obs_types[self.system].extend(codes)
+        if label != "END OF HEADER":
+            self.header.append(line)
+            return
+        self.select()
+        for l in self.v2_header():
+            self.write(l)
+        self.line = self.data_line
+
+    def select(self):
+        """
+        choose, for each system, the RINEX 3 code of each RINEX 2 type
+        """
+        used = set()
+        for s in systems:
+            if s not in self.obs_types:
+                continue
+            index = {code: i for (i, code) in enumerate(self.obs_types[s])}
+            self.columns[s] = []
+            for t in v2_types:
+                codes = [c for c in priority.get(s, {}).get(t, []) if c in index]
+                self.columns[s].append(index[codes[0]] if codes else None)
+                if codes:
+                    used.add(t)
+        self.types = [t for t in v2_types if t in used]
+        # drop types no system has, keeping the order of v2_types
+        keep = [i for (i, t) in enumerate(v2_types) if t in used]
+        for s in self.columns:
+            self.columns[s] = [self.columns[s][i] for i in keep]
+        for s in list(self.columns):
+            if all(c is None for c in self.columns[s]):
+                del self.columns[s]
+
+    def v2_header(self):
+        kept = [s for s in systems if s in self.columns]
+        if len(kept) == 1:
+            sysname = system_names.get(kept[0], kept[0])
+        else:
+            sysname = "M (MIXED)"
+        lines = [header("%9.2f%11s%-20s%-20s" % (2.11, "", "OBSERVATION DATA", sysname),
+                        "RINEX VERSION / TYPE")]
+        types_written = False
+        for line in self.header[1:]:
+            label = line[60:].rstrip()
+            if label == "SYS / # / OBS TYPES" and not types_written:
+                lines.append(header("%6d%6d" % (1, 1), "WAVELENGTH FACT L1/2"))
+                for i in range(0, max(len(self.types), 1), 9):
+                    text = ("%6d" % len(self.types)) if i == 0 else " "*6
+                    text += "".join("%6s" % t for t in self.types[i:i+9])
+                    lines.append(header(text, "# / TYPES OF OBSERV"))
+                types_written = True
+            elif label == "LEAP SECONDS":
+                lines.append(header(line[:6], label))
+            elif label in v2_labels:
+                lines.append(line)
+        lines.append(header("converted from RINEX %s, systems %s" % (self.header[0][:9].strip(), "".join(kept)),
+                            "COMMENT"))
+        lines.append(header("", "END OF HEADER"))
+        return lines
+
+    def data_line(self, line):
+        if self.special:  # event record, e.g. a header line
+            self.special -= 1
+            label = line[60:].rstrip()
+            if label in v2_labels or label == "":
+                self.write(line)
+            return
+        if line[:1] == ">":
+            self.flush()
+            flag = line[31]
+            nsat = int(line[32:35])
+            date = line[2:29]
+            if date.strip():
+                date = " %02d %2d %2d %2d %2d%s" % (int(line[4:6]), int(line[7:9]), int(line[10:12]),
+                                                   int(line[13:15]), int(line[16:18]), line[18:29])
+            else:
+                date = " "*26
+            if flag in "2345":  # special records follow
+                self.write("%s  %s%3d" % (date, flag, nsat))
+                self.special = nsat
+                return
+            clock = line[41:56].strip()
+            self.epoch = ("%s  %s" % (date, flag), clock)
+            return
+        columns = self.columns.get(line[0])
+        if columns is None or self.epoch is None:  # satellite system not selected
+            return
+        fields = []
+        n = len(line)
+        for c in columns:
+            if c is None:
+                fields.append(" "*16)
+            else:
+                start = 3 + 16*c
+                f = line[start:start+16] if start < n else ""
+                fields.append(f.ljust(16))
+        if all(f[:14].isspace() for f in fields):
+            return
+        rows = ["".join(fields[i:i+5]).rstrip() for i in range(0, len(fields), 5)]
+        self.records.append((line[:3].replace(" ", "0"), rows))
+
+    def flush(self):
+        """
+        write the epoch collected so far
+        """
+        if self.epoch is None:
+            return
+        (head, clock) = self.epoch
+        sats = [sat for (sat, rows) in self.records]
+        for i in range(0, max(len(sats), 1), 12):
+            if i == 0:
+                line = "%s%3d%s" % (head, len(sats), "".join(sats[0:12]))
+                if clock:
+                    line = line.ljust(68) + "%12.9f" % float(clock)
+                self.write(line)
+            else:
+                self.write(" "*32 + "".join(sats[i:i+12]))
+        for (sat, rows) in self.records:
+            for row in rows:
+                self.write(row)
+        self.epoch = None
+        self.records = []
+
+    def close(self):
+        self.flush()
+
+
+def rinex2_lines(lines):
+    """
+    generator of RINEX 2 lines, from an iterator over RINEX 3 lines (without newline)
+    """
+    out = []
+    converter = Converter(out.append)
+    for line in lines:
+        converter.line(line)
+        if out:
+            yield from out
+            del out[:]
+    converter.close()
+    yield from out
+
+
+def write_lines(lines, fout):
+    """
+    write an iterator over lines to the binary file object fout, in blocks
+    """
+    while True:
+        block = list(itertools.islice(lines, 4096))
+        if not block:
+            break
+        fout.write(("\n".join(block) + "\n").encode("latin-1"))
+
+
+def convert(fin, fout):
+    """
+    convert RINEX 3 from binary file object fin to RINEX 2 in fout
+    """
+    lines = (line.decode("latin-1").rstrip("\r\n") for line in fin)
+    write_lines(rinex2_lines(lines), fout)
+
+
+def convert_file(rnx3_file, rnx2_file):
+    """
+    convert the file rnx3_file to RINEX 2, written as rnx2_file.
+    rnx3_file and rnx2_file may be the same file.
+    """
+    print("RINEX 3 to 2: ", rnx3_file, " -> ", rnx2_file)
+    part = rnx2_file + ".part"
+    try:
+        with open(rnx3_file, "rb") as fin:
+            with open(part, "wb") as fout:
+                convert(fin, fout)
+    except Exception:
+        os.unlink(part)
+        raise
+    os.replace(part, rnx2_file)
+    return rnx2_file
+
+
+def is_obs_name(fn):
+    """
+    True for RINEX observation filenames, e.g. MI050040.21o or ..._MO.rnx
+    """
+    return (fn.endswith("O.rnx") or fn.endswith("O.RNX") or
+            (len(fn) > 4 and fn[-4] == "." and fn[-3:-1].isdigit() and fn[-1] in "oO"))
+
+
+if __name__ == "__main__":
+    convert_file(sys.argv[1], sys.argv[2])
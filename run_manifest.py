@@ -0,0 +1,122 @@
+"""
+    This file is part of ppp-tools, https://github.com/aewallin/ppp-tools
+    GPLv2 license.
+
+    Input manifests of PPP runs, to skip runs that are up to date.
+
+    Each run writes a manifest next to its result file,
+    e.g. results/MI04/MI04.60310.final.gpspace.manifest.json
+    named after the day of the run (ppp_common.result_path()). It has
+    the name of the result file, the sha256 of every input file (RINEX,
+    products) and configuration file (ANTEX, OLC, CMD, ...), the engine
+    version (for gLAB and RTKLib the sha256 of the executable, see
+    binary_version()), the staging settings (pruning, RINEX 3 to 2) and the
+    calibration delays of the station.
+
+    Before running, a runner builds the manifest of the run it is about
+    to do. If the result file exists and its manifest is the same, the
+    run is skipped. A re-published RINEX file, new products, or a
+    changed configuration file or delay makes the manifests differ, and
+    the run is done again. A final result has its own result file, so
+    a day processed with rapid products is run again when final
+    products are used. The rapid result is kept.
+
+    Set skip_up_to_date = False to run everything again.
+"""
+import os
+import json
+import time
+import shutil
+
+import input_cache
+
+skip_up_to_date = True
+skipped = []  # result files of the runs up_to_date() skipped, in this process
+
+delay_names = ["ref_dly", "cab_dly", "int_dly_p1", "int_dly_p2"]
+
+
+def manifest_file(result_file):
+    if result_file.endswith(".txt"):
+        result_file = result_file[:-4]
+    return result_file + ".manifest.json"
+
+
+def binary_version(binary):
+    """
+    version of the executable binary, found in the path, for manifests:
+    its name and the sha256 of its contents, so installing another
+    version of the program makes runs out of date.
+    """
+    path = shutil.which(binary)
+    if path is None:
+        return "%s (not found)" % binary
+    return "%s sha256:%s" % (binary, input_cache.source_hash(os.path.realpath(path)))
+
+
+def build(station, engine, version, inputs, config, settings, prefixdir=""):
+    """
+    the manifest of a run, as a dict.
+    inputs and config are lists of filenames, settings a dict of
+    other values that change the result, e.g. rapid and num_days.
+    Filenames are stored relative to prefixdir.
+    """
+    def hashes(files):
+        return {f[len(prefixdir):] if f.startswith(prefixdir) else f: input_cache.source_hash(f)
+                for f in files}
+    return {"engine": engine,
+            "version": version,
+            "station": dict([("name", station.name), ("receiver", station.receiver),
+                             ("antex", station.antex), ("rinex3", station.rinex3)] +
+                            [(d, getattr(station, d)) for d in delay_names]),
+            "settings": settings,
+            "inputs": hashes(inputs),
+            "config": hashes(config)}
+
+
+def read(run_file):
+    """
+    the manifest of the run with result path run_file, or None
+    """
+    try:
+        with open(manifest_file(run_file)) as f:
+            return json.load(f)
+    except (IOError, ValueError):
+        return None
+
+
+def write(run_file, manifest, result_file):
+    """
+    write the manifest of a run with result path run_file, that wrote result_file
+    """
+    manifest = dict(manifest, result=os.path.basename(result_file), written=time.time())
+    part = manifest_file(run_file) + ".part"
+    with open(part, "w") as f:
+        json.dump(manifest, f, indent=1, sort_keys=True)
+    os.replace(part, manifest_file(run_file))
+
+
+def up_to_date(run_file, manifest):
+    """
+    the result file of an earlier run with result path run_file, if it
+    exists and was made from the inputs of manifest. Otherwise None,
+    after printing what changed. Skipped runs are added to skipped.
+    """
+    if not skip_up_to_date:
+        return None
+    old = read(run_file)
+    if old is None:
+        return None
+    result_file = os.path.join(os.path.dirname(run_file), old.get("result", ""))
+    if not os.path.isfile(result_file):
+        print("result file of manifest is missing: ", result_file)
+        return None
+    # round-trip through json, so e.g. tuples compare equal to lists
+    new = json.loads(json.dumps(manifest))
+    changed = [key for key in new if old.get(key) != new[key]]
+    if changed:
+        print("run is not up to date, changed: %s" % ", ".join(changed))
+        return None
+    print("up to date, skipping run: ", result_file)
+    skipped.append(result_file)
+    return result_file
@@ -0,0 +1,78 @@
+"""
+    This file is part of ppp-tools, https://github.com/aewallin/ppp-tools
+    GPLv2 license.
+
+    Single-flight locks for downloads.
+
+    When several threads or processes on one host want the same file,
+    e.g. the products for day N when many stations are processed in
+    parallel, only one of them downloads it. The others wait on the
+    lock and then use the finished file.
+
+    Threads of one process wait on a threading.Lock per file, processes
+    wait on an flock() of a lock file in a .locks/ directory next to
+    the downloaded file.
+"""
+import os
+import fcntl
+import threading
+import contextlib
+
+_locks = {}  # path -> [threading.Lock, number of users]
+_guard = threading.Lock()
+
+
+def lock_file(path):
+    (directory, fn) = os.path.split(path)
+    lockdir = os.path.join(directory, ".locks")
+    os.makedirs(lockdir, exist_ok=True)
+    return os.path.join(lockdir, fn + ".lock")
+
+
+@contextlib.contextmanager
+def lock(path):
+    """
+    exclusive lock on path, across threads and processes
+    """
+    with _guard:
+        entry = _locks.setdefault(path, [threading.Lock(), 0])
+        entry[1] += 1
+    try:
+        with entry[0]:
+            with open(lock_file(path), "a") as f:
+                fcntl.flock(f, fcntl.LOCK_EX)
+                try:
+                    yield
+                finally:
+                    fcntl.flock(f, fcntl.LOCK_UN)
+    finally:
+        with _guard:
+            entry[1] -= 1
+            if entry[1] == 0:
+                del _locks[path]
+
+
+def mtime(path):
+    """
+    modification time of path, or None if it does not exist
+    """
+    try:
+        return os.path.getmtime(path)
+    except OSError:
+        return None
+
+
+def fetch(path, fetch_function, mtime_before):
+    """
+    call fetch_function() to create path, unless another thread or
+    process created it while we waited for the lock.
+    mtime_before is mtime(path) from before the caller decided to fetch.
+    Returns True if the file was fetched, False if it was shared.
+    """
+    with lock(path):
+        current = mtime(path)
+        if current is not None and current != mtime_before:
+            print("shared download: ", path)
+            return False
+        fetch_function()
+        return True
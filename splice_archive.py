@@ -0,0 +1,241 @@
+"""
+    This file is part of ppp-tools, https://github.com/aewallin/ppp-tools
+    GPLv2 license.
+
+    Sliding-window archive of spliced RINEX, for multi-day runs.
+
+    A daily job running run_multiday() for "the last N days" would
+    decompress and splice all N days every day, although only one day
+    is new. The archive keeps the decompressed observations of each day
+    in <prefixdir>/stations/<name>/splice.obs (splice_v2.obs for files
+    converted to RINEX 2), and an index splice.json with, for each day,
+    the byte range of its epochs in splice.obs, its header, and the
+    size and mtime of the source file it was read from.
+
+    update() appends new (or re-published) days and forgets days before
+    the window. write() writes the spliced file for a window: the merged
+    header, then the byte range of each day copied from the archive.
+    splice() does both under one lock, so another process can not
+    forget or compact days in between.
+    Each day holds only the epochs from 00:00 of the day until 00:00 of
+    the next day, so consecutive days join without duplicate epochs.
+    When more than half of splice.obs is forgotten days, it is compacted.
+"""
+import os
+import json
+import datetime
+import fcntl
+import contextlib
+
+import ftp_tools
+import decompress
+import rnx3to2
+import rinex_splice
+
+
+class SpliceArchive():
+    """
+    daily observation segments of one station
+    """
+
+    def __init__(self, station, prefixdir="", rinex2=False, prune=None):
+        self.station = station
+        self.rinex2 = rinex2
+        self.prune = prune
+        self.localdir = prefixdir + "/stations/" + station.name + "/"
+        base = self.localdir + ("splice_v2" if rinex2 else "splice")
+        self.data_file = base + ".obs"
+        self.index_file = base + ".json"
+        self.lock_file = base + ".lock"
+        self.recipe = decompress.recipe(rinex2, prune)  # a changed recipe rebuilds the archive
+        self.days = {}  # "YYYY-MM-DD" -> {"offset", "length", "header", "source", "size", "mtime"}
+
+    @contextlib.contextmanager
+    def lock(self):
+        """
+        exclusive lock on the archive, across processes
+        """
+        ftp_tools.check_dir(os.path.dirname(self.localdir.rstrip("/")))
+        ftp_tools.check_dir(self.localdir)
+        with open(self.lock_file, "a") as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                self.load()
+                yield
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+    def load(self):
+        self.days = {}
+        if os.path.isfile(self.index_file) and os.path.isfile(self.data_file):
+            with open(self.index_file) as f:
+                index = json.load(f)
+            if index["recipe"] == self.recipe:  # otherwise the archive is rebuilt
+                self.days = index["days"]
+
+    def save(self):
+        with open(self.index_file + ".tmp", "w") as f:
+            json.dump({"station": self.station.name, "recipe": self.recipe, "days": self.days}, f)
+        os.replace(self.index_file + ".tmp", self.index_file)
+
+    def current(self, day, src):
+        """
+        True if the archive has day, read from the present version of src
+        """
+        entry = self.days.get(day.strftime("%Y-%m-%d"))
+        if entry is None or not os.path.isfile(src):
+            return False
+        st = os.stat(src)
+        return (entry["source"], entry["size"], entry["mtime"]) == (src, st.st_size, st.st_mtime)
+
+    def append(self, day, src, cache=None):
+        """
+        read the epochs of day from src, and append them to the archive
+        """
+        print("splice archive, adding ", day.strftime("%Y-%m-%d"), " from ", src)
+        start = day.replace(hour=0, minute=0, second=0, microsecond=0)
+        end = start + datetime.timedelta(days=1)
+        st = os.stat(src)
+        lines = decompress.rinex_lines(src, self.rinex2, cache, self.prune)
+        try:
+            source = rinex_splice.Source(src, lines)
+            with open(self.data_file, "ab") as fout:
+                offset = fout.tell()
+                segment = []
+                for (time, epoch, records) in source.epochs():
+                    if time is not None and not (start <= time < end):
+                        continue
+                    segment.extend(epoch)
+                    for (system, rows) in records:
+                        segment.extend(rows)
+                    if len(segment) >= 4096:
+                        fout.write(("\n".join(segment) + "\n").encode("latin-1"))
+                        segment = []
+                if segment:
+                    fout.write(("\n".join(segment) + "\n").encode("latin-1"))
+                length = fout.tell() - offset
+        finally:
+            lines.close()
+        self.days[day.strftime("%Y-%m-%d")] = {
+            "offset": offset, "length": length, "header": source.header,
+            "source": src, "size": st.st_size, "mtime": st.st_mtime}
+
+    def splice(self, days, files, spliced_file, cache=None):
+        """
+        update the archive with days (datetimes), read from files, and
+        write the spliced RINEX file for days to spliced_file.
+        """
+        with self.lock():
+            self.update(days, files, cache)
+            return self.write(days, spliced_file)
+
+    def update(self, days, files, cache=None):
+        """
+        make the archive hold days (datetimes), read from files.
+        days before the first day are forgotten.
+        call with the lock() held.
+        """
+        first = min(days).strftime("%Y-%m-%d")
+        for day in [d for d in self.days if d < first]:
+            del self.days[day]
+        for (day, src) in zip(days, files):
+            if not self.current(day, src):
+                self.append(day, src, cache)
+        self.save()
+        live = sum(e["length"] for e in self.days.values())
+        if os.path.getsize(self.data_file) > 2*live:
+            self.compact()
+
+    def compact(self):
+        """
+        rewrite the archive with only the days in the index
+        """
+        print("splice archive, compacting ", self.data_file)
+        offset = 0
+        with open(self.data_file, "rb") as fin:
+            with open(self.data_file + ".tmp", "wb") as fout:
+                for day in sorted(self.days):
+                    entry = self.days[day]
+                    copy_range(fin, fout, entry["offset"], entry["length"])
+                    entry["offset"] = offset
+                    offset += entry["length"]
+        os.replace(self.data_file + ".tmp", self.data_file)
+        self.save()
+
+    def sources(self, days):
+        """
+        rinex_splice.Source objects for days, with the lines of each day
+        read from the archive when they are iterated.
+        """
+        sources = []
+        for day in days:
+            entry = self.days[day.strftime("%Y-%m-%d")]
+            source = rinex_splice.Source(entry["source"], iter(entry["header"]))
+            source.lines = segment_lines(self.data_file, entry["offset"], entry["length"])
+            sources.append(source)
+        return sources
+
+    def write(self, days, spliced_file):
+        """
+        write the spliced RINEX file for days (datetimes) to spliced_file.
+        Days with the observation types of the splice are copied byte by byte.
+        call with the lock() held.
+        """
+        sources = self.sources(days)
+        if any(s.version != sources[0].version for s in sources):
+            raise ValueError("cannot splice RINEX files of different versions")
+        types = rinex_splice.merged_types(sources)
+        header = rinex_splice.merge_header(sources, types)
+        with open(self.data_file, "rb") as fin:
+            with open(spliced_file + ".part", "wb") as fout:
+                fout.write(("\n".join(header) + "\n").encode("latin-1"))
+                for (day, source) in zip(days, sources):
+                    entry = self.days[day.strftime("%Y-%m-%d")]
+                    if all(source.types.get(system) == t for (system, t) in types.items()
+                           if system in source.types):
+                        copy_range(fin, fout, entry["offset"], entry["length"])
+                    else:
+                        rnx3to2.write_lines(rinex_splice.body_lines(source, types), fout)
+        os.replace(spliced_file + ".part", spliced_file)
+        print("spliced ", len(days), " days from the archive into ", spliced_file)
+        return spliced_file
+
+
+def segment_lines(data_file, offset, length):
+    """
+    generator of the lines of a byte range of data_file
+    """
+    with open(data_file, "rb") as f:
+        f.seek(offset)
+        for line in f:
+            if length <= 0:
+                break
+            length -= len(line)
+            yield line.decode("latin-1").rstrip("\n")
+
+
+def copy_range(fin, fout, offset, length):
+    """
+    copy length bytes at offset in file object fin to the end of fout
+    """
+    fout.flush()
+    if hasattr(os, "copy_file_range"):
+        try:
+            while length > 0:
+                n = os.copy_file_range(fin.fileno(), fout.fileno(), length, offset)
+                if n == 0:
+                    break
+                offset += n
+                length -= n
+            fout.seek(0, os.SEEK_END)
+            if length == 0:
+                return
+        except OSError:
+            pass  # e.g. not supported between these filesystems, copy below
+    fin.seek(offset)
+    while length > 0:
+        block = fin.read(min(length, decompress.block_size))
+        if not block:
+            raise IOError("splice archive is truncated")
+        fout.write(block)
+        length -= len(block)
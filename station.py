@@ -3,13 +3,16 @@
     GPLv2 license.
 """
 import os
+import re
 import datetime
-import shutil
-import subprocess
 
 import bipm_ftp
+import rinex_splice
+import splice_archive
+import input_cache
 import ftp_tools
-import wget
+import negative_cache
+import transfer
 
 
 class Station():
@@ -100,33 +103,85 @@ class Station():
     def antex(self):
         return self.antex
 
-    def get_rinex(self, dt):
+    def parse_rinex_filename(self, fn):
         """
-            Retrieve RINEX file using wget
+            the inverse of rinex_filename(): return the datetime of
+            RINEX file fn, or None if fn is not a RINEX file of this station.
+        """
+        m = re.match(re.escape(self.receiver) + r"(\d{3})0\.(\d{2})", fn)
+        if m is None:
+            return None
+        (doy, year) = (int(m.group(1)), 2000 + int(m.group(2)))
+        dt = datetime.datetime(year, 1, 1) + datetime.timedelta(days=doy-1)
+        if dt.year != year or self.rinex_filename(dt) != fn:
+            return None
+        return dt
+
+    def rinex_dir_url(self):
+        """
+            url of the RINEX directory on the server
+        """
+        if self.ftp_server.startswith("http"):
+            return self.ftp_server+self.ftp_dir
+        # plain ftp server
+        return transfer.ftp_url(self.ftp_server, self.ftp_username, self.ftp_password,
+                                self.ftp_dir, "")
+
+    def rinex_transfer(self, dt, prefixdir=None):
+        """
+            return (url, localfile) for the RINEX file of datetime dt.
+            used with transfer.download(), to fetch many files at once.
+            the file is stored in <prefixdir>/stations/<name>/, by default
+            under the current directory. no directories are created here.
+        """
+        if not prefixdir:
+            prefixdir = os.getcwd()
+        localdir = prefixdir + '/stations/' + self.name + '/'
+        localfile = localdir + self.rinex_filename(dt)
+        url = self.rinex_dir_url() + self.rinex_filename(dt)
+        return (url, localfile)
+
+    def get_rinex(self, dt, prefixdir=None):
+        """
+            Retrieve RINEX file over http(s) or ftp
             dt is the datetime for the file we want
             return filename (including path) of RINEX
             this is usually in the form:
             /stations/MYSTATION/rinex_filename.gz
+            Downloads are resumable, and the file appears under its
+            final name only once it is complete.
         """
-        current_dir = os.getcwd()
-        ftp_tools.check_dir(current_dir+'/stations/') # create directory, if it doesn't exist
-        localdir = current_dir + '/stations/' + self.name + '/'
-        ftp_tools.check_dir(localdir)
-        localfile = localdir + self.rinex_filename(dt)
+        if not prefixdir:
+            prefixdir = os.getcwd()
+        (url, localfile) = self.rinex_transfer(dt, prefixdir)
         if os.path.isfile(localfile):
             print(localfile, ' already exists, not downloading')
             return localfile
-        else:
-            print('wget from ', self.ftp_server+self.ftp_dir+self.rinex_filename(dt))
-            return wget.download(self.ftp_server+self.ftp_dir+self.rinex_filename(dt), out=localdir)
-
-    def get_multiday_rinex(self, dtend, num_days=2):
+        ftp_tools.check_dir(os.path.dirname(localfile)) # create directory, if it doesn't exist
+        print('download from ', url)
+        status = transfer.download([(url, localfile)],
+                                   negative=negative_cache.for_prefix(prefixdir))
+        if status[localfile] == "missing":
+            raise IOError("RINEX known to be missing, not retried: %s" % url)
+        if status[localfile] != "downloaded":
+            raise IOError("RINEX download failed: %s" % url)
+        return localfile
+
+    def get_multiday_rinex(self, dtend, num_days=2, rinex2=False, sliding=False, prune=None,
+                           workdir=None):
         """
             get multiple 24h RINEX files
-            splice them together with gfzrnx
+            splice them together, see rinex_splice.py
             dtend is the datetime of the last day
             num_days is the number of days
-            return filename (including path) of spliced RINEX
+            with rinex2, RINEX version 3 files are converted to version 2 while splicing
+            with a prune profile, observations are decimated and pruned while splicing, see rinex_prune.py
+            with sliding, days are kept in a splice_archive.SpliceArchive, so
+            only days not spliced before are decompressed.
+            the spliced file is written into the run directory workdir,
+            by default temp/ of the current directory.
+            return (dtlist, filename), the datetimes of the days and the
+            filename (including path) of the spliced RINEX
         """
         dtlist = [dtend - datetime.timedelta(days=n) for n in reversed(range(num_days))]
         day_files = []
@@ -135,66 +190,22 @@ class Station():
             day_files.append( self.get_rinex(day) )
         print('splicing files: ' + str(day_files))
         # we now have a list of zipped v2 or v3 files
-        # we do processing in a temp directory
+        # we do processing in the run directory
         current_dir = os.getcwd()
-        tempdir = current_dir + "/temp/"
+        tempdir = workdir if workdir is not None else current_dir + "/temp/"
         ftp_tools.check_dir(tempdir)
 
-        # move files to the temp-directory
-        moved_files=[]
-        for f in day_files:
-            shutil.copy2(f, tempdir)
-            (tmp, fn) = os.path.split(f)
-            moved_files.append(tempdir + fn)
-        print(moved_files)
-
-        # now unzip the files
-        # unzip zipped files. this may include the RINEX, CLK, EPH files.
-        for f in moved_files:
-            if f[-1] == "Z" or f[-1] == "z":  # compressed .z or .Z file
-                cmd = '/bin/gunzip'
-                cmd = cmd + " -f " + f  # -f overwrites existing file
-                print("unzipping: ", cmd)
-                p = subprocess.Popen(cmd, shell=True)
-                p.communicate()
-
-        # figure out the unzipped rinex file name
-        unzipped_files =[]
-        #print("rinex= ", rinex)
-        for f in moved_files:
-            (tmp, rinexfile) = os.path.split(f)
-            inputfile = rinexfile[:-2]  # strip off ".Z"
-            if inputfile[-1] == ".":  # ends in a dot
-                inputfile = inputfile[:-1]  # strip off
-            unzipped_files.append(inputfile)
-        print("unzipped files: ", str(unzipped_files))
-
-        # if files are Hatanaka compressed, uncompress
-        rnx_files=[]
-        for inputfile in unzipped_files:
-            if inputfile[-1] == "d" or inputfile[-1] == "D":
-                cmd = "CRX2RNX " + tempdir+inputfile
-                print("Hatanaka uncompress: ", cmd)
-                p = subprocess.Popen(cmd, shell=True)
-                p.communicate()
-                rnx_files.append( inputfile[:-1]+"O" ) # CRX2RNX changes ending to "O"
-            else:
-                rnx_files.append( inputfile )
-
-        print("rinex files to splice: ", len(rnx_files), " ", str(rnx_files))
-        # now splice files together
-        cmd = "gfzrnx -finp "
-        for f in rnx_files:
-            cmd += tempdir+f+" "
-        # kv option to keep rinex version of splice same as input files
-        # f option to overwrite output file, if it already exists
-        cmd += " -fout " + tempdir+"splice.rnx" + " -kv -f"
-        print("splice command: ",cmd)
-        p = subprocess.Popen(cmd, shell=True)
-        p.communicate()
+        # the daily files are decompressed (and Hatanaka decoded) as streams,
+        # straight into the spliced file. Days already in the input cache are read from there.
+        cache = input_cache.for_prefix(current_dir)
+        if sliding:
+            archive = splice_archive.SpliceArchive(self, current_dir, rinex2, prune)
+            archive.splice(dtlist, day_files, tempdir + "splice.rnx", cache)
+        else:
+            rinex_splice.splice(day_files, tempdir + "splice.rnx", rinex2=rinex2, cache=cache, prune=prune)
 
         # return the resulting spliced RINEX filename
-        return dtlist, tempdir+"splice.rnx", moved_files
+        return dtlist, tempdir+"splice.rnx"
 
 
 ########################################################################
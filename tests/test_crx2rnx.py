@@ -0,0 +1,65 @@
+"""
+    This file is part of ppp-tools, https://github.com/aewallin/ppp-tools
+    GPLv2 license.
+
+    Tests of the native Hatanaka decoder, crx2rnx.py
+
+    The files in tests/data/ are small synthetic observation files,
+    compressed with RNX2CRX ver.4.1.0, and the output of CRX2RNX
+    ver.4.1.0 for them:
+    - TEST0040.21d -> TEST0040.21o, Compact RINEX 1.0 (RINEX 2.11)
+    - TEST00XXX_R_20210040000_01D_30S_MO.crx -> .rnx, Compact RINEX 3.0 (RINEX 3.04)
+    - TEST0050.21d -> TEST0050.21o, the first epochs of TEST0040.21o with
+      non-ASCII (latin-1) comments in the header and in an event epoch
+    The first two have event epochs (flags 2-5) with comment lines, arcs that are
+    restarted after missing observations, receiver clock offsets,
+    values between -1 and 1 (written as "-.123"), LLI and signal strength
+    flags, and epochs with more than 12 satellites.
+    The decoded output must be byte-identical to CRX2RNX.
+
+    run with:
+    python -m pytest tests/
+"""
+import os
+import io
+import sys
+import gzip
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import crx2rnx
+import decompress
+
+datadir = os.path.join(os.path.dirname(os.path.abspath(__file__)), "data")
+
+fixtures = [("TEST0040.21d", "TEST0040.21o"),
+            ("TEST00XXX_R_20210040000_01D_30S_MO.crx", "TEST00XXX_R_20210040000_01D_30S_MO.rnx"),
+            ("TEST0050.21d", "TEST0050.21o")]
+
+
+def expected(rnx_name):
+    with open(os.path.join(datadir, rnx_name), "rb") as f:
+        return f.read()
+
+
+def test_decode():
+    for (crx_name, rnx_name) in fixtures:
+        out = io.BytesIO()
+        with open(os.path.join(datadir, crx_name), "rb") as fin:
+            crx2rnx.decode(fin, out)
+        assert out.getvalue() == expected(rnx_name), crx_name
+
+
+def test_stage(tmp_path):
+    # a gzipped Compact RINEX file, as downloaded, is decoded while staging
+    for (crx_name, rnx_name) in fixtures:
+        src = str(tmp_path / (crx_name + ".gz"))
+        with open(os.path.join(datadir, crx_name), "rb") as fin:
+            with gzip.open(src, "wb") as fout:
+                fout.write(fin.read())
+        destdir = tmp_path / "staged"
+        destdir.mkdir(exist_ok=True)
+        staged = decompress.stage(src, str(destdir))
+        assert os.path.basename(staged) == rnx_name
+        with open(staged, "rb") as f:
+            assert f.read() == expected(rnx_name), crx_name
@@ -0,0 +1,48 @@
+"""
+    This file is part of ppp-tools, https://github.com/aewallin/ppp-tools
+    GPLv2 license.
+
+    Tests of the Unix compress (.Z) decoder in decompress.py
+
+    tests/data/TEST00XXX_R_20210040000_01D_30S_MO.rnx.Z is the .rnx
+    fixture of test_crx2rnx.py, compressed with compress(1). It is long
+    enough for the code width to grow to 13 bits.
+
+    run with:
+    python -m pytest tests/
+"""
+import os
+import sys
+import shutil
+import subprocess
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import decompress
+
+datadir = os.path.join(os.path.dirname(os.path.abspath(__file__)), "data")
+
+z_file = os.path.join(datadir, "TEST00XXX_R_20210040000_01D_30S_MO.rnx.Z")
+
+
+def test_unlzw_blocks():
+    with open(os.path.join(datadir, "TEST00XXX_R_20210040000_01D_30S_MO.rnx"), "rb") as f:
+        expected = f.read()
+    with open(z_file, "rb") as fin:
+        assert b"".join(decompress.unlzw_blocks(fin)) == expected
+
+
+@pytest.mark.skipif(shutil.which("gzip") is None, reason="gzip is not installed")
+def test_unlzw_blocks_gzip():
+    # the fallback decoder gives the same output as gzip -dc
+    with open(z_file, "rb") as fin:
+        native = b"".join(decompress.unlzw_blocks(fin))
+    assert native == subprocess.check_output(["gzip", "-dc", z_file])
+
+
+def test_unlzw_blocks_not_compressed():
+    with open(os.path.join(datadir, "TEST0040.21o"), "rb") as fin:
+        with pytest.raises(IOError):
+            b"".join(decompress.unlzw_blocks(fin))